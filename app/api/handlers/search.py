@@ -1,112 +1,39 @@
+from django.conf import settings
 from django.http import JsonResponse
 from django.views import View
 
 from catalog.exceptions import AnalogNotFound, ArticleNotFound
-from catalog.forms import SearchForm
+from catalog.forms import MultiSearchForm, SearchForm
 from catalog.models import Manufacturer, Product
+from catalog.search import autocomplete, comparison, profiling
 from app.api.handlers.functools import make_error_json_response, make_success_json_response
-from app.decorators import a_decorator_passing_logs
+from app.decorators import a_decorator_passing_logs, database_sync_to_async
 
 def get_product_info(analog: Product, original: Product):
-    info = list()
-    info.append(
-        {
-            "analog":
-                {
-                    "name": "наименование", "value": analog.title
-                },
-            "original":
-                {
-                    "name": "наименование", "value": original.title
-                }
-        }
-    )
-
-    matching = {
-        analog.pk: "analog",
-        original.pk: "original"
-    }
-    
-    for attribute__pk, group in original.comparison(analog):
-        elements = list(group)
-        element1 = elements[0]
-        
-        if element1["attribute__title"].lower() in ('ед. изм.', 'цена', 'нет в прайсе'):
-            continue
-        
-        if len(elements) == 2:
-            element2 = elements[1]
-            if element2 != element1:
-                info.append({
-                    matching[element1["product__pk"]]: {
-                        "name": element1["attribute__title"].lower(),
-                        "value": element1["value__title"] if element1["value__title"] is not None else element1["un_value"]
-                    },
-                    matching[element2["product__pk"]]: {
-                        "name": element2["attribute__title"].lower(),
-                        "value": element2["value__title"] if element2["value__title"] is not None else element2["un_value"]
-                    },
-                })
-            else:
-                info.append({
-                    "analog": {
-                        "name": element1["attribute__title"].lower(),
-                        "value": element1["value__title"] if element1["value__title"] is not None else element1[
-                            "un_value"]
-                    },
-                    "original": {
-                        "name": element1["attribute__title"].lower(),
-                        "value": element1["value__title"] if element1["value__title"] is not None else element1[
-                            "un_value"]
-                    }
-                })
-
-        elif len(elements) == 1:
-            product__pk = [key for key in matching.keys() if key != element1["product__pk"]][0]
-            info.append({
-                matching[element1["product__pk"]]: {
-                    "name": element1["attribute__title"].lower(),
-                    "value": element1["value__title"] if element1["value__title"] is not None else element1["un_value"]
-                },
-                
-                matching[product__pk]: {
-                    "name": element1["attribute__title"].lower(),
-                    "value": "------"
-                },
-            })
-
-    info.append(
-        {
-            "analog":
-                {
-                    "name": "производитель", "value": analog.manufacturer.title
-                },
-            "original":
-                {
-                    "name": "производитель", "value": original.manufacturer.title
-                }
-        }
-    )
-
-    return {"result": info}
+    return comparison.get_payload(analog=analog, original=original)
 
 
-def get_analog(article: str = None, manufacturer_to: Manufacturer = None, pk: str = None) -> dict:
+def get_product(article: str = None, pk: str = None, manufacturer_to=None) -> Product:
     if pk:
         product = Product.objects.filter(
             pk=pk
         ).first()
     else:
-        product = Product.objects.filter(
-            article=article,
+        product = Product.objects.by_article(
+            article,
             # is_enabled=True
         ).first()
     
     if not product:
         raise ArticleNotFound("Артикул {} не найден".format(article),
                               "Article: {}, manufacturer to: {}".format(article, manufacturer_to))
+    return product
+
+
+def get_analog(article: str = None, manufacturer_to: Manufacturer = None, pk: str = None, profiler=None) -> dict:
+    product = get_product(article=article, pk=pk, manufacturer_to=manufacturer_to)
     
-    analog = product.get_analog(manufacturer_to)
+    analog = product.get_analog(manufacturer_to, profiler=profiler)
     if not analog:
         raise AnalogNotFound('Аналог по артикулу: {} не найден'.format(article),
                              "Not find analog for article: {}, manufacturer to: {}".format(article, manufacturer_to))
@@ -115,52 +42,111 @@ def get_analog(article: str = None, manufacturer_to: Manufacturer = None, pk: st
 
 
 class SearchView(View):
+    """ Async under ASGI: the searches wait for the database on the bounded pool, see <core.asgi> """
     LIMIT_VIEW = 50
 
     @a_decorator_passing_logs
-    def get(self, request):
+    async def get(self, request):
         article = request.GET.get("article")
     
         if article is not None and len(article) > 1:
-            return make_success_json_response(
-                list(
-                    Product.objects.filter(
-                        article__istartswith=article  # , is_enabled=True  # todo: maybe use later
-                    ).extra(
-                        select={'value': 'article'}
-                    ).values(
-                        'value',
-                        'title',
-                        'manufacturer__title',
-                        'pk'
-                    )[:self.LIMIT_VIEW]
-                ),
-                safe=False
-            )
+            # the index is built from the DB on the first request
+            result = await database_sync_to_async(autocomplete.search)(article, self.LIMIT_VIEW)
+            return make_success_json_response(result, safe=False)
         
         return make_error_json_response(f'{article} не найден')  # JsonResponse({'error': "Not found"})
 
     @a_decorator_passing_logs
-    def post(self, request):
+    async def post(self, request):
+        # the form checks the manufacturer and the user is loaded from the session: all of it off the loop
+        return await database_sync_to_async(self.search)(request)
+
+    # responses of an async view are awaited: Django 3.1 returns the sync ones of <View> as is
+    async def http_method_not_allowed(self, request, *args, **kwargs):
+        return super().http_method_not_allowed(request, *args, **kwargs)
+
+    async def options(self, request, *args, **kwargs):
+        return super().options(request, *args, **kwargs)
+
+    def search(self, request):
         form = SearchForm(request.POST)
         if form.is_valid():
         
             article = form.cleaned_data['article']
             manufacturer_to = form.cleaned_data['manufacturer_to']
             pk = form.cleaned_data["pk"]
+            debug = request.POST.get("debug") if settings.DEBUG or request.user.is_staff else None
+            profiler = profiling.SearchProfiler() if debug else None
         
             try:
-                result = get_analog(article=article, manufacturer_to=manufacturer_to, pk=pk)
-                return make_success_json_response({
+                result = get_analog(article=article, manufacturer_to=manufacturer_to, pk=pk, profiler=profiler)
+                body = {
                     'result': [result["analog"].article],
                     'info': result["info"].get("result"),
                     "image": result["info"].get("image"),
                     'result_pk': result["analog"].pk,
                     'original_pk': result["product"].pk,
                     'error': False
-                })
+                }
+                ranked = result["product"].get_ranked(manufacturer_to)
+                if ranked:
+                    body['ranked'] = [
+                        {'result_pk': product.pk, 'result': product.article, 'score': score}
+                        for product, score in ranked
+                    ]
+                if profiler is not None:
+                    profiling.summary.add(profiler)
+                    body['profile'] = profiler.as_list()
+                    if debug == 'summary':
+                        body['profile_summary'] = profiling.summary.report()
+                return make_success_json_response(body)
             except Exception as e:
                 return make_error_json_response('Аналог не найден')
     
         return make_error_json_response('Некорректные данные.')
 
+
+class MultiSearchView(View):
+    """ Analogs of one product in several manufacturers with their comparison payloads """
+
+    @a_decorator_passing_logs
+    def post(self, request):
+        form = MultiSearchForm(request.POST)
+        if not form.is_valid():
+            return make_error_json_response('Некорректные данные.')
+
+        if form.cleaned_data['all_tried']:
+            manufacturers = list(Manufacturer.objects.filter(is_tried=True))
+        else:
+            manufacturers = list(form.cleaned_data['manufacturers_to'])
+
+        try:
+            product = get_product(article=form.cleaned_data['article'], pk=form.cleaned_data['pk'])
+        except ArticleNotFound:
+            return make_error_json_response('Артикул не найден')
+
+        # a failed search gives no analog, any other error is not a search result
+        analogs = product.get_analogs(manufacturers)
+
+        results = []
+        for manufacturer in manufacturers:
+            analog = analogs.get(manufacturer.pk)
+            if analog is None:
+                results.append({'manufacturer_pk': manufacturer.pk, 'manufacturer': manufacturer.title, 'error': True})
+                continue
+            info = get_product_info(analog=analog, original=product)
+            results.append({
+                'manufacturer_pk': manufacturer.pk,
+                'manufacturer': manufacturer.title,
+                'result': [analog.article],
+                'info': info.get("result"),
+                "image": info.get("image"),
+                'result_pk': analog.pk,
+                'error': False
+            })
+
+        return make_success_json_response({
+            'original_pk': product.pk,
+            'analogs': results,
+            'error': False
+        })
@@ -1,3 +1,182 @@
-from django.test import TestCase
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from app.log_writer import writer
+from app.models import FeedBack
+from catalog.choices import RANKED_ENGINE
+from catalog.models import AnalogSearch, Manufacturer, ProductAnalog
+from catalog.search import autocomplete
+from catalog.search.invalidation import category_version
+from catalog.tests.fixtures import Catalog, reset_caches
+
+
+class SearchTestMixin(object):
+
+    def setUp(self):
+        reset_caches()
+        self.catalog = Catalog().bolts()
+        # request logs are written by a background thread with its own connection
+        self.addCleanup(writer.stop)
+
+    def post(self, name, data) -> dict:
+        response = self.client.post(reverse(f'api:{name}'), data)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+
+class SearchViewTests(SearchTestMixin, TransactionTestCase):
+    """ The async view queries on the threads of the pool: data of the test is committed """
+
+    def test_analog(self):
+        catalog = self.catalog
+        response = self.post('search', {'article': 'A-1', 'manufacturer_to': catalog.target.pk})
+
+        self.assertFalse(response['error'])
+        body = response['body']
+        self.assertEqual((body['result'], body['result_pk'], body['original_pk']),
+                         (['B-1'], catalog.b1.pk, catalog.initial.pk))
+        self.assertEqual(body['info'][0], {
+            'analog': {'name': 'наименование', 'value': 'Болт B-1'},
+            'original': {'name': 'наименование', 'value': 'Болт A-1'}
+        })
+        self.assertNotIn('ranked', body)
+
+        # the result and its comparison payload are stored for the next request
+        stored = ProductAnalog.objects.current().get(product=catalog.initial, manufacturer_to=catalog.target)
+        self.assertEqual(stored.analog, catalog.b1)
+        self.assertEqual(stored.comparison, {'result': body['info']})
+
+        self.assertEqual(self.post('search', {'article': 'A-1', 'manufacturer_to': catalog.target.pk}), response)
+
+    def test_canonical_article(self):
+        response = self.post('search', {'article': 'a 1', 'manufacturer_to': self.catalog.target.pk})
+        self.assertEqual(response['body']['result_pk'], self.catalog.b1.pk)
+
+    @override_settings(ANALOG_SEARCH_ENGINE=RANKED_ENGINE)
+    def test_ranked(self):
+        response = self.post('search', {'article': 'A-1', 'manufacturer_to': self.catalog.target.pk})
+
+        self.assertEqual(response['body']['result_pk'], self.catalog.b1.pk)
+        self.assertEqual(
+            [(item['result'], item['score']) for item in response['body']['ranked']],
+            [('B-1', 1.), ('B-2', 1.5), ('B-3', 1.5)]
+        )
+
+    def test_not_found(self):
+        response = self.post('search', {'article': 'A-1', 'manufacturer_to': self.catalog.other.pk})
+        self.assertEqual(response, {'error': True, 'description': 'Аналог не найден'})
+
+        response = self.post('search', {'article': 'X-1', 'manufacturer_to': self.catalog.target.pk})
+        self.assertTrue(response['error'])
+
+    def test_invalid_form(self):
+        response = self.post('search', {'article': 'A-1'})
+        self.assertEqual(response, {'error': True, 'description': 'Некорректные данные.'})
+
+    async def test_concurrent_searches(self):
+        catalog = self.catalog
+        responses = await asyncio.gather(*(
+            self.async_client.post(reverse('api:search'), {'article': article, 'manufacturer_to': catalog.target.pk})
+            for article in ('A-1', 'a 1', 'A-1')
+        ))
+        self.assertEqual([response.json()['body']['result_pk'] for response in responses], [catalog.b1.pk] * 3)
+
+    def test_autocomplete(self):
+        autocomplete._index = None  # built from the data of this test on the request
+        response = self.client.get(reverse('api:search'), {'article': 'b-'}).json()
+
+        self.assertFalse(response['error'])
+        self.assertEqual([item['value'] for item in response['body']], ['B-1', 'B-2', 'B-3', 'B-4', 'B-5'])
+        self.assertEqual(response['body'][0]['pk'], self.catalog.b1.pk)
+
+        self.assertTrue(self.client.get(reverse('api:search'), {'article': 'b'}).json()['error'])
+
+
+class MultiSearchViewTests(SearchTestMixin, TestCase):
+
+    def analogs(self, response) -> dict:
+        self.assertFalse(response['error'])
+        return {analog['manufacturer_pk']: analog for analog in response['body']['analogs']}
+
+    def test_analogs(self):
+        catalog = self.catalog
+        analogs = self.analogs(self.post('search_multi', {
+            'article': 'A-1', 'manufacturers_to': [catalog.source.pk, catalog.target.pk, catalog.other.pk]
+        }))
+
+        self.assertEqual(analogs[catalog.source.pk]['result_pk'], catalog.initial.pk)
+        self.assertEqual(analogs[catalog.target.pk]['result'], ['B-1'])
+        self.assertEqual(analogs[catalog.target.pk]['info'][-1], {
+            'analog': {'name': 'производитель', 'value': 'Beta'},
+            'original': {'name': 'производитель', 'value': 'Alpha'}
+        })
+        self.assertTrue(analogs[catalog.other.pk]['error'])
+
+    def test_all_tried(self):
+        analogs = self.analogs(self.post('search_multi', {'pk': self.catalog.initial.pk, 'all_tried': True}))
+        self.assertEqual(set(analogs), {self.catalog.source.pk, self.catalog.target.pk})
+
+    def test_stored_analogs(self):
+        catalog = self.catalog
+        version = category_version(catalog.category.pk)
+        ProductAnalog.store(catalog.initial.pk, catalog.target.pk, catalog.b3.pk, [], version)
+
+        analogs = self.analogs(self.post('search_multi', {'article': 'A-1', 'manufacturers_to': [catalog.target.pk]}))
+        self.assertEqual(analogs[catalog.target.pk]['result_pk'], catalog.b3.pk)
+
+    def test_missing_analogs_are_searched_in_one_batch(self):
+        catalog = self.catalog
+        second = catalog.create(Manufacturer, title='Delta')
+        catalog.product('D-1', second, kind=catalog.hex, length=10, diameter=5, weight=2)
+
+        with mock.patch.object(AnalogSearch, 'build_many', wraps=AnalogSearch.build_many) as build_many:
+            analogs = self.analogs(self.post('search_multi', {
+                'article': 'A-1', 'manufacturers_to': [catalog.target.pk, second.pk, catalog.other.pk]
+            }))
+
+        self.assertEqual(build_many.call_count, 1)
+        self.assertEqual(analogs[catalog.target.pk]['result'], ['B-1'])
+        self.assertEqual(analogs[second.pk]['result'], ['D-1'])
+        self.assertTrue(analogs[catalog.other.pk]['error'])
+        # the miss is stored as well
+        self.assertEqual(ProductAnalog.objects.current().filter(product=catalog.initial).count(), 3)
+
+    def test_invalid_form(self):
+        response = self.post('search_multi', {'article': 'A-1'})
+        self.assertEqual(response, {'error': True, 'description': 'Некорректные данные.'})
+
+        response = self.post('search_multi', {'article': 'X-1', 'all_tried': True})
+        self.assertEqual(response, {'error': True, 'description': 'Артикул не найден'})
+
+
+@override_settings(GOOGLE_RECAPTCHA_SECRET_KEY='secret')
+class FeedbackViewTests(TransactionTestCase):
+    """ reCAPTCHA is checked by the async HTTP client """
+    DATA = {
+        'name': 'Иван', 'email': 'ivan@example.com', 'phone': '123', 'text': 'Нет аналога', 'g-recaptcha-response': 'x'
+    }
+
+    def setUp(self):
+        self.addCleanup(writer.stop)
+
+    def post(self, **recaptcha):
+        with mock.patch.object(httpx.AsyncClient, 'post', **recaptcha) as post:
+            response = self.client.post(reverse('api:feedback'), self.DATA)
+        post.assert_called_once()
+        return response
+
+    def test_valid_recaptcha(self):
+        response = self.post(return_value=httpx.Response(200, json={'success': True}))
+
+        self.assertEqual(response.json(), {})
+        self.assertEqual(FeedBack.objects.get().text, 'Нет аналога')
+
+    def test_recaptcha_timeout(self):
+        response = self.post(side_effect=httpx.ConnectTimeout('timeout'))
+
+        self.assertEqual(response.json(), {'OK': False, 'error': 'Invalid reCAPTCHA. Please try again.'})
+        self.assertFalse(FeedBack.objects.exists())
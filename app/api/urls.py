@@ -1,12 +1,13 @@
 from django.conf.urls import url
 from app.api.views import check_product_and_get_attributes, advanced_search, \
     feedback, logout_view, login_view, registration_view, subscriber, report_an_error
-from app.api.handlers.search import SearchView
+from app.api.handlers.search import MultiSearchView, SearchView
 
 app_name = 'api'
 urlpatterns = [
     url(r'^get_product/$', check_product_and_get_attributes, name='get_product'),
     url(r'^search/$', SearchView.as_view(), name='search'),
+    url(r'^search/multi/$', MultiSearchView.as_view(), name='search_multi'),
     url(r'^advanced_search/$', advanced_search, name='advanced_search'),
     url(r'^feedback/$', feedback, name='feedback'),
     url(r'^subscriber/$', subscriber, name='subscriber'),
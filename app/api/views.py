@@ -6,7 +6,7 @@ from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, JsonR
 from django.shortcuts import redirect, render
 from django.views.decorators.csrf import csrf_exempt
 
-from app.decorators import a_decorator_passing_logs
+from app.decorators import a_decorator_passing_logs, database_sync_to_async
 from app.decorators import check_recaptcha
 from app.forms import FeedBackForm, SubscribeForm
 from app.models import FeedBack, MainLog
@@ -20,7 +20,12 @@ from catalog.utils import SearchProducts
 logger = logging.getLogger('analog')
 
 
-def advanced_search(request: HttpRequest) -> HttpResponse:
+async def advanced_search(request: HttpRequest) -> HttpResponse:
+    # the search with its forms and logs runs on the bounded pool, see <core.asgi>
+    return await database_sync_to_async(_advanced_search)(request)
+
+
+def _advanced_search(request: HttpRequest) -> HttpResponse:
     if request.method == 'POST':
         form = SearchForm(request.POST)
         if form.is_valid():
@@ -28,7 +33,7 @@ def advanced_search(request: HttpRequest) -> HttpResponse:
             manufacturer_from = form.cleaned_data['manufacturer_from']
             manufacturer_to = form.cleaned_data['manufacturer_to']
             try:
-                product = Product.objects.get(article=article, manufacturer=manufacturer_from)
+                product = Product.objects.get_by_article(article, manufacturer=manufacturer_from)
             except Product.DoesNotExist:
                 MainLog(user=request.user,
                         message='По артикулу: {} и производителю: {} не найдено товара'.
@@ -64,7 +69,11 @@ def advanced_search(request: HttpRequest) -> HttpResponse:
     return JsonResponse({'result': [], 'error': "Произошла ошибка при выполнении запроса"})
 
 
-def check_product_and_get_attributes(request: HttpRequest) -> HttpResponse:
+async def check_product_and_get_attributes(request: HttpRequest) -> HttpResponse:
+    return await database_sync_to_async(_check_product_and_get_attributes)(request)
+
+
+def _check_product_and_get_attributes(request: HttpRequest) -> HttpResponse:
     if request.method == 'POST':
         form = SearchForm(request.POST)
         if form.is_valid():
@@ -84,29 +93,33 @@ def check_product_and_get_attributes(request: HttpRequest) -> HttpResponse:
 
 @a_decorator_passing_logs
 @check_recaptcha
-def feedback(request: HttpRequest) -> HttpResponse:
+async def feedback(request: HttpRequest) -> HttpResponse:
     if request.method == 'POST':
         form = FeedBackForm(request.POST)
-        user = request.user if str(request.user) != 'AnonymousUser' else None
         if form.is_valid():
             
             if not request.recaptcha_is_valid:
                 return JsonResponse({'OK': False, 'error': 'Invalid reCAPTCHA. Please try again.'})
             
-            try:
-                FeedBack.objects.create(user=user,
-                                        text=form.cleaned_data.get('text', ''),
-                                        email=form.cleaned_data.get('email', ''),
-                                        name=form.cleaned_data.get('name', ''),
-                                        phone=form.cleaned_data.get('phone', ''),
-                                        )
-                return JsonResponse({})
-            except Exception as e:
-                MainLog.objects.create(user=user, raw={'error': e}, has_errors=True)
-                return HttpResponseBadRequest()
+            return await database_sync_to_async(_save_feedback)(request, form)
     return HttpResponseBadRequest()
 
 
+def _save_feedback(request: HttpRequest, form: FeedBackForm) -> HttpResponse:
+    user = request.user if str(request.user) != 'AnonymousUser' else None
+    try:
+        FeedBack.objects.create(user=user,
+                                text=form.cleaned_data.get('text', ''),
+                                email=form.cleaned_data.get('email', ''),
+                                name=form.cleaned_data.get('name', ''),
+                                phone=form.cleaned_data.get('phone', ''),
+                                )
+        return JsonResponse({})
+    except Exception as e:
+        MainLog.objects.create(user=user, raw={'error': e}, has_errors=True)
+        return HttpResponseBadRequest()
+
+
 @a_decorator_passing_logs
 def subscriber(request: HttpRequest) -> HttpResponse:
     if request.method == 'POST':
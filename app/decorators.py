@@ -1,76 +1,160 @@
+import asyncio
+import logging
+import random
+from typing import Optional
+
+import httpx
 import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import close_old_connections
 
+from app.log_writer import writer
 from app.models import MainLog
 from functools import wraps
 
+RECAPTCHA_URL = 'https://www.google.com/recaptcha/api/siteverify'
 
-def a_decorator_passing_logs(func):
-    
-    @wraps(func)
-    def wrapper_logs(*args, **kwargs):
-        if len(args) == 1:
-            request = args[0]  # if called func
-        elif len(args) > 1:
-            request = args[1]  # if called method of class
+logger = logging.getLogger('analog')
 
-        message = {}
-        
+
+def _response_payload(response: bytes) -> Optional[str]:
+    """ Response body to store: sampled by MAINLOG_RESPONSE_SAMPLE_RATE and cut to MAINLOG_RESPONSE_MAX_LENGTH """
+    if random.random() >= getattr(settings, 'MAINLOG_RESPONSE_SAMPLE_RATE', 1.):
+        return None
+    max_length = getattr(settings, 'MAINLOG_RESPONSE_MAX_LENGTH', 2000)
+    payload = response.decode('utf-8', errors='replace')
+    if max_length is not None and len(payload) > max_length:
+        return payload[:max_length] + '...'
+    return payload
+
+
+def database_sync_to_async(func):
+    """
+    Blocking ORM work of an async view, run by <sync_to_async(thread_sensitive=False)> on the default executor
+    of the loop bounded by ASGI_THREADS, see <core.asgi>. Connections are closed by CONN_MAX_AGE as after a request
+    """
+
+    @wraps(func)
+    def run(*args, **kwargs):
+        close_old_connections()
         try:
-            client_address = request.META['HTTP_X_FORWARDED_FOR']
-        except KeyError:
-            client_address = request.META.get('REMOTE_ADDR')
-        
-        message['path_info'] = request.META.get('PATH_INFO')
-        message['method'] = request.method
-        
-        user = request.user
-        if str(request.user) == 'AnonymousUser':
-            user = None
-        
-        if request.method == 'POST':
-            message['post_data'] = request.POST
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def a_decorator_passing_logs(func):
 
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper_logs(*args, **kwargs):
+            response_func = await func(*args, **kwargs)
+            # the user of the request is loaded from the session
+            await database_sync_to_async(_log_request)(_request(args), response_func)
+            return response_func
+
+        return async_wrapper_logs
+
+    @wraps(func)
+    def wrapper_logs(*args, **kwargs):
         response_func = func(*args, **kwargs)
-        response_content_type = response_func._headers['content-type'][1]
-        response = b'<html>'
-        if 'json' in response_content_type:
-            response = response_func._container[0]
-
-        MainLog.objects.create(
-            user=user,
-            message=message,
-            client_address=client_address,
-            raw={
-                'request': {
-                    'raw_request': message,
-                    'HTTP_USER_AGENT': request.META.get('HTTP_USER_AGENT'),
-                    'HTTP_CONNECTION': request.META.get('HTTP_CONNECTION')
-                },
-                'response': {
-                    'response_headers': response_func._headers,
-                    'response': response.decode('utf-8')
-                }
-            }
-        )
-        
+        _log_request(_request(args), response_func)
         return response_func
     
     return wrapper_logs
 
 
+def _request(args):
+    if len(args) == 1:
+        return args[0]  # if called func
+    return args[1]  # if called method of class
+
+
+def _log_request(request, response_func):
+    message = {}
+    
+    try:
+        client_address = request.META['HTTP_X_FORWARDED_FOR']
+    except KeyError:
+        client_address = request.META.get('REMOTE_ADDR')
+    
+    message['path_info'] = request.META.get('PATH_INFO')
+    message['method'] = request.method
+    
+    user = request.user
+    if str(request.user) == 'AnonymousUser':
+        user = None
+    
+    if request.method == 'POST':
+        message['post_data'] = request.POST
+
+    response_content_type = response_func._headers['content-type'][1]
+    response = b'<html>'
+    if 'json' in response_content_type:
+        response = response_func._container[0]
+
+    # written by the background writer, the response does not wait for the insert
+    writer.put(MainLog(
+        user=user,
+        message=message,
+        client_address=client_address,
+        raw={
+            'request': {
+                'raw_request': message,
+                'HTTP_USER_AGENT': request.META.get('HTTP_USER_AGENT'),
+                'HTTP_CONNECTION': request.META.get('HTTP_CONNECTION')
+            },
+            'response': {
+                'response_headers': response_func._headers,
+                'response': _response_payload(response)
+            }
+        }
+    ))
+
+
+def _recaptcha_timeout() -> float:
+    return getattr(settings, 'GOOGLE_RECAPTCHA_TIMEOUT', 5)
+
+
+def _recaptcha_data(request) -> dict:
+    return {
+        'secret': settings.GOOGLE_RECAPTCHA_SECRET_KEY,
+        'response': request.POST.get('g-recaptcha-response')
+    }
+
+
 def check_recaptcha(function):
+    if asyncio.iscoroutinefunction(function):
+        @wraps(function)
+        async def async_wrap(request, *args, **kwargs):
+            request.recaptcha_is_valid = None
+            if request.method == 'POST':
+                # the worker serves other requests while google answers
+                try:
+                    async with httpx.AsyncClient(timeout=_recaptcha_timeout()) as client:
+                        r = await client.post(RECAPTCHA_URL, data=_recaptcha_data(request))
+                    result = r.json()
+                except (httpx.HTTPError, ValueError) as e:
+                    logger.error(f'reCAPTCHA check failed: {e}')
+                    result = {'success': False}
+                request.recaptcha_is_valid = bool(result.get('success'))
+            return await function(request, *args, **kwargs)
+
+        return async_wrap
+
     def wrap(request, *args, **kwargs):
         request.recaptcha_is_valid = None
         if request.method == 'POST':
-            recaptcha_response = request.POST.get('g-recaptcha-response')
-            data = {
-                'secret': settings.GOOGLE_RECAPTCHA_SECRET_KEY,
-                'response': recaptcha_response
-            }
-            r = requests.post('https://www.google.com/recaptcha/api/siteverify', data=data)
-            result = r.json()
-            if result['success']:
+            try:
+                r = requests.post(RECAPTCHA_URL, data=_recaptcha_data(request), timeout=_recaptcha_timeout())
+                result = r.json()
+            except (requests.RequestException, ValueError) as e:
+                logger.error(f'reCAPTCHA check failed: {e}')
+                result = {'success': False}
+            if result.get('success'):
                 request.recaptcha_is_valid = True
             else:
                 request.recaptcha_is_valid = False
@@ -0,0 +1,103 @@
+"""
+Фоновая пакетная запись логов активности
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger('analog')
+
+_STOP = object()
+
+
+class MainLogWriter(object):
+    """
+    Bounded in-process queue of unsaved <MainLog> rows, flushed by <bulk_create> from a background thread
+    when MAINLOG_BATCH_SIZE rows are collected or MAINLOG_FLUSH_INTERVAL seconds have passed.
+    Rows are dropped, not waited for, when the queue is full. Settings are read on the first <start>,
+    so the module can be imported before Django is configured
+    """
+
+    def __init__(self):
+        self.batch_size = None
+        self.interval = None
+        self.queue: Optional[queue.Queue] = None
+        self.dropped = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self.queue is None:
+                self.batch_size = getattr(settings, 'MAINLOG_BATCH_SIZE', 100)
+                self.interval = getattr(settings, 'MAINLOG_FLUSH_INTERVAL', 2.)
+                self.queue = queue.Queue(maxsize=getattr(settings, 'MAINLOG_QUEUE_SIZE', 10000))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='mainlog-writer', daemon=True)
+                self._thread.start()
+
+    def put(self, log):
+        self.start()
+        try:
+            self.queue.put_nowait(log)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped % 1000 == 1:
+                logger.error(f'MainLog queue is full, {dropped} rows dropped')
+
+    def stop(self, timeout: float = 10.):
+        """ Flush queued rows and stop the thread """
+        with self._lock:
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        thread.join(timeout)
+
+    def _run(self):
+        batch: List = []
+        deadline = time.monotonic() + self.interval
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    self._flush(batch)
+                    return
+                if item is not None:
+                    batch.append(item)
+                if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                    self._flush(batch)
+                    batch = []
+                    deadline = time.monotonic() + self.interval
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _flush(batch: List):
+        if not batch:
+            return
+        from app.models import MainLog
+
+        try:
+            MainLog.objects.bulk_create(batch)
+        except Exception as e:
+            logger.error(f'MainLog flush of {len(batch)} rows failed: {e}')
+            connection.close()
+
+
+writer = MainLogWriter()
+atexit.register(writer.stop)
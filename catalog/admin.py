@@ -8,10 +8,12 @@ from django.contrib.auth.models import User
 from django.utils.safestring import mark_safe
 
 from app.models import MainLog
-from catalog.file_utils import ProcessingUploadData, XLSDocumentReader
+from catalog import imports
+from catalog.choices import JOB_FAILED, JOB_PENDING
 from catalog.models import Attribute, Category, DataFile, FixedValue, GroupSubclass, Manufacturer, Product, \
-    Specification, AlternativeCategory
+    Specification, AlternativeCategory, ProductAnalog, AnalogClusterMember, ImportJob
 from catalog.reporters import generators, writers
+from catalog.search import clusters
 
 
 def mark_as_published(modeladmin, request, queryset):
@@ -82,7 +84,7 @@ class CategoryAdmin(BaseAdmin):
 
 
 class AttributeAdmin(BaseAdmin):
-    list_display = ['title', 'unit', 'weight', 'id', 'type', 'priority', 'is_public', 'deleted']
+    list_display = ['title', 'unit', 'weight', 'id', 'type', 'search_type', 'priority', 'is_public', 'deleted']
 
 
 class ProductChangeList(ChangeList):
@@ -159,6 +161,11 @@ class ManufacturerAdmin(BaseAdmin):
     def clear_analogs(self, request, queryset):
         for manufacturer in queryset:
             Product.objects.filter(manufacturer=manufacturer).update(raw=None)
+            ProductAnalog.objects.filter(product__manufacturer=manufacturer).delete()
+            # with the members linked through the products of the manufacturer
+            clusters.unlink(
+                AnalogClusterMember.objects.filter(manufacturer=manufacturer).values_list('product_id', flat=True)
+            )
             for product in Product.objects.filter(manufacturer=manufacturer):
                 product.analogs_to.clear()
 
@@ -226,7 +233,7 @@ class ManufacturerAdmin(BaseAdmin):
 
 
 class FileUploadAdmin(admin.ModelAdmin):
-    actions = ['process_file']
+    actions = ['process_file', 'process_file_upsert']
     list_display = ['file', 'type', 'file_link', 'created_at', 'created_by']
     
     def file_link(self, obj):
@@ -238,17 +245,16 @@ class FileUploadAdmin(admin.ModelAdmin):
     file_link.allow_tags = True
     file_link.short_description = 'Ссылка на скачивание'
     
-    def process_file(self, request, queryset):
+    def process_file(self, request, queryset, upsert=False):
+        # files are imported by the process_imports worker, progress is shown at the import jobs
         for qq in queryset:
-            created, error = ProcessingUploadData(
-                XLSDocumentReader(path=qq.file.name).parse_file(), request=request
-            ).get_structured_data(only_check=False)
-            
-            if created:
-                messages.add_message(request, messages.SUCCESS, 'Данные успешно загружены из {} файла в БД'.format(qq.file.name))
-            else:
-                messages.add_message(request, messages.ERROR, error)
+            job = imports.enqueue(qq, request.user, upsert=upsert)
+            messages.add_message(request, messages.SUCCESS, 'Файл {} поставлен в очередь загрузки #{}'.format(qq.file.name, job.pk))
     process_file.short_description = u'Импортировать данные(общий шаблон)'
+
+    def process_file_upsert(self, request, queryset):
+        self.process_file(request, queryset, upsert=True)
+    process_file_upsert.short_description = u'Импортировать с обновлением существующих товаров'
     
     def save_model(self, request, obj, form, change):
         if not change:
@@ -259,6 +265,32 @@ class FileUploadAdmin(admin.ModelAdmin):
     #autocomplete_fields = ['category']
 
 
+def restart_jobs(modeladmin, request, queryset):
+    queryset.filter(status=JOB_FAILED).update(status=JOB_PENDING, error='', finished_at=None)
+
+
+restart_jobs.short_description = u"Продолжить с последней загруженной строки"
+
+
+class ImportJobAdmin(admin.ModelAdmin):
+    actions = [restart_jobs]
+    list_display = ['id', 'file', 'status', 'upsert', 'progress_display', 'checkpoint', 'total', 'rows_per_second',
+                    'created_count', 'changed_count', 'worker', 'started_at', 'heartbeat_at', 'finished_at']
+    list_filter = ['status', 'upsert', 'created_at']
+    readonly_fields = ['status', 'checkpoint', 'total', 'created_count', 'changed_count', 'rows_per_second', 'worker',
+                       'error', 'created_by', 'started_at', 'heartbeat_at', 'finished_at']
+
+    def progress_display(self, obj):
+        return '-' if obj.progress is None else '{}%'.format(obj.progress)
+
+    progress_display.short_description = 'Прогресс'
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.created_by = request.user
+        obj.save()
+
+
 class MainLogAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'action_time', 'message', 'client_address']
 
@@ -286,7 +318,7 @@ class GroupSubclassAdmin(BaseAdmin):
     
 
 class AlternativeCategoryAdmin(BaseAdmin):
-    list_display = ['original', 'alternative']
+    list_display = ['original', 'alternative', 'priority']
 
 
 admin.site.register(MainLog, MainLogAdmin)
@@ -297,6 +329,7 @@ admin.site.register(Manufacturer, ManufacturerAdmin)
 admin.site.register(Attribute, AttributeAdmin)
 admin.site.register(Specification, BaseAdmin)
 admin.site.register(DataFile, FileUploadAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
 admin.site.register(LogEntry, LogEntryAdmin)
 admin.site.register(GroupSubclass, GroupSubclassAdmin)
 admin.site.register(AlternativeCategory, AlternativeCategoryAdmin)
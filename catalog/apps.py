@@ -6,6 +6,10 @@ class CatalogConfig(AppConfig):
     name = 'catalog'
     verbose_name="Функционал прикладного администратора"
 
+    def ready(self):
+        import catalog.signals  # noqa
+
+
 class AnalogAuthConfig(AuthConfig):
     verbose_name = "Функционал системного администратора"
     
\ No newline at end of file
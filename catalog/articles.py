@@ -0,0 +1,21 @@
+"""
+Приведение артикулов к каноническому виду для поиска
+"""
+import re
+
+# cyrillic letters looking like latin ones, after upper()
+LOOKALIKES = str.maketrans({
+    'А': 'A', 'В': 'B', 'Е': 'E', 'Ё': 'E', 'З': '3', 'К': 'K', 'М': 'M', 'Н': 'H',
+    'О': 'O', 'Р': 'P', 'С': 'C', 'Т': 'T', 'У': 'Y', 'Х': 'X',
+})
+SEPARATORS = re.compile(r'[\W_]+')
+
+
+def canonical_article(article) -> str:
+    """
+    Upper case, cyrillic look-alikes as latin, without spaces, dashes, dots and other separators.
+    Empty for an article of separators only, such an article is looked up by its exact spelling
+    """
+    if article is None:
+        return ''
+    return SEPARATORS.sub('', str(article).upper().translate(LOOKALIKES))
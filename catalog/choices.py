@@ -47,3 +47,25 @@ TYPES_FILE = (
     ('result_search', 'Результат поиска'),
     ('export', 'Экспорт данных')
 )
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE    = 'done'
+JOB_FAILED  = 'failed'
+
+STATUSES_JOB = (
+    (JOB_PENDING, 'В очереди'),
+    (JOB_RUNNING, 'Выполняется'),
+    (JOB_DONE,    'Завершено'),
+    (JOB_FAILED,  'Ошибка')
+)
+
+SQL_ENGINE    = 'sql'
+MATRIX_ENGINE = 'matrix'
+RANKED_ENGINE = 'ranked'
+
+SEARCH_ENGINES = (
+    (SQL_ENGINE,    'Запросы к БД'),
+    (MATRIX_ENGINE, 'Матрица атрибутов в памяти'),
+    (RANKED_ENGINE, 'Взвешенное ранжирование')
+)
@@ -1,20 +1,75 @@
 # import the logging library
+import csv
+import io
 import logging
+import multiprocessing
+import os
+import pickle
 import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import openpyxl
+from django.conf import settings
 from django.contrib.auth import models as auth_md
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 from openpyxl.utils.exceptions import InvalidFileException
-from functools import lru_cache
 from app.models import MainLog
+from catalog.articles import canonical_article
 from catalog.choices import _dict, _rev_dict
 from catalog.models import *
 
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # parquet is read by pandas then, if it is installed
+    pq = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
 # Get an instance of a logger
 logger = logging.getLogger('analog')
 
 
-class XLSDocumentReader(object):
+class DocumentReader(object):
+    """
+    Lines of a document as {column number: stripped non-empty string}, the first lines are the header.
+    Subclasses implement <iter_rows>
+    """
+
+    def parse_file(self):
+        self.doc = list(self.iter_rows())
+        return self.doc
+
+    def iter_rows(self) -> Iterator[dict]:
+        raise NotImplementedError
+
+    def iter_chunks(self, size: int = 1000) -> Iterator[List[dict]]:
+        return chunked(self.iter_rows(), size)
+
+    def count_rows(self) -> Optional[int]:
+        """ Number of lines if it is known without parsing the document """
+        return None
+
+    @staticmethod
+    def line(values: Iterable) -> dict:
+        line = {}
+        for cnt_c, cell_value in enumerate(values):
+            if cell_value is None:
+                continue
+            value = str(cell_value).strip()
+            if value:
+                line[cnt_c] = value
+        return line
+
+
+class XLSDocumentReader(DocumentReader):
     
     def __init__(self, path=None, workbook=None):
         assert path or workbook, "You should provide either path to file or XLS-object"
@@ -35,53 +90,220 @@ class XLSDocumentReader(object):
         self.options = {}
         self.values = []
         self.doc = []
-        
-    def parse_file(self):
+
+    def iter_rows(self) -> Iterator[dict]:
+        """ Lines {column: value} one by one from the read-only sheet, memory does not depend on file size """
         logger.debug(f'Start parse file: {self.xlsx}')
         start_time = time.time()
         
-        rows = self.sheet.rows
-        for cnt, row in enumerate(rows):
-            
-            line = {}
-            for cnt_c, cell in enumerate(row):
-    
-                if cell.value is None:
-                    continue
-                value = str(cell.value).strip()
-                
-                if value:
-                    line.update({cnt_c: value})
-                    
-            self.doc.append(line)
-            
-        self.workbook._archive.close()
+        try:
+            for row in self.sheet.iter_rows(values_only=True):
+                yield self.line(row)
+        finally:
+            self.workbook._archive.close()
         
         logger.debug(f'Finish parse file, time left: {time.time() - start_time}s')
-        return self.doc
 
+    def count_rows(self) -> Optional[int]:
+        """
+        Rows counted by a pass over the read-only sheet: the stored dimensions may be missing or stale.
+        The pass is cheap next to the import, which checks and writes every row
+        """
+        return sum(1 for _ in self.sheet.iter_rows(values_only=True))
 
-@lru_cache()
-def get_manufacturer(manufacturer: str):
-    return Manufacturer.objects.get(title__icontains=manufacturer)
 
+class CSVDocumentReader(DocumentReader):
+    """ CSV/TSV by the C parser of the csv module, the delimiter is sniffed when it is not given """
+    DELIMITERS = ',;\t|'
+    SAMPLE_SIZE = 64 * 1024
 
-@lru_cache()
-def get_category(product_class, product_subclass):
-    return Category.objects.get(
-        title__iexact=product_subclass,
-        parent__title__iexact=product_class
-    )
+    def __init__(self, path, delimiter: str = None, encoding: str = None):
+        self.path = path
+        self.delimiter = delimiter
+        self.encoding = encoding or getattr(settings, 'IMPORT_CSV_ENCODING', 'utf-8-sig')
+        self.doc = []
+
+    def _open(self):
+        """ Text stream of a path or of a file object, e.g. <FieldFile> """
+        if isinstance(self.path, (str, os.PathLike)):
+            binary = open(self.path, 'rb')
+        else:
+            binary = self.path
+            if hasattr(binary, 'open'):
+                binary.open('rb')
+            else:
+                binary.seek(0)
+        return io.TextIOWrapper(binary, encoding=self.encoding, newline='')
+
+    def _delimiter(self, stream) -> str:
+        if self.delimiter:
+            return self.delimiter
+        sample = stream.read(self.SAMPLE_SIZE)
+        stream.seek(0)
+        try:
+            return csv.Sniffer().sniff(sample, delimiters=self.DELIMITERS).delimiter
+        except csv.Error:
+            return ','
+
+    def iter_rows(self) -> Iterator[dict]:
+        logger.debug(f'Start parse file: {self.path}')
+        start_time = time.time()
+
+        with self._open() as stream:
+            for row in csv.reader(stream, delimiter=self._delimiter(stream)):
+                yield self.line(row)
+
+        logger.debug(f'Finish parse file, time left: {time.time() - start_time}s')
+
+
+class ParquetDocumentReader(DocumentReader):
+    """ Parquet by record batches of pyarrow, or by pandas; column names make the first line """
+
+    def __init__(self, path, batch_size: int = 10000):
+        assert pq is not None or pd is not None, "Reading parquet files requires pyarrow or pandas"
+        self.path = path
+        self.batch_size = batch_size
+        self.doc = []
+
+    def iter_rows(self) -> Iterator[dict]:
+        logger.debug(f'Start parse file: {self.path}')
+        start_time = time.time()
+
+        if pq is not None:
+            parquet = pq.ParquetFile(self.path)
+            yield self.line(parquet.schema_arrow.names)
+            for batch in parquet.iter_batches(batch_size=self.batch_size):
+                for row in zip(*(column.to_pylist() for column in batch.columns)):
+                    yield self.line(row)
+        else:
+            frame = pd.read_parquet(self.path)
+            yield self.line(frame.columns)
+            for row in frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None):
+                yield self.line(row)
+
+        logger.debug(f'Finish parse file, time left: {time.time() - start_time}s')
+
+    def count_rows(self) -> Optional[int]:
+        if pq is None:
+            return None
+        return pq.ParquetFile(self.path).metadata.num_rows + 1  # and the line of column names
+
+
+READERS = {
+    '.csv': CSVDocumentReader,
+    '.tsv': lambda path: CSVDocumentReader(path, delimiter='\t'),
+    '.parquet': ParquetDocumentReader,
+}
 
 
-@lru_cache()
-def get_attribute(category, name):
-    return Attribute.objects.get(category=category, title__iexact=name)
+def document_reader(path) -> DocumentReader:
+    """ Reader by the file extension, Excel is the default; path is a string or a file object with a name """
+    _, extension = os.path.splitext(str(getattr(path, 'name', path)))
+    return READERS.get(extension.lower(), XLSDocumentReader)(path=path)
 
 
-@lru_cache()
-def get_fixed_value(value, attribute):
-    return FixedValue.objects.get(title__iexact=value, attribute=attribute)
+def chunked(lines: Iterable, size: int) -> Iterator[list]:
+    lines = iter(lines)
+    chunk = list(islice(lines, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(lines, size))
+
+
+class ImportResolver(object):
+    """
+    Reference data of one import session: manufacturers, categories, attributes and fixed values
+    are preloaded by a handful of queries, existing product keys once per manufacturer or all at once
+    by <preload_products> for a snapshot of the validation pool.
+    Lookups repeat the matching of the former per-row queries (icontains/iexact) on dictionaries
+    """
+
+    def __init__(self):
+        self.manufacturers = list(Manufacturer.objects.all())
+
+        self.categories = defaultdict(list)
+        for category in Category.objects.filter(parent__isnull=False).select_related('parent'):
+            self.categories[(category.parent.title.lower(), category.title.lower())].append(category)
+
+        attributes = Attribute.objects.in_bulk()
+        self.attributes = defaultdict(list)
+        for category_pk, attribute_pk in Category.attributes.through.objects.values_list('category_id', 'attribute_id'):
+            attribute = attributes.get(attribute_pk)
+            if attribute is not None:  # not deleted
+                self.attributes[(category_pk, attribute.title.lower())].append(attribute)
+
+        self.fixed_values = defaultdict(list)
+        for fixed_value in FixedValue.objects.all():
+            self.fixed_values[(fixed_value.attribute_id, fixed_value.title.lower())].append(fixed_value)
+
+        self._manufacturers_by_title = {}
+        self._product_keys: Dict[int, Dict[tuple, List[int]]] = {}
+        self._all_products = False  # keys of every manufacturer are loaded, no more queries
+
+    def preload_products(self):
+        """ Keys of the products of every manufacturer by one query """
+        keys = defaultdict(lambda: defaultdict(list))
+        for manufacturer_pk, pk, article, additional_article in Product.objects.values_list(
+            'manufacturer_id', 'pk', 'article', 'additional_article'
+        ).iterator():
+            keys[manufacturer_pk][(article, additional_article)].append(pk)
+        self._product_keys = {manufacturer_pk: keys[manufacturer_pk] for manufacturer_pk in keys}
+        self._all_products = True
+
+    def snapshot(self) -> bytes:
+        """ Pickled resolver with all product keys for the processes of the validation pool """
+        if not self._all_products:
+            self.preload_products()
+        return pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _one(model, objects: list, **lookup):
+        if not objects:
+            raise model.DoesNotExist(f'{model.__name__} matching {lookup} does not exist')
+        if len(objects) > 1:
+            raise model.MultipleObjectsReturned(f'{len(objects)} {model.__name__} matching {lookup}')
+        return objects[0]
+
+    def get_manufacturer(self, manufacturer: str) -> Manufacturer:
+        title = (manufacturer or '').lower()
+        if title not in self._manufacturers_by_title:
+            self._manufacturers_by_title[title] = [m for m in self.manufacturers if title in m.title.lower()]
+        return self._one(Manufacturer, self._manufacturers_by_title[title], title__icontains=manufacturer)
+
+    def get_category(self, product_class: str, product_subclass: str) -> Category:
+        return self._one(
+            Category, self.categories.get((product_class.lower(), product_subclass.lower()), []),
+            title__iexact=product_subclass, parent__title__iexact=product_class
+        )
+
+    def get_attribute(self, category: Category, name: str) -> Attribute:
+        return self._one(Attribute, self.attributes.get((category.pk, name.lower()), []), title__iexact=name)
+
+    def get_fixed_value(self, value: str, attribute: Attribute) -> FixedValue:
+        return self._one(FixedValue, self.fixed_values.get((attribute.pk, value.lower()), []), title__iexact=value)
+
+    def _keys(self, manufacturer: Manufacturer) -> Dict[tuple, List[int]]:
+        if manufacturer.pk not in self._product_keys:
+            keys = defaultdict(list)
+            if self._all_products:  # a manufacturer without products
+                self._product_keys[manufacturer.pk] = keys
+                return keys
+            for pk, article, additional_article in Product.objects.filter(
+                manufacturer=manufacturer
+            ).values_list('pk', 'article', 'additional_article'):
+                keys[(article, additional_article)].append(pk)
+            self._product_keys[manufacturer.pk] = keys
+        return self._product_keys[manufacturer.pk]
+
+    def product_pks(self, article: str, manufacturer: Manufacturer, additional_article: str) -> List[int]:
+        return self._keys(manufacturer).get((article, additional_article), [])
+
+    def count_products(self, article: str, manufacturer: Manufacturer, additional_article: str) -> int:
+        return len(self.product_pks(article, manufacturer, additional_article))
+
+    def add_product(self, article: str, manufacturer: Manufacturer, additional_article: str, pk: int = None):
+        """ Products created in the session are seen by the checks of the next chunks """
+        self._keys(manufacturer)[(article, additional_article)].append(pk)
 
 
 class ProcessingUploadData(object):
@@ -102,7 +324,11 @@ class ProcessingUploadData(object):
         value: value,
         name: name
     }
+    data: list of lines or an iterator over them, e.g. <document_reader(path).iter_rows()>;
+    the body is consumed by chunks of CHUNK_SIZE lines, only the header and the current chunk are kept
     """
+    CHUNK_SIZE = 1000
+
     STRUCTURE_PRODUCT = (
         (0, "title"),
         (1, "class"),
@@ -119,9 +345,11 @@ class ProcessingUploadData(object):
     STRUCTURE_PRODUCT_REV_DICT = _rev_dict(STRUCTURE_PRODUCT)
     STRUCTURE_PRODUCT_DICT = _dict(STRUCTURE_PRODUCT)
     
-    def __init__(self, data, request=None):
+    def __init__(self, data, request=None, bulk=None, upsert=False, user=None, workers: int = None):
         
-        if request is None:
+        if user is not None:
+            self.user = user
+        elif request is None:
             self.user = auth_md.User.objects.get(is_staff=True, username='admin')
         else:
             self.user = request.user
@@ -135,11 +363,26 @@ class ProcessingUploadData(object):
         self.attributes = []
         self.options = []
         self.body = []
+        self.first_line = 0  # line of the body the import starts from
 
         self.unique_manufacturer, self.unique_class, self.unique_subclass = set(), set(), set()
         self.unique_type_attributes, self.unique_value_attributes = set(), set()
         
         self.products = []
+        self.errors = []  # [(line number, error), ...] of the last check
+        self.bulk = bulk if bulk is not None else getattr(settings, 'IMPORT_BULK_CREATE', True)
+        # existing products are updated with changed fields and attribute values instead of being rejected
+        self.upsert = upsert
+        self.created_products, self.changed_products = [], []
+        self.resolver = ImportResolver()
+        # processes validating chunks, see <iter_validated>
+        self.workers = workers if workers is not None else getattr(settings, 'IMPORT_VALIDATION_WORKERS', 1)
+        self.seen_keys = set()  # (manufacturer pk, article, additional article) of the checked lines
+
+    @classmethod
+    def from_file(cls, path, **kwargs) -> "ProcessingUploadData":
+        """ Lines of the file are streamed by the reader of its type """
+        return cls(document_reader(path).iter_rows(), **kwargs)
         
     def get_structured_data(self, only_check=True):
         self.to_separate()
@@ -148,63 +391,178 @@ class ProcessingUploadData(object):
         #     self.unique_type_attributes.add(self.attributes[opt])
         #     self.unique_value_attributes.add(self.options[opt])
         
-        for count, line in enumerate(self.body):
-            if count % 100 == 0:
-                logger.debug('Line #{}'.format(count))
-                # messages.add_message(request, messages.INFO, 'Success processed {} lines'.format(count))
-            if not line:  # empty line
-                continue
-                
-            structured_product, attributes = {}, []
-            try:
-                self.unique_class.add(line[1])
-                self.unique_subclass.add(line[6])
-                self.unique_manufacturer.add(line[7])
-            except KeyError:
-                return False, 'Error in line: {}'.format(line)
-            
-            for key in line.keys():
-                if key < 9:
-                    structured_product.update({
-                            self.STRUCTURE_PRODUCT[key][1]: line[key]  # article: 1234
-                    })
-                else:
-                    attributes.append({
-                        "name": self.options[key],
-                        "value": line[key]
-                        })
-
-            structured_product.update({
-                self.STRUCTURE_PRODUCT[9][1]: attributes
-            })
-
-            is_valid_data = self.check_exists_types(structured_product)
-
-            if isinstance(is_valid_data, str):
-                MainLog(
-                    user=self.user,
-                    message=f'{is_valid_data}\n reason: {structured_product}, time: {time.time() - self.start_time}'
-                ).save()
-                return False, is_valid_data
-            else:
-                self.products.append(is_valid_data)
-        logger.debug('Check correct and finish, start creating products')
-        # messages.add_message(request, messages.SUCCESS, 'Check correct and finish, start create products')
-        if not only_check:
-            self.create_products()
-        
+        # products of checked chunks are created at once, errors of any chunk roll them back
+        errors = []
+        with transaction.atomic():
+            for _, products, chunk_errors in self.iter_validated():
+                errors.extend(chunk_errors)
+                self.products = self.recheck(products, errors)
+
+                if not errors and not only_check:
+                    self.create_products()
+            if errors:
+                transaction.set_rollback(True)
+
+        if errors:
+            return False, self.report(errors)
+
+        logger.debug('Check correct and finish')
         MainLog(user=self.user, message='Processing success in {}  seconds'.format(time.time()-self.start_time)).save()
+        if self.upsert and not only_check:
+            return True, 'Success: {} created, {} changed'.format(len(self.created_products), len(self.changed_products))
         return True, 'Success'
         
         # TODO: make correctly check_exists
         #resp = self.check_exists_category()
+
+    def import_chunks(self, start: int = 0, on_chunk=None) -> Tuple[bool, str]:
+        """
+        Import with a transaction per chunk, continuing from the <start> line of the body.
+        on_chunk(end) is called in the transaction of the chunk, so a checkpoint saved there is committed
+        together with the products. Stops at the first chunk with errors, the earlier chunks stay imported
+        """
+        self.to_separate()
+        self.body = islice(self.body, start, None)
+        self.first_line = start
+
+        for end, products, errors in self.iter_validated():
+            with transaction.atomic():
+                self.products = self.recheck(products, errors)
+                if errors:
+                    break
+                self.create_products()
+                if on_chunk is not None:
+                    on_chunk(end)
+        else:
+            MainLog(user=self.user, message=f'Import from line {start} finished in {time.time() - self.start_time}s').save()
+            return True, 'Success'
+
+        return False, self.report(errors)
+
+    def recheck(self, products: list, errors: list) -> list:
+        """
+        Workers check rows against the snapshot, products created from earlier chunks and lines repeated
+        within the file are checked here, in the same way with and without the import
+        """
+        checked = []
+        for count, product in products:
+            manufacturer = product['manufacturer_obj']
+            key = (manufacturer.pk, product['article'], product.get('additional_article', ""))
+            if key in self.seen_keys:
+                error = 'Ошибка! Продукт с наименованием - {} и производителем товара - {} повторяется в файле'.format(
+                    product['article'], manufacturer.title)
+            else:
+                self.seen_keys.add(key)
+                error = None if self.upsert else self.check_not_exists(product, manufacturer)
+            if error is not None:
+                errors.append((count, error, product))
+            else:
+                checked.append(product)
+        return checked
+
+    def report(self, errors: list) -> str:
+        errors.sort(key=lambda error: error[0])
+        self.errors = [(count + self.OPTION_LINE + 2, error) for count, error, _ in errors]
+        report = '\n'.join(f'Строка {line_number}: {error}' for line_number, error in self.errors)
+        MainLog(
+            user=self.user,
+            message=f'{report}\n reason: {errors[0][2]}, time: {time.time() - self.start_time}'
+        ).save()
+        return report
+
+    def iter_validated(self) -> Iterator[Tuple[int, list, list]]:
+        """
+        (end, [(count, product), ...], [(count, error, reason), ...]) per chunk in file order,
+        end is the body line after the chunk.
+        With workers > 1 (opt-in, e.g. big files of the import worker) chunks are validated by a process pool
+        over a snapshot of the resolver with the product keys preloaded here, the workers make no queries
+        """
+        chunks = self.iter_chunks()
+        if self.workers <= 1:
+            for start, lines in chunks:
+                yield self.validate_chunk(start, lines)
+            return
+
+        from catalog import validation
+
+        # spawned processes do not share the state of this one: threads, DB connections
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=validation.init,
+                                 initargs=(self.resolver.snapshot(), self.options, self.upsert)) as executor:
+            pending = deque()
+            for start, lines in chunks:
+                pending.append(executor.submit(validation.validate_chunk, start, lines))
+                if len(pending) >= self.workers * 2:  # bounded number of chunks in memory
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def iter_chunks(self) -> Iterator[Tuple[int, list]]:
+        start = self.first_line
+        for lines in chunked(self.body, self.CHUNK_SIZE):
+            yield start, lines
+            start += len(lines)
+
+    def validate_chunk(self, start: int, lines: list) -> Tuple[int, list, list]:
+        products, errors = [], []
+        for count, line in enumerate(lines, start):
+            product, error, reason = self.process_line(line, count)
+            if error is not None:
+                errors.append((count, error, reason))
+            elif product is not None:
+                products.append((count, product))
+        return start + len(lines), products, errors
+
+    def process_line(self, line, count):
+        """ Checked product of one line or (None, error, reason) if the line is invalid """
+        if count % 100 == 0:
+            logger.debug('Line #{}'.format(count))
+            # messages.add_message(request, messages.INFO, 'Success processed {} lines'.format(count))
+        if not line:  # empty line
+            return None, None, None
+            
+        structured_product, attributes = {}, []
+        try:
+            self.unique_class.add(line[1])
+            self.unique_subclass.add(line[6])
+            self.unique_manufacturer.add(line[7])
+        except KeyError:
+            return None, 'Error in line: {}'.format(line), line
+        
+        for key in line.keys():
+            if key < 9:
+                structured_product.update({
+                        self.STRUCTURE_PRODUCT[key][1]: line[key]  # article: 1234
+                })
+            else:
+                attributes.append({
+                    "name": self.options[key],
+                    "value": line[key]
+                    })
+
+        structured_product.update({
+            self.STRUCTURE_PRODUCT[9][1]: attributes
+        })
+
+        is_valid_data = self.check_exists_types(structured_product)
+
+        if isinstance(is_valid_data, str):
+            return None, is_valid_data, structured_product
+        
+        return is_valid_data, None, None
         
     def to_separate(self):
-        self.attributes = self.data[self.ATTRIBUTE_LINE]
-        self.options = self.data[self.OPTION_LINE]
-        self.body = self.data[self.OPTION_LINE+1:]
+        lines = iter(self.data)
+        header = list(islice(lines, self.OPTION_LINE + 1))
+        self.attributes = header[self.ATTRIBUTE_LINE] if len(header) > self.ATTRIBUTE_LINE else {}
+        self.options = header[self.OPTION_LINE] if len(header) > self.OPTION_LINE else {}
+        self.body = lines
     
     def create_products(self):
+        if self.upsert:
+            self.products = self.upsert_products()
+        if self.bulk:
+            return self.bulk_create_products()
         
         def create_attr():
             attr_val = AttributeValue(
@@ -233,41 +591,195 @@ class ProcessingUploadData(object):
                 irrelevant=True if product.get("irrelevant", False) in ("True", "true", 1, "1", True) else False
             )
             new_product.save()
+            self.resolver.add_product(new_product.article, new_product.manufacturer, new_product.additional_article,
+                                      new_product.pk)
+            self.created_products.append(new_product.pk)
             for attr in product['attributes']:
                 create_attr()
  
+    def bulk_create_products(self):
+        """ Products of the current chunk and their attribute values by <bulk_create>, without per-row signals """
+        from catalog.search import autocomplete, invalidation
+
+        batch_size = getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+        new_products = [
+            Product(
+                article=product['article'],
+                normalized_article=canonical_article(product['article']),  # save() is not called
+                additional_article=product.get('additional_article', ""),
+                manufacturer=product['manufacturer_obj'],
+                created_by=self.user,
+                updated_by=self.user,
+                **self.product_fields(product)
+            ) for product in self.products
+        ]
+        Product.objects.bulk_create(new_products, batch_size=batch_size)  # pks are returned by postgres
+        for new_product in new_products:
+            self.resolver.add_product(new_product.article, new_product.manufacturer, new_product.additional_article,
+                                      new_product.pk)
+        self.created_products.extend(new_product.pk for new_product in new_products)
+
+        attribute_values = []
+        for new_product, product in zip(new_products, self.products):
+            for attr in product['attributes']:
+                value, un_value = self.attribute_value(attr)
+                attribute_values.append(AttributeValue(
+                    value=value,
+                    un_value=un_value,
+                    attribute=attr['attr_obj'],
+                    created_by=self.user,
+                    updated_by=self.user,
+                    product=new_product
+                ))
+        AttributeValue.objects.bulk_create(attribute_values, batch_size=batch_size)
+
+        # post_save is not sent by bulk_create, the categories are invalidated here with their caches
+        invalidation.schedule(*{new_product.category_id for new_product in new_products})
+        transaction.on_commit(autocomplete.invalidate)
+
+    # fields of <Product> set by <product_fields>
+    PRODUCT_FIELDS = ('series', 'title', 'category', 'priority', 'is_tried', 'irrelevant')
+
+    @staticmethod
+    def product_fields(product) -> dict:
+        """ Fields of <Product> taken from a checked line, except the (manufacturer, article, additional_article) key """
+        return {
+            "series": product.get('series', ""),
+            "title": product['title'],
+            "category": product['category_obj'],
+            "priority": int(product.get('priority', 10)),
+            "is_tried": True,
+            "irrelevant": True if product.get("irrelevant", False) in ("True", "true", 1, "1", True) else False
+        }
+
+    @staticmethod
+    def attribute_value(attr) -> tuple:
+        """ (value, un_value) of a checked attribute, is_fixed of the preloaded attribute instead of a query """
+        if attr['attr_obj'].is_fixed:
+            return attr['value'], None
+        return None, attr['value']
+
+    def upsert_products(self) -> list:
+        """
+        Update existing products of the current chunk with changed fields and attribute values by bulk queries,
+        attribute values missing in the file are soft-deleted. Products not found in the DB are returned
+        """
+        from catalog.search import autocomplete, invalidation
+
+        now = timezone.now()
+        batch_size = getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+
+        # the last line of a product wins
+        rows, new = {}, {}
+        for product in self.products:
+            key = (product['manufacturer_obj'].pk, product['article'], product.get('additional_article', ""))
+            pks = self.resolver.product_pks(key[1], product['manufacturer_obj'], key[2])
+            if pks:
+                rows[pks[0]] = product
+            else:
+                new[key] = product
+        new = list(new.values())
+        if not rows:
+            return new
+
+        stored = Product.objects.in_bulk(list(rows))
+        values = defaultdict(list)
+        for attribute_value in AttributeValue.objects.filter(product__in=list(rows)):
+            values[attribute_value.product_id].append(attribute_value)
+
+        changed_products, created_values, changed_values, removed_values = [], [], [], []
+        changed, category_pks = set(), set()
+        for pk, product in rows.items():
+            instance = stored[pk]
+            fields = self.product_fields(product)
+            # category is compared by pk, without fetching the related object
+            if any(getattr(instance, Product._meta.get_field(field).attname) != getattr(value, 'pk', value)
+                   for field, value in fields.items()):
+                category_pks.add(instance.category_id)
+                for field, value in fields.items():
+                    setattr(instance, field, value)
+                instance.updated_by, instance.updated_at = self.user, now
+                changed_products.append(instance)
+                changed.add(pk)
+
+            current = {}
+            for attribute_value in values[pk]:
+                if attribute_value.attribute_id in current:  # duplicated value of an attribute
+                    removed_values.append(attribute_value.pk)
+                else:
+                    current[attribute_value.attribute_id] = attribute_value
+
+            for attr in product['attributes']:
+                value, un_value = self.attribute_value(attr)
+                attribute_value = current.pop(attr['attr_obj'].pk, None)
+                if attribute_value is None:
+                    created_values.append(AttributeValue(
+                        value=value, un_value=un_value, attribute=attr['attr_obj'],
+                        created_by=self.user, updated_by=self.user, product_id=pk
+                    ))
+                elif (attribute_value.value_id, attribute_value.un_value) != (getattr(value, 'pk', None), un_value):
+                    attribute_value.value, attribute_value.un_value = value, un_value
+                    attribute_value.updated_by, attribute_value.updated_at = self.user, now
+                    changed_values.append(attribute_value)
+                else:
+                    continue
+                changed.add(pk)
+
+            if current:
+                removed_values.extend(attribute_value.pk for attribute_value in current.values())
+                changed.add(pk)
+
+        Product.objects.bulk_update(
+            changed_products, list(self.PRODUCT_FIELDS) + ['updated_by', 'updated_at'], batch_size=batch_size
+        )
+        AttributeValue.objects.bulk_create(created_values, batch_size=batch_size)
+        AttributeValue.objects.bulk_update(
+            changed_values, ['value', 'un_value', 'updated_by', 'updated_at'], batch_size=batch_size
+        )
+        AttributeValue.objects.filter(pk__in=removed_values).update(deleted=True, updated_by=self.user, updated_at=now)
+        Product.objects.filter(pk__in=changed).update(attributes_version=F('attributes_version') + 1)
+
+        if changed:
+            self.changed_products.extend(sorted(changed))
+            category_pks.update(stored[pk].category_id for pk in changed)
+            # a changed product can become the best analog of any product of the category, as in the signals
+            invalidation.schedule(*category_pks)
+            transaction.on_commit(autocomplete.invalidate)
+        return new
+
     def check_exists_types(self, product):
         # check manufacturer
         try:
-            manufacturer = get_manufacturer(product.get('manufacturer'))
+            manufacturer = self.resolver.get_manufacturer(product.get('manufacturer'))
         except Manufacturer.DoesNotExist:
             return 'Ошибка! Не найден производитель товаров: {}'.format(product.get('manufacturer'))
+        except Manufacturer.MultipleObjectsReturned:
+            return 'Ошибка! Найдено несколько производителей товаров: {}'.format(product.get('manufacturer'))
         # check category
         try:
-            category = get_category(product['class'], product['subclass'],)
+            category = self.resolver.get_category(product['class'], product['subclass'],)
         except Category.DoesNotExist:
             return 'Ошибка! Не найден класс {} с подклассом {}'.format(product['class'], product['subclass'])
         except Category.MultipleObjectsReturned:
             return 'Ошибка! Найдено более одного подкласса {} с классом {}'.format(product['subclass'], product['class'])
         # check product
-        try:
-            Product.objects.get(article=product['article'], manufacturer=manufacturer, additional_article=product.get("additional_article"))
-            return 'Ошибка! Наден продукт с наименованием - {} и производителем товара - {} в БД'.format(
-                product['article'], manufacturer.title)
-        except Product.DoesNotExist:
-            pass
-        except Product.MultipleObjectsReturned:
-            return 'Ошибка! Найдено несколько продуктов с наименованием - {} и производителем товара - {} в БД'.format(
-                product['article'], manufacturer.title)
+        if self.upsert:
+            if self.resolver.count_products(product['article'], manufacturer, product.get("additional_article", "")) > 1:
+                return 'Ошибка! Найдено несколько продуктов с наименованием - {} и производителем товара - {} в БД'.format(
+                    product['article'], manufacturer.title)
+        else:
+            error = self.check_not_exists(product, manufacturer)
+            if error is not None:
+                return error
         # check attributes
         for attr in product['attributes']:
             # find instance attribute
             try:
-                attribute = get_attribute(category, attr['name'])
+                attribute = self.resolver.get_attribute(category, attr['name'])
                 attr.update({"attr_obj": attribute})
                 # find fixed attribute
                 if attribute.is_fixed:
-                    fix_value = get_fixed_value(attr['value'], attribute)
+                    fix_value = self.resolver.get_fixed_value(attr['value'], attribute)
                     attr['value'] = fix_value
                 else:
                     attr['value'] = float(attr['value'].replace(',', '.')) if is_digit(attr['value'].replace(',', '.')) else attr['value']
@@ -277,6 +789,8 @@ class ProcessingUploadData(object):
                 return f'Ошибка! Найдено несколько атрибутов с наименованием {attr["name"]}'
             except FixedValue.DoesNotExist:
                 return f'Ошибка! Не найден фикс. атрибут {attribute} со значением {attr["value"]}'
+            except FixedValue.MultipleObjectsReturned:
+                return f'Ошибка! Найдено несколько значений фикс. атрибута {attribute} со значением {attr["value"]}'
             #  todo: useful insert check FixedValue.DoesNotExist
         
         product.update({
@@ -286,9 +800,28 @@ class ProcessingUploadData(object):
         
         return product
 
+    def check_not_exists(self, product, manufacturer):
+        found = self.resolver.count_products(product['article'], manufacturer, product.get("additional_article", ""))
+        if found == 1:
+            return 'Ошибка! Наден продукт с наименованием - {} и производителем товара - {} в БД'.format(
+                product['article'], manufacturer.title)
+        if found > 1:
+            return 'Ошибка! Найдено несколько продуктов с наименованием - {} и производителем товара - {} в БД'.format(
+                product['article'], manufacturer.title)
+        return None
+
+    @classmethod
+    def validator(cls, resolver: ImportResolver, options, upsert: bool) -> "ProcessingUploadData":
+        """ Instance only able to check lines, for workers of the validation pool """
+        instance = cls.__new__(cls)
+        instance.resolver, instance.options = resolver, options
+        instance.upsert = upsert
+        instance.unique_manufacturer, instance.unique_class, instance.unique_subclass = set(), set(), set()
+        return instance
+
     def get_attribute(self):
         pass
-    
+
 
 def is_digit(s):
     try:
@@ -26,6 +26,22 @@ class SearchForm(forms.Form):
     pk = forms.CharField(label='Primary key', required=False)
     
 
+class MultiSearchForm(forms.Form):
+    article = forms.CharField(label='Артикул', required=False)
+    pk = forms.CharField(label='Primary key', required=False)
+    manufacturers_to = forms.ModelMultipleChoiceField(label='Необходимые производители', required=False,
+                                                      queryset=Manufacturer.objects.all())
+    all_tried = forms.BooleanField(label='Все проверенные производители', required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('article') and not cleaned_data.get('pk'):
+            raise forms.ValidationError('Не указан артикул')
+        if not cleaned_data.get('manufacturers_to') and not cleaned_data.get('all_tried'):
+            raise forms.ValidationError('Не указаны производители')
+        return cleaned_data
+
+
 class AdvancedSearchForm(forms.Form):
     article = forms.CharField(label='Артикул', widget=forms.TextInput(attrs={'readonly':'readonly'}))#, disabled=True, required=False)
     # advanced_search = forms.BooleanField(label='Расширенный поиск', widget=forms.CheckboxInput, required=False)
@@ -1,6 +1,5 @@
-from catalog.file_utils import XLSDocumentReader
-from catalog.models import Product, DataFile
-from catalog.utils import SearchProducts
+from catalog.file_utils import document_reader
+from catalog.models import AnalogSearch, Product, DataFile
 from catalog import choices
 from catalog.internal.utils import get_product_info
 
@@ -9,6 +8,7 @@ from app.models import MainLog
 from catalog.reporters.writers import dump_csv, BookkeepingWriter
 
 import csv
+import os
 
 from django.conf import settings
 from django.shortcuts import render
@@ -20,48 +20,60 @@ class ProcessingSearchFile:
         self.path = path
         self.form = form
         self.request = request
-        self.content = XLSDocumentReader(path=path).parse_file()
+        self.content = document_reader(path).parse_file()
         self.manufacturer_from = form.cleaned_data['manufacturer_from']
         
     @staticmethod
     def check_product(article, manufacturer):
         if manufacturer is None:
-            products = Product.objects.filter(article=article)
+            products = Product.objects.by_article(article)
         else:
-            products = Product.objects.filter(article=article, manufacturer=manufacturer)
-            
-        if products.exists():
-            return products.first(), ''
+            products = Product.objects.by_article(article, manufacturer=manufacturer)
+        
+        product = products.first()
+        if product is not None:
+            return product, ''
         else:
             return None, u'Not found product with article %s' % article
     
     def file_search(self, data=None):
         if not data:
             data = self.content
+        manufacturer_to = self.form.cleaned_data['manufacturer_to']
+
+        checked = [(rec, ) + self.check_product(rec.get(0), self.manufacturer_from) for rec in data]
+        products = [product for _, product, _ in checked if product is not None]
+        errors = {}
+        analogs = AnalogSearch.build_many(products, [manufacturer_to], errors=errors)
+        found = Product.objects.in_bulk([analog_pk for analog_pk, _ in analogs.values() if analog_pk is not None])
+
         result_content = []
-        for i, rec in enumerate(data):
+        for rec, product, err in checked:
             body = list()
             
             body.append(rec.get(0))
             body.append(rec.get(1))
-            product, err = self.check_product(rec.get(0), self.manufacturer_from)
             
             if product is None:
                 body.append(err)
                 result_content.append(err)
                 continue
             
-            instance = SearchProducts(self.request, self.form, product)
-            instance.global_search(default=True)
-            
-            if instance.founded_products.count():
-                body.append(instance.founded_products.first().article)
+            key = (product.pk, manufacturer_to.pk)
+            if key in errors:
+                body.append(str(errors[key]))
+                result_content.append(body)
+                continue
+
+            analog_pk, _ = analogs[key]
+            if analog_pk is not None:
+                body.append(found[analog_pk].article)
             else:
                 body.append('not found a product that meets the criteria')
             
             result_content.append(body)
         
-        filename = 'OUT_{}.xls'.format(self.path.name[6:-5])
+        filename = 'OUT_{}.xls'.format(os.path.splitext(os.path.basename(self.path.name))[0])
         
         dump_csv(filename, result_content)
         instance = DataFile(type=choices.TYPES_FILE[2][0], created_by=self.request.user, updated_by=self.request.user)
@@ -115,7 +127,7 @@ def result_api_processing(instance, request, default=True):
         # founded products must be one
         founded_product = instance.founded_products.first()
         return JsonResponse(
-            {'result': [founded_product.article], 'info': get_product_info(founded_product),
+            {'result': [founded_product.article], 'info': get_product_info(founded_product, instance.product),
              # {'result': [prod.article for prod in instance.founded_products[:1]],
              'error': False, 'Lead_time': instance.lead_time}, content_type='application/json')
     else:
@@ -0,0 +1,125 @@
+"""
+Фоновая загрузка файлов в БД с продолжением с последней загруженной строки
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from catalog.choices import JOB_DONE, JOB_FAILED, JOB_PENDING, JOB_RUNNING
+from catalog.models import DataFile, ImportJob
+
+logger = logging.getLogger('analog')
+
+
+class JobLost(Exception):
+    """ The job was claimed by another worker after a missed heartbeat """
+
+
+def enqueue(datafile: DataFile, user, upsert: bool = False) -> ImportJob:
+    return ImportJob.objects.create(file=datafile, created_by=user, upsert=upsert)
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim(worker: str) -> Optional[ImportJob]:
+    """ Oldest pending job, or a running one whose worker has stopped sending heartbeats """
+    now = timezone.now()
+    stale = now - timedelta(seconds=getattr(settings, 'IMPORT_JOB_STALE_TIMEOUT', 600))
+    with transaction.atomic():
+        job = ImportJob.objects.select_for_update(skip_locked=True).filter(
+            Q(status=JOB_PENDING) | Q(status=JOB_RUNNING, heartbeat_at__lt=stale)
+        ).order_by('created_at').first()
+        if job is None:
+            return None
+
+        if job.status == JOB_RUNNING:
+            logger.warning(f'Import job <{job.pk}> of {job.worker} is resumed from line {job.checkpoint}')
+        job.status, job.worker, job.error = JOB_RUNNING, worker, ''
+        job.heartbeat_at = now
+        job.started_at = job.started_at or now
+        job.save(update_fields=('status', 'worker', 'error', 'heartbeat_at', 'started_at'))
+    return job
+
+
+def validation_workers(job: ImportJob) -> int:
+    """ Process pool only for files big enough to pay for the workers, see <ProcessingUploadData.iter_validated> """
+    if job.total is None or job.total - job.checkpoint < getattr(settings, 'IMPORT_POOL_MIN_ROWS', 50000):
+        return 1
+    return getattr(settings, 'IMPORT_POOL_WORKERS', min(4, os.cpu_count() or 1))
+
+
+def heartbeat(job: ImportJob, stop: threading.Event):
+    """
+    Heartbeats of the job independent of chunk commits, so a long chunk is not taken for a stopped worker.
+    Stops when the job is no longer owned by the worker
+    """
+    try:
+        while not stop.wait(getattr(settings, 'IMPORT_HEARTBEAT_INTERVAL', 60)):
+            if not ImportJob.objects.filter(pk=job.pk, worker=job.worker).update(heartbeat_at=timezone.now()):
+                logger.warning(f'Import job <{job.pk}> is no longer owned by {job.worker}')
+                break
+    finally:
+        connection.close()
+
+
+def run(job: ImportJob) -> bool:
+    """ Import the file of a claimed job from its checkpoint, every chunk is committed with the new checkpoint """
+    from catalog.file_utils import ProcessingUploadData, document_reader
+
+    start_time, start = time.time(), job.checkpoint
+    created, changed = job.created_count, job.changed_count
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job, stop), name=f'import-heartbeat-{job.pk}', daemon=True).start()
+    try:
+        reader = document_reader(job.file.file.name)
+        processing = ProcessingUploadData(reader.iter_rows(), user=job.created_by, upsert=job.upsert)
+        if job.total is None:
+            rows = reader.count_rows()
+            job.total = max(rows - processing.OPTION_LINE - 1, 0) if rows else None
+        processing.workers = validation_workers(job)
+
+        def on_chunk(end: int):
+            job.checkpoint = end
+            job.created_count = created + len(processing.created_products)
+            job.changed_count = changed + len(processing.changed_products)
+            job.rows_per_second = (end - start) / max(time.time() - start_time, 1e-6)
+            job.heartbeat_at = timezone.now()
+            # the row lock is held until the chunk commits, a job taken over by another worker rolls the chunk back
+            if not ImportJob.objects.filter(pk=job.pk, worker=job.worker).update(
+                checkpoint=job.checkpoint, total=job.total, created_count=job.created_count,
+                changed_count=job.changed_count, rows_per_second=job.rows_per_second, heartbeat_at=job.heartbeat_at
+            ):
+                raise JobLost(f'Import job <{job.pk}> is no longer owned by {job.worker}')
+            logger.debug(f'Import job <{job.pk}>: {end} lines, {job.rows_per_second:.1f} lines/s')
+
+        success, message = processing.import_chunks(start, on_chunk)
+    except JobLost as e:
+        logger.warning(f'{e}, the chunk is rolled back')
+        return False
+    except Exception:
+        success, message = False, traceback.format_exc()
+        logger.exception(f'Import job <{job.pk}> failed')
+    finally:
+        stop.set()
+
+    job.status = JOB_DONE if success else JOB_FAILED
+    job.error = '' if success else message
+    job.finished_at = timezone.now()
+    if not ImportJob.objects.filter(pk=job.pk, worker=job.worker).update(
+        status=job.status, error=job.error, finished_at=job.finished_at, total=job.total
+    ):
+        logger.warning(f'Import job <{job.pk}> is no longer owned by {job.worker}, its status is not saved')
+        return False
+    return success
@@ -21,13 +21,13 @@ class DuplicateCheck(object):
             if product.is_duplicate:
                 continue
             
-            selection = Product.objects.filter(article=product.article)
-            if selection.count() > 1:
-                selection.update(is_duplicate=True)
+            selection = list(Product.objects.by_article(product.article).values_list('pk', flat=True))
+            if len(selection) > 1:
+                Product.objects.filter(pk__in=selection).update(is_duplicate=True)
     
     @staticmethod
     def get_products(article: str):
-        return Product.objects.filter(article=article)
+        return Product.objects.by_article(article)
     
     def search_duplicates(self, api=False):
         if isinstance(self._product, str):
@@ -56,7 +56,7 @@ class ProductInfo(object):
     def _get_product(self):
         product = None
         if self.article is not None:
-            product = Product.objects.get(article=self.article)
+            product = Product.objects.get_by_article(self.article)
             
         if self.product is None and self.form is not None:
             product = self._get_product_from_form()
@@ -68,9 +68,9 @@ class ProductInfo(object):
         manufacturer_from = self.form.cleaned_data.get('manufacturer_from')
         
         if manufacturer_from:
-            product = Product.objects.get(article=article, manufacturer=manufacturer_from)
+            product = Product.objects.get_by_article(article, manufacturer=manufacturer_from)
         else:
-            product = Product.objects.get(article=article)
+            product = Product.objects.get_by_article(article)
         return product
     
     def _serialize_fix_attribute(self):
@@ -116,24 +116,19 @@ def get_product_info(analog, original=None):
                  {"name": "наименование", "value": original.title}
              }]
 
-    original_info = original.get_info()
-    analog_get_info = analog.get_info()
+    original_info = {
+        attr.attribute.title: attr for attr in original.attributevalue_set.select_related('attribute', 'value')
+    }
     
     fixed_attributes = []  # for find images in groups
     
-    for attr in analog_get_info:
+    for attr in analog.attributevalue_set.select_related('attribute', 'value'):
         analog_name = attr.attribute.title
-        orig_attr = None
         
         if analog_name in ('ед.изм', 'цена'):
             continue
         
-        for original_attr in original_info:
-            print(original_attr.attribute.title, analog_name)
-            if original_attr.attribute.title == analog_name:
-                orig_attr = original_attr
-                break
-        
+        orig_attr = original_info.get(analog_name)
         analog_info = {'name': analog_name}
         
         if attr.attribute.is_fixed:
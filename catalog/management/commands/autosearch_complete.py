@@ -4,12 +4,13 @@ from django.contrib.auth import models as auth_md
 from django.core.mail import EmailMessage
 
 from datetime import datetime
+import json
 import time
 
 from catalog.reporters import generators, writers
-from catalog.models import Manufacturer, Category, Attribute, FixedValue, Product
+from catalog.search import profiling
+from catalog.models import AnalogSearch, Manufacturer, Category, Attribute, FixedValue, Product
 from catalog.internal.messages import _get_connection
-from catalog.utils import SearchProducts
 
 from app.models import MainLog
 
@@ -21,8 +22,9 @@ logger = logging.getLogger('analog')
 
 class SearchTable(object):
     """ Automatic search for analogues """
-    def __init__(self, full=False, products=None, manufacturers=None):
+    def __init__(self, full=False, products=None, manufacturers=None, profile=False):
         self.start_time = time.time()
+        self.profile = profile
         self.lead_time = 0
         self.user = auth_md.User.objects.get(is_staff=True, username='admin')
         
@@ -42,53 +44,51 @@ class SearchTable(object):
     
     def build(self):
         logger.debug('{} products'.format(self.products.count()))
-        for i, manufacturer in enumerate(self.manufacturers):
-            logger.debug('{}/{} from {}'.format(i, self.manufacturers.count(), manufacturer.title))
+        manufacturers = list(self.manufacturers)
+        for i, manufacturer in enumerate(manufacturers):
+            logger.debug('{}/{} from {}'.format(i, len(manufacturers), manufacturer.title))
             
-            products = self.products.filter(manufacturer=manufacturer)
-            logger.debug('{} products from {}'.format(products.count(), manufacturer.title))
-            # need_manufactures = Manufacturer.objects.exclude(pk=manufacturer.pk)
+            products = list(self.products.filter(manufacturer=manufacturer))
+            logger.debug('{} products from {}'.format(len(products), manufacturer.title))
+
+            profiler = profiling.SearchProfiler(manufacturer.pk) if self.profile else None
+            errors = {}
+            with profiling.maybe_stage(profiler, profiling.BATCH) as stage:
+                analogs = AnalogSearch.build_many(products, manufacturers, errors=errors, profiler=profiler)
+                stage.candidates = len(products)
+            if profiler is not None:
+                profiling.summary.add(profiler)
         
             for product in products:
                 raw = product.raw
                 if raw is not None:
-                    analogs = raw.get('analogs', None)
+                    analogs_raw = raw.get('analogs', None)
                 else:
-                    raw, analogs = {}, {}
+                    raw, analogs_raw = {}, {}
             
-                if not analogs:
+                if not analogs_raw:
                     raw.update(
                         {'analogs': {},
                          'errors': False,
                          'description': None
                          })
             
-                for mm in self.manufacturers:
-                    result = SearchProducts(product=product, manufacturer_to=mm)
-                    try:
-                        result.global_search()
-                        if result.founded_products is None or not result.founded_products.exists():
-                            analog = {mm.title: None}
-                        else:
-                            analog = {mm.title: result.founded_products.first().pk}
-                    
-                        raw['analogs'].update(analog)
-                        # product.raw = {
-                        #     'analogs': {}
-                        # }
-                    except Exception as e:
+                for mm in manufacturers:
+                    error = errors.get((product.pk, mm.pk))
+                    if error is not None:
                         raw.update({
                             'errors_%s' % mm.title: True,
-                            'description_%s' % mm.title: str(e),
+                            'description_%s' % mm.title: str(error),
                             'errors': True
                         })
-                    finally:
-                        del result
+                        continue
+                    analog_pk, _ = analogs[(product.pk, mm.pk)]
+                    raw['analogs'].update({mm.title: analog_pk})
                 
                 product.is_enabled = True
                 product.raw = raw
                 product.is_updated = True
-                product.save()
+                product.save(update_fields=('is_enabled', 'raw', 'is_updated'))
     
     def __enter__(self):
         return self
@@ -105,6 +105,11 @@ class SearchTable(object):
 class Command(BaseCommand):
     help = 'Automatic search for analogues'
 
+    def add_arguments(self, parser):
+        parser.add_argument("--profile", action="store_true", help="print batch percentiles per manufacturer")
+
     def handle(self, *args, **options):
-        with SearchTable() as st:
+        with SearchTable(profile=options["profile"]) as st:
             st.build()
+        if options["profile"]:
+            self.stdout.write(json.dumps(profiling.summary.report(), indent=2))
@@ -0,0 +1,37 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog import imports
+
+# Get an instance of a logger
+logger = logging.getLogger('analog')
+
+
+class Command(BaseCommand):
+    """ Worker of background file imports """
+    help = 'Process queued imports of data files, resuming interrupted ones from their checkpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+        parser.add_argument("--sleep", type=float, default=5., help="seconds between polls of an empty queue")
+
+    def handle(self, *args, **options):
+        worker = imports.worker_name()
+        self.stdout.write(f'Import worker {worker} started')
+
+        while True:
+            job = imports.claim(worker)
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["sleep"])
+                continue
+
+            self.stdout.write(f'Import job <{job.pk}> {job.file} from line {job.checkpoint}')
+            success = imports.run(job)
+            self.stdout.write(
+                f'Import job <{job.pk}> {"done" if success else "failed"}: {job.checkpoint} lines, '
+                f'{job.created_count} created, {job.changed_count} changed'
+            )
@@ -0,0 +1,65 @@
+import json
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Case, Count, F, IntegerField, Q, Value, When
+
+from catalog.models import AnalogSearch, Category, Manufacturer, Product
+from catalog.search import profiling
+
+# Get an instance of a logger
+logger = logging.getLogger('analog')
+
+
+class Command(BaseCommand):
+    """ Recompute stored analogs for products whose results were invalidated """
+    help = 'Recompute precomputed analogs of invalidated categories'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--category", type=int, nargs="*", help="categories pk, all by default")
+        parser.add_argument("--batch", type=int, default=500)
+        parser.add_argument("--profile", action="store_true", help="print stage percentiles per category")
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        manufacturers = list(Manufacturer.objects.filter(is_tried=True))
+
+        categories = Category.objects.exclude(parent=None)
+        if options["category"]:
+            categories = categories.filter(pk__in=options["category"])
+
+        total = 0
+        for category in categories:
+            # rows of an older catalog version are stale, so only incomplete products are recomputed;
+            # the analog of a product at its own manufacturer is the product itself and is not stored
+            products = list(
+                Product.objects.filter(category=category).annotate(
+                    stored=Count('precomputed_analogs', filter=Q(precomputed_analogs__catalog_version=F('category__version'))),
+                    own=Case(When(manufacturer__in=manufacturers, then=Value(1)), default=Value(0),
+                             output_field=IntegerField())
+                ).filter(stored__lt=len(manufacturers) - F('own'))
+            )
+            for offset in range(0, len(products), options["batch"]):
+                batch = products[offset:offset + options["batch"]]
+                profiler = profiling.SearchProfiler(category.pk) if options["profile"] else None
+                with profiling.maybe_stage(profiler, profiling.BATCH) as stage:
+                    total += self.recompute(category, batch, manufacturers, profiler)
+                    stage.candidates = len(batch)
+                if profiler is not None:
+                    profiling.summary.add(profiler)
+
+        self.stdout.write(f'Recomputed {total} analogs in {time.time() - start_time}s')
+        if options["profile"]:
+            self.stdout.write(json.dumps(profiling.summary.report(), indent=2))
+
+    @staticmethod
+    def recompute(category, products, manufacturers, profiler=None) -> int:
+        """ Missing results of the batch are searched and stored by <AnalogSearch.build_many> """
+        errors = {}
+        analogs = AnalogSearch.build_many(products, manufacturers, errors=errors, profiler=profiler)
+        if errors:
+            logger.error(f'{len(errors)} searches failed for category <{category.pk}>, they stay incomplete')
+
+        logger.debug(f'Recomputed {len(analogs)} analogs for category <{category.pk}>')
+        return len(analogs)
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from catalog.file_utils import ProcessingUploadData, XLSDocumentReader
+from catalog.file_utils import ProcessingUploadData
 
 import logging
 
@@ -15,7 +15,7 @@ class Command(BaseCommand):
     
     def add_arguments(self, parser):
         parser.add_argument(
-            "--filename", action="store_true",
+            "--filename", help="xlsx, csv, tsv or parquet file",
         )
     
     def handle(self, *args, **options):
@@ -23,8 +23,7 @@ class Command(BaseCommand):
         if not filename:
             filename = 'files/North_Aurora(fason).xlsx'
 
-        created, error = ProcessingUploadData(
-            XLSDocumentReader(path=filename).parse_file()).get_structured_data(only_check=False)
+        created, error = ProcessingUploadData.from_file(filename).get_structured_data(only_check=False)
         
         if created:
             self.stdout.write(f'File {filename} is upload success')
@@ -1,5 +1,7 @@
 from django.db import models
 
+from catalog.articles import canonical_article
+
 
 class CoreQuerySet(models.query.QuerySet):
     """QuerySet whose delete() does not delete items, but instead marks the
@@ -8,6 +10,33 @@ class CoreQuerySet(models.query.QuerySet):
     def delete(self):
         self.update(deleted=True)
 
+
+class ProductQuerySet(models.query.QuerySet):
+    """ Bulk writes of <Product.article> keep <Product.normalized_article> in sync, as <Product.save> does """
+
+    def update(self, **kwargs):
+        if 'article' in kwargs and 'normalized_article' not in kwargs:
+            if not isinstance(kwargs['article'], (str, type(None))):
+                raise ValueError('normalized_article must be passed along with an article expression')
+            kwargs['normalized_article'] = canonical_article(kwargs['article'])
+        return super().update(**kwargs)
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        fields = list(fields)
+        if 'article' in fields:
+            for obj in objs:
+                obj.normalized_article = canonical_article(obj.article)
+            if 'normalized_article' not in fields:
+                fields.append('normalized_article')
+        return super().bulk_update(objs, fields, batch_size=batch_size)
+
+
+class ProductAnalogQuerySet(models.query.QuerySet):
+
+    def current(self):
+        """ Results computed for the current version of the product category, older ones are stale """
+        return self.filter(catalog_version=models.F('product__category__version'))
+
     
 class CoreModelManager(models.Manager):
     # TODO make this compatible with related fields.
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.10 on 2026-10-17 10:12
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0027_alternativecategory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Версия каталога'),
+        ),
+        migrations.CreateModel(
+            name='ProductAnalog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('second_dataset', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None, verbose_name='Товары после жесткой проверки')),
+                ('catalog_version', models.PositiveIntegerField(default=0, verbose_name='Версия каталога')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Когда обновлено')),
+                ('analog', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catalog.Product', verbose_name='Аналог')),
+                ('manufacturer_to', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catalog.Manufacturer', verbose_name='Производитель')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='precomputed_analogs', to='catalog.Product', verbose_name='Исходный товар')),
+            ],
+            options={
+                'verbose_name': 'Предрассчитанный аналог',
+                'verbose_name_plural': 'Предрассчитанные аналоги',
+                'unique_together': {('product', 'manufacturer_to')},
+            },
+        ),
+    ]
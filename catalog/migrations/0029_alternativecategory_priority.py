@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-17 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0028_productanalog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alternativecategory',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Приоритет'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.10 on 2026-10-17 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0029_alternativecategory_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalogCluster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Когда создано')),
+            ],
+            options={
+                'verbose_name': 'Группа аналогов',
+                'verbose_name_plural': 'Группы аналогов',
+            },
+        ),
+        migrations.CreateModel(
+            name='AnalogClusterMember',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('confidence', models.FloatField(default=1.0, verbose_name='Достоверность')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Когда обновлено')),
+                ('cluster', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='catalog.AnalogCluster', verbose_name='Группа')),
+                ('linked_from', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='catalog.Product', verbose_name='Связан через')),
+                ('manufacturer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catalog.Manufacturer', verbose_name='Производитель')),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='analog_cluster', to='catalog.Product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Товар группы аналогов',
+                'verbose_name_plural': 'Товары групп аналогов',
+                'index_together': {('cluster', 'manufacturer')},
+            },
+        ),
+    ]
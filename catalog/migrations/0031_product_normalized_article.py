@@ -0,0 +1,33 @@
+# Generated by Django 2.2.10 on 2026-10-17 16:20
+
+from django.db import migrations, models
+
+from catalog.articles import canonical_article
+
+
+def fill_normalized_article(apps, schema_editor):
+    Product = apps.get_model('catalog', 'Product')
+    batch = []
+    for product in Product.objects.only('pk', 'article').iterator(chunk_size=2000):
+        product.normalized_article = canonical_article(product.article)
+        batch.append(product)
+        if len(batch) >= 2000:
+            Product.objects.bulk_update(batch, ['normalized_article'])
+            batch = []
+    Product.objects.bulk_update(batch, ['normalized_article'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0030_analogcluster'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='normalized_article',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255, verbose_name='Канонический артикул'),
+        ),
+        migrations.RunPython(fill_normalized_article, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.10 on 2026-10-17 17:05
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0031_product_normalized_article'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='attributes_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Версия атрибутов'),
+        ),
+        migrations.AddField(
+            model_name='productanalog',
+            name='comparison',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True, verbose_name='Таблица сравнения'),
+        ),
+        migrations.AddField(
+            model_name='productanalog',
+            name='comparison_key',
+            field=models.CharField(blank=True, default='', max_length=255, verbose_name='Версии товаров сравнения'),
+        ),
+    ]
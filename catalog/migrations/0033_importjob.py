@@ -0,0 +1,42 @@
+# Generated by Django 2.2.10 on 2026-10-17 18:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalog', '0032_comparison_payload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Завершено'), ('failed', 'Ошибка')], db_index=True, default='pending', max_length=7, verbose_name='Статус')),
+                ('upsert', models.BooleanField(default=False, verbose_name='Обновлять существующие товары')),
+                ('checkpoint', models.PositiveIntegerField(default=0, verbose_name='Загружено строк')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='Всего строк')),
+                ('created_count', models.PositiveIntegerField(default=0, verbose_name='Создано товаров')),
+                ('changed_count', models.PositiveIntegerField(default=0, verbose_name='Изменено товаров')),
+                ('rows_per_second', models.FloatField(default=0.0, verbose_name='Строк в секунду')),
+                ('worker', models.CharField(blank=True, max_length=255, verbose_name='Обработчик')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Когда создано')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начало загрузки')),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True, verbose_name='Последняя активность')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Окончание загрузки')),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Кем создано')),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='import_jobs', to='catalog.DataFile', verbose_name='Файл')),
+            ],
+            options={
+                'verbose_name': 'Загрузка файла',
+                'verbose_name_plural': 'Загрузки файлов',
+                'ordering': ('-created_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-17 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0033_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attribute',
+            name='search_type',
+            field=models.CharField(choices=[('nearest', 'Ближайший'), ('min', 'Минимальный'), ('max', 'Максимальный'), ('closest_min', 'Ближайшее минимальное'), ('closest_max', 'Ближайшее максимальное')], default='nearest', max_length=11, verbose_name='Тип поиска значения'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.10 on 2026-10-17 19:40
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0034_attribute_search_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productanalog',
+            name='ranked',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list, verbose_name='Ранжированные аналоги'),
+        ),
+    ]
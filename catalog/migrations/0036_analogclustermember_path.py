@@ -0,0 +1,34 @@
+# Generated by Django 2.2.10 on 2026-10-17 21:10
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0035_productanalog_ranked'),
+    ]
+
+    operations = [
+        # clusters are a cache of search results, members linked without a path are dropped
+        migrations.RunSQL(
+            'DELETE FROM catalog_analogclustermember; DELETE FROM catalog_analogcluster;',
+            migrations.RunSQL.noop
+        ),
+        migrations.AddField(
+            model_name='analogclustermember',
+            name='path',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, size=None, verbose_name='Путь от корня группы'),
+        ),
+        migrations.AddField(
+            model_name='analogclustermember',
+            name='path_confidence',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), blank=True, default=list, size=None, verbose_name='Достоверность пути'),
+        ),
+        migrations.AddIndex(
+            model_name='analogclustermember',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['path'], name='catalog_cluster_path_gin'),
+        ),
+    ]
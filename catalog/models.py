@@ -4,18 +4,25 @@
 import logging
 import time
 import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import chain
 from itertools import groupby
-from typing import List, Mapping, Optional, Any
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres import fields as pgfields
-from django.db import models
-from django.db.models import F, Func, QuerySet
+from django.contrib.postgres.indexes import GinIndex
+from django.db import connection, models
+from django.db.models import Case, QuerySet, Value, When
+from django.utils import timezone
 
-from catalog.choices import HARD, PRICE, RECALCULATION, RELATION, SOFT, TYPES, TYPES_FILE, UNITS
+from catalog.choices import HARD, JOB_PENDING, MATRIX_ENGINE, PRICE, RANKED_ENGINE, RECALCULATION, RELATION, SOFT, \
+    SQL_ENGINE, STATUSES_JOB, TYPES, TYPES_FILE, TYPES_SEARCH, UNITS
+from catalog.articles import canonical_article
 from catalog.exceptions import AnalogNotFound
-from catalog.managers import CoreModelManager
+from catalog.managers import CoreModelManager, ProductAnalogQuerySet, ProductQuerySet
 
 logger = logging.getLogger("analog")
 
@@ -74,6 +81,7 @@ class Category(Base):
     title = models.CharField(max_length=255, verbose_name='Наименование')
     short_title = models.CharField(max_length=255, verbose_name='Краткое наименование', blank=True)
     attributes = models.ManyToManyField('Attribute', blank=True, verbose_name="Атрибуты")
+    version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0, editable=False)
 
     def getAttributes(self):
         if not self.childs:
@@ -109,6 +117,8 @@ class Attribute(Base):
     priority = models.PositiveSmallIntegerField(verbose_name='Приоритет')
     weight = models.PositiveSmallIntegerField(verbose_name='Вес', default=0)
     is_fixed = models.BooleanField(verbose_name='Fixed attribute?', default=False)
+    search_type = models.CharField(max_length=11, choices=TYPES_SEARCH, default='nearest',
+                                   verbose_name='Тип поиска значения')
     
     def __str__(self):
         return '{}({})'.format(self.title, self.type)
@@ -160,7 +170,7 @@ class AttributeValue(Base):
         verbose_name_plural = "Значения атрибутов"
 
 
-class ProductManager(models.Manager):
+class ProductManager(models.Manager.from_queryset(ProductQuerySet)):
     def autoselect(self, instance, type_=None):
         """
         :raises: :class:`AssertionError`: when instance is Parcel and type_
@@ -168,6 +178,25 @@ class ProductManager(models.Manager):
         """
         return None
 
+    def by_article(self, article: str, **filters) -> QuerySet:
+        """ Products with the same canonical article, the exact spelling first """
+        normalized = canonical_article(article)
+        # an article of separators only has no canonical form, it would match every such product
+        products = self.filter(normalized_article=normalized) if normalized else self.filter(article=article)
+        return products.filter(**filters).annotate(
+            is_exact=Case(When(article=article, then=Value(0)), default=Value(1), output_field=models.IntegerField())
+        ).order_by('is_exact', 'pk')
+
+    def get_by_article(self, article: str, **filters) -> "Product":
+        """ <get> by canonical article in one query, an exact spelling wins over look-alikes """
+        products = list(self.by_article(article, **filters))
+        products = [product for product in products if product.article == article] or products
+        if not products:
+            raise self.model.DoesNotExist('Product with article {} does not exist'.format(article))
+        if len(products) > 1:
+            raise self.model.MultipleObjectsReturned('{} products with article {}'.format(len(products), article))
+        return products[0]
+
 
 class Product(Base):
     """
@@ -177,6 +206,9 @@ class Product(Base):
     formalized_title = models.CharField(max_length=255, null=True, verbose_name='Формализованное наименование')
     
     article = models.CharField(max_length=255, verbose_name='Артикул')
+    normalized_article = models.CharField(max_length=255, verbose_name='Канонический артикул', default='',
+                                          db_index=True, editable=False)
+    attributes_version = models.PositiveIntegerField(verbose_name='Версия атрибутов', default=0, editable=False)
     additional_article = models.CharField(max_length=255, default="", blank=True, verbose_name='Доп. артикул')
     series = models.CharField(max_length=255, default="", blank=True, verbose_name='Серия')
     category = models.ForeignKey(Category, on_delete=models.PROTECT,
@@ -202,72 +234,169 @@ class Product(Base):
     irrelevant = models.BooleanField(verbose_name='Неактуал', default=False)  # position for only search from this
     
     objects = ProductManager()
+
+    # fields having an influence on analog search, see <catalog.signals.product_changed>
+    SEARCH_FIELDS = ('category', 'manufacturer', 'irrelevant', 'deleted')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._search_state = instance.search_state()
+        return instance
+
+    def search_state(self) -> tuple:
+        return tuple(self.__dict__.get(self._meta.get_field(field).attname) for field in self.SEARCH_FIELDS)
+
+    def search_changed(self) -> bool:
+        """ Search fields differ from the loaded ones, True for a product not loaded from the DB """
+        return getattr(self, '_search_state', None) != self.search_state()
+
+    @property
+    def loaded_category_id(self) -> Optional[int]:
+        state = getattr(self, '_search_state', None)
+        return state[0] if state is not None else None
+
+    def save(self, *args, **kwargs):
+        self.normalized_article = canonical_article(self.article)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'article' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'normalized_article'}
+        super().save(*args, **kwargs)
+        self._search_state = self.search_state()
     
-    def get_analog(self, manufacturer_to: Manufacturer) -> Optional["Product"]:
+    def get_analog(self, manufacturer_to: Manufacturer, profiler=None) -> Optional["Product"]:
+        from catalog.search import clusters, singleflight
+        from catalog.search.invalidation import category_version
+        from catalog.search.profiling import STORED, maybe_stage
+
         assert manufacturer_to is not None, 'Manufacturer is None'
-        logger.info(
-            f'call <get_analog({manufacturer_to.title})> for product: <{self.pk}>/<{self.article}>'
-        )
+        logger.debug('call <get_analog(%s)> for product: <%s>/<%s>', manufacturer_to.title, self.pk, self.article)
         
-        if self.manufacturer == manufacturer_to:
+        if self.manufacturer_id == manufacturer_to.pk:
             return self
         
-        analogs = self.analogs_to.filter(manufacturer=manufacturer_to)
-        if analogs.exists():
-            analog = analogs.first()
-            logger.info(f'analog is <{analog.pk}/{analog.article}>')
-            return analogs.first()
+        with maybe_stage(profiler, STORED):
+            stored = ProductAnalog.objects.current().filter(
+                product=self, manufacturer_to=manufacturer_to
+            ).select_related('analog').first()
+            if stored is not None:
+                analog = stored.analog
+                self.__dict__.setdefault('_loaded_analogs', {})[manufacturer_to.pk] = stored
+            else:
+                catalog_version = category_version(self.category_id)
+                analog = clusters.find_analog(self, manufacturer_to.pk)
+                if analog is not None:
+                    ProductAnalog.store(self.pk, manufacturer_to.pk, analog.pk, [], catalog_version)
+        if stored is not None or analog is not None:
+            logger.debug('analog is <%s>', analog.pk if analog is not None else None)
+            return analog
         
-        return self.search_analog(manufacturer_to)
+        return singleflight.do(
+            (self.pk, manufacturer_to.pk), lambda: self._search_analog_once(manufacturer_to, profiler=profiler)
+        )
+
+    def get_ranked(self, manufacturer_to: Manufacturer) -> List[Tuple["Product", float]]:
+        """ Stored top candidates of <RANKED_ENGINE> with their scores, best first """
+        # loaded or stored by <get_analog> just before
+        stored = self.__dict__.get('_loaded_analogs', {}).get(manufacturer_to.pk)
+        if stored is None:
+            stored = ProductAnalog.objects.current().filter(product=self, manufacturer_to=manufacturer_to).first()
+        if stored is None or not stored.ranked:
+            return []
+        found = Product.objects.in_bulk([pk for pk, _ in stored.ranked])
+        return [(found[pk], score) for pk, score in stored.ranked if pk in found]
+
+    def get_analogs(self, manufacturers) -> Dict[int, Optional["Product"]]:
+        """
+        {manufacturer_pk: analog} for several manufacturers in one batched pass: stored results and clusters
+        in one query each, the rest by one <AnalogSearch.build_many> call that stores them.
+        A failed search gives None for its manufacturer
+        """
+        from catalog.search import clusters
+        from catalog.search.invalidation import category_version
+
+        manufacturers = list(manufacturers)
+        result = {manufacturer.pk: self for manufacturer in manufacturers if manufacturer.pk == self.manufacturer_id}
+        loaded = self.__dict__.setdefault('_loaded_analogs', {})
+
+        for stored in ProductAnalog.objects.current().filter(
+            product=self, manufacturer_to__in=[m for m in manufacturers if m.pk not in result]
+        ).select_related('analog'):
+            result[stored.manufacturer_to_id] = stored.analog
+            loaded[stored.manufacturer_to_id] = stored
+        catalog_version = category_version(self.category_id)
+        linked = clusters.find_analogs(self, [m.pk for m in manufacturers if m.pk not in result])
+        for manufacturer_pk, analog in linked.items():
+            ProductAnalog.store(self.pk, manufacturer_pk, analog.pk, [], catalog_version)
+        result.update(linked)
+
+        missing = [manufacturer for manufacturer in manufacturers if manufacturer.pk not in result]
+        if not missing:
+            return result
+
+        # stored results were read above
+        analogs = AnalogSearch.build_many([self], missing, use_stored=False)
+        found = Product.objects.in_bulk([analog_pk for analog_pk, _ in analogs.values() if analog_pk is not None])
+        for manufacturer in missing:
+            analog_pk, second_dataset = analogs.get((self.pk, manufacturer.pk), (None, []))
+            analog = result[manufacturer.pk] = found.get(analog_pk)
+            if (self.pk, manufacturer.pk) in analogs:
+                # the row as stored, for the comparison payload
+                loaded[manufacturer.pk] = ProductAnalog(
+                    product=self, manufacturer_to=manufacturer, analog=analog, second_dataset=second_dataset,
+                    catalog_version=catalog_version
+                )
+            clusters.link(self, analog)
+        return result
+
+    def _search_analog_once(self, manufacturer_to: Manufacturer, profiler=None) -> Optional["Product"]:
+        """ Search under advisory lock: a worker waiting for the lock reuses the result stored by its holder """
+        from catalog.search import singleflight
 
-    def search_analog(self, manufacturer_to: Manufacturer) -> Optional["Product"]:
+        with singleflight.advisory_lock(self.pk, manufacturer_to.pk):
+            stored = ProductAnalog.objects.current().filter(
+                product=self, manufacturer_to=manufacturer_to
+            ).select_related('analog').first()
+            if stored is not None:
+                self.__dict__.setdefault('_loaded_analogs', {})[manufacturer_to.pk] = stored
+                return stored.analog
+            return self.search_analog(manufacturer_to, profiler=profiler)
+
+    def search_analog(self, manufacturer_to: Manufacturer, profiler=None) -> Optional["Product"]:
         """ Start <AnalogSearch> process """
-        logger.info(f'call <search_analog({manufacturer_to.title})> for product: <{self.pk}>/<{self.article}')
+        from catalog.search import clusters
+        from catalog.search.invalidation import category_version
+        from catalog.search.profiling import ALTERNATIVE, maybe_stage
+
+        logger.debug('call <search_analog(%s)> for product: <%s>/<%s>', manufacturer_to.title, self.pk, self.article)
         
-        search = AnalogSearch(product_from=self, manufacturer_to=manufacturer_to)
+        # read before the search: a result computed from data changed meanwhile is stored as stale
+        catalog_version = category_version(self.category_id)
+        search = AnalogSearch(product_from=self, manufacturer_to=manufacturer_to, profiler=profiler)
         try:
             result = search.build()
         except AnalogNotFound:
-            alternative_categories = AlternativeCategory.objects.filter(original=self.category)
-            if not alternative_categories.exists():
-                return None
-            
-            # if result.product is None and not alternative_categories.exists():
-            #     return None
-            
-            # if result.product is None:
-            result = None
-            for alt_category in alternative_categories:
-                search = AnalogSearch(product_from=self, manufacturer_to=manufacturer_to)
-                try:
-                    result = search.build(category=alt_category.alternative)
-                except AnalogNotFound:
-                    continue
+            with maybe_stage(profiler, ALTERNATIVE):
+                result = search.build_alternatives()
 
         except Exception as e:
             logger.debug(f'<{e}>\n{traceback.format_exc()}')
             return None
 
-        if result is None:
-            return None
-
-        old_analogs = self.analogs_to.filter(manufacturer=manufacturer_to)
-        if old_analogs.exists():
-            self.analogs_to.remove(old_analogs.values('pk'))
-
-        self.analogs_to.add(result.product)
-    
-        raw = self.raw or {}
-        raw__analogs: dict = raw.get("analogs", {})
-        raw__analogs[manufacturer_to.pk] = {
-            "analog_seconds": list(result.second_dataset),
-            "analog": result.product.pk
-        }
-        raw["analogs"] = raw__analogs
-        self.raw = raw
-        self.save()
+        analog = result.product if result is not None else None
+        stored = ProductAnalog(
+            product=self, manufacturer_to=manufacturer_to, analog=analog,
+            second_dataset=list(result.second_dataset) if result is not None else [], catalog_version=catalog_version,
+            ranked=[[pk, score] for pk, score in result.ranked] if result is not None else []
+        )
+        ProductAnalog.store(
+            self.pk, manufacturer_to.pk, stored.analog_id, stored.second_dataset, catalog_version, stored.ranked
+        )
+        # the row as stored, for <get_ranked> and the comparison payload
+        self.__dict__.setdefault('_loaded_analogs', {})[manufacturer_to.pk] = stored
+        clusters.link(self, analog)
     
-        return result.product
+        return analog
 
     def get_info(self) -> list:
         return list(self.attributevalue_set.all())
@@ -372,18 +501,66 @@ class DataFile(Base):
         super(DataFile, self).save(*args, **kwargs)
 
 
+class ImportJob(models.Model):
+    """
+    Модель фоновой загрузки файла в БД
+    """
+    file = models.ForeignKey(DataFile, on_delete=models.CASCADE, verbose_name="Файл", related_name="import_jobs")
+    status = models.CharField(max_length=7, choices=STATUSES_JOB, default=JOB_PENDING, db_index=True,
+                              verbose_name="Статус")
+    upsert = models.BooleanField(verbose_name="Обновлять существующие товары", default=False)
+    checkpoint = models.PositiveIntegerField(verbose_name="Загружено строк", default=0)
+    total = models.PositiveIntegerField(verbose_name="Всего строк", null=True, blank=True)
+    created_count = models.PositiveIntegerField(verbose_name="Создано товаров", default=0)
+    changed_count = models.PositiveIntegerField(verbose_name="Изменено товаров", default=0)
+    rows_per_second = models.FloatField(verbose_name="Строк в секунду", default=0.)
+    worker = models.CharField(max_length=255, verbose_name="Обработчик", blank=True)
+    error = models.TextField(verbose_name="Ошибка", blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Когда создано")
+    created_by = models.ForeignKey(User, on_delete=models.PROTECT, verbose_name="Кем создано", related_name="+")
+    started_at = models.DateTimeField(verbose_name="Начало загрузки", null=True, blank=True)
+    heartbeat_at = models.DateTimeField(verbose_name="Последняя активность", null=True, blank=True)
+    finished_at = models.DateTimeField(verbose_name="Окончание загрузки", null=True, blank=True)
+
+    def __str__(self):
+        return '{}: {}'.format(self.file, self.get_status_display())
+
+    @property
+    def progress(self) -> Optional[float]:
+        if not self.total:
+            return None
+        return min(100., round(100. * self.checkpoint / self.total, 1))
+
+    class Meta:
+        ordering = ('-created_at', )
+        verbose_name = "Загрузка файла"
+        verbose_name_plural = "Загрузки файлов"
+
+
 class AnalogSearch(object):
-    def __init__(self, product_from: Optional[Product], manufacturer_to: Optional[Manufacturer]):
+    def __init__(self, product_from: Optional[Product], manufacturer_to: Optional[Manufacturer], engine: str = None,
+                 explain: bool = None, search_modes: Mapping[int, str] = None, use_bitmaps: bool = None,
+                 profiler=None):
         
         # self.start_time = None
+        self.engine = engine or getattr(settings, 'ANALOG_SEARCH_ENGINE', SQL_ENGINE)
         self.left_time = None
         self.initial_product = product_from
         self.initial_product_info = {}
         self.null_attributes = {}
         self.manufacturer_to = manufacturer_to
+        self.explain = explain if explain is not None else getattr(settings, 'ANALOG_SEARCH_EXPLAIN', False)
+        self.explain_plans = []
+        self.use_bitmaps = use_bitmaps if use_bitmaps is not None else \
+            getattr(settings, 'ANALOG_BITMAP_HARD_FILTER', False)
+        self.search_modes = search_modes or {}  # attribute pk -> <choices.TYPES_SEARCH>, over <Attribute.search_type>
+        self.profiler = profiler  # <catalog.search.profiling.SearchProfiler> or None
+        self.category_pk = None
+        self.version = None  # of the searched category, caches are stamped with it
         self.product = None
         self.first_step_products = None
         self.second_dataset = None
+        self.ranked = []  # [(product pk, score), ...] of <RANKED_ENGINE>
         
         # raise product_from is None or manufacturer_to is None
         
@@ -398,6 +575,8 @@ class AnalogSearch(object):
         )
 
     def get_full_info_from_initial_product(self) -> List[Mapping[str, List[Optional[AttributeValue]]]]:
+        from catalog.search.schema import get_schema
+
         # attributes = Category.objects.get(pk=self.initial_product.category.pk).attributes.values(
         #     'value',
         #     'un_value',
@@ -416,64 +595,88 @@ class AnalogSearch(object):
             'attribute__type',
             'attribute__title',
             'attribute__is_fixed'
-        ).order_by('-attribute__is_fixed')  # Attr is fixed: True, True, ..., False, False
+        ).order_by('-attribute__is_fixed', 'attribute', 'pk')  # Attr is fixed: True, True, ..., False, False
+        attributes = list(attributes)
         
-        null_attributes = Category.objects.get(
-            pk=self.initial_product.category.pk
-        ).attributes.exclude(
-            pk__in=self.initial_product.attributevalue_set.values_list('attribute__pk', flat=True)
+        null_attributes = get_schema(self.initial_product.category_id).missing(
+            attribute['attribute'] for attribute in attributes
         )
 
-        info = {HARD: [], SOFT: [], RELATION: [], RECALCULATION: [], PRICE: []}
-        for attribute in attributes:
-            info[attribute["attribute__type"]].append(attribute)
-        
-        null_info = {HARD: [], SOFT: [], RELATION: [], RECALCULATION: [], PRICE: []}
-        for null_attribute in null_attributes:
-            null_info[null_attribute.type].append(null_attribute)
-        
-        return [info, null_info]
+        return self.group_by_type(attributes, null_attributes)
 
-    def filter_by_hard_attributes(self, dataset_pk) -> QuerySet:
-        middleware_pk_products = dataset_pk
+    @staticmethod
+    def _attribute_condition(alias: str, attribute_pk: int, column: str, value=None, not_null=False):
+        condition = f'({alias}.attribute_id = %s AND {alias}.{column} '
+        if not_null:
+            return condition + 'IS NOT NULL)', [attribute_pk]
+        if value is None:
+            return condition + 'IS NULL)', [attribute_pk]
+        return condition + '= %s)', [attribute_pk, value]
+
+    def compile_hard_filter(self, dataset_pk) -> Tuple[str, list]:
+        """
+        HARD step as one statement: GROUP BY product HAVING count = n over matched values
+        and an anti-join (NOT EXISTS) for attributes missing at the initial product
+        """
+        table = AttributeValue._meta.db_table
+        dataset_sql, params = dataset_pk.query.sql_with_params()
+        params = list(params)
 
+        hard_conditions = []
         for attribute in self.initial_product_info[HARD]:
-            filter_args = dict(
-                product__pk__in=middleware_pk_products,
-                attribute=attribute['attribute']
-            )
-    
             if attribute["attribute__is_fixed"]:
-                filter_args["value"] = attribute["value"]
+                condition, condition_params = self._attribute_condition('av', attribute['attribute'], 'value_id',
+                                                                        value=attribute["value"])
             else:
-                filter_args["un_value"] = attribute["un_value"]
-            
-            middleware_pk_products = AttributeValue.objects.select_related(
-                    'attribute', 'product', 'value'
-                ).filter(
-                **filter_args
-                ).distinct('product__pk').values_list('product__pk', flat=True)
+                condition, condition_params = self._attribute_condition('av', attribute['attribute'], 'un_value',
+                                                                        value=attribute["un_value"])
+            hard_conditions.append(condition)
+            params += condition_params
 
+        null_conditions, null_params = [], []
         for null_attribute in self.null_attributes[HARD]:
-            null_filter_args = dict(
-                attributevalue__attribute=null_attribute
+            condition, condition_params = self._attribute_condition(
+                'nv', null_attribute.pk, 'value_id' if null_attribute.is_fixed else 'un_value', not_null=True
             )
-            if null_attribute.is_fixed:
-                null_filter_args["attributevalue__value__isnull"] = False
-            else:
-                null_filter_args["attributevalue__un_value__isnull"] = False
-                
-            middleware_pk_products = Product.objects.filter(
-                pk__in=middleware_pk_products
-            ).exclude(
-                pk__in=Product.objects.filter(
-                    **null_filter_args
-                )).values_list('pk', flat=True)
-            
-        return middleware_pk_products
+            null_conditions.append(condition)
+            null_params += condition_params
+
+        def anti_join(product_column):
+            if not null_conditions:
+                return ''
+            return f' AND NOT EXISTS (SELECT 1 FROM {table} nv WHERE nv.product_id = {product_column}' \
+                   f' AND nv.deleted = false AND ({" OR ".join(null_conditions)}))'
+
+        if not hard_conditions:
+            sql = f'SELECT p.id FROM {Product._meta.db_table} p WHERE p.id IN ({dataset_sql}){anti_join("p.id")}'
+            return sql, params + null_params
+
+        sql = f'SELECT av.product_id FROM {table} av ' \
+              f'WHERE av.deleted = false AND av.product_id IN ({dataset_sql}) ' \
+              f'AND ({" OR ".join(hard_conditions)}){anti_join("av.product_id")} ' \
+              f'GROUP BY av.product_id HAVING COUNT(DISTINCT av.attribute_id) = %s'
+        hard_count = len({attribute['attribute'] for attribute in self.initial_product_info[HARD]})
+        return sql, params + null_params + [hard_count]
+
+    def filter_by_hard_attributes(self, dataset_pk: QuerySet) -> List[int]:
+        sql, params = self.compile_hard_filter(dataset_pk)
+
+        with connection.cursor() as cursor:
+            if self.explain:
+                cursor.execute(f'EXPLAIN ANALYZE {sql}', params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                self.explain_plans.append(plan)
+                logger.debug(f'HARD step plan for product <{self.initial_product.pk}>:\n{plan}')
+
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def filter_by_any_attributes(self, dataset_pk, attribute_type=SOFT) -> QuerySet:
+        from catalog.search.index import NEAREST, get_index
+        from catalog.search.schema import get_schema
 
-    def filter_by_any_attributes(self, dataset_pk: QuerySet, attribute_type=SOFT) -> QuerySet:
         middleware_pk_products = dataset_pk
+        search_types = get_schema(self.initial_product.category_id).search_types(self.search_modes)
     
         for attribute in self.initial_product_info[attribute_type]:
             if attribute["attribute__is_fixed"]:
@@ -489,48 +692,69 @@ class AnalogSearch(object):
                     middleware_pk_products = products_pk
         
             else:
-                middleware_attributes = AttributeValue.objects.select_related(
-                    'attribute', 'product'
-                ).filter(
-                    product__pk__in=middleware_pk_products,
-                    attribute=attribute['attribute'],
-                ).annotate(
-                    abs_diff=Func(F('un_value') - attribute["un_value"], function='ABS')
-                ).order_by('abs_diff')  # .distinct('product')  # .values_list('product__pk', flat=True)
-            
-                if middleware_attributes.exists():
-                    closest_attribute = middleware_attributes.first()
-                
-                    middleware_pk_products = AttributeValue.objects.select_related(
-                        'attribute', 'product', 'value'
-                    ).filter(
-                        product__pk__in=middleware_pk_products,
-                        attribute=attribute['attribute'],
-                        un_value=closest_attribute.un_value,
-                    ).distinct('product__pk').values_list('product__pk', flat=True)
+                # bisect over the values of the candidates instead of ORDER BY ABS(un_value - x)
+                narrowed = get_index(self.category_pk, attribute['attribute'], self.version).narrow(
+                    attribute["un_value"], middleware_pk_products, search_types.get(attribute['attribute'], NEAREST)
+                )
+                if narrowed is not None:
+                    middleware_pk_products = narrowed
             
         return middleware_pk_products
 
     def build(self, category=None) -> "AnalogSearch":
+        from catalog.search import profiling
+        from catalog.search.bitmap import get_bitmaps
+        from catalog.search.invalidation import category_version
+        from catalog.search.profiling import maybe_stage
+
         start_time = time.time()
         # logger.
-        self.initial_product_info, self.null_attributes = self.get_full_info_from_initial_product()
-        
-        # first step
-        first_dataset: QuerySet = self.filter_by_category_and_manufacturer(category)
+        self.category_pk = self.initial_product.category_id if category is None else category.pk
+        self.version = category_version(self.category_pk)
+        if self.profiler is not None and self.profiler.category_pk is None:
+            self.profiler.category_pk = self.category_pk
+
+        if self.engine == MATRIX_ENGINE:
+            return self.build_in_memory(category)
+        if self.engine == RANKED_ENGINE:
+            return self.build_ranked(category)
+
+        if not self.initial_product_info:
+            with maybe_stage(self.profiler, profiling.SCHEMA):
+                self.initial_product_info, self.null_attributes = self.get_full_info_from_initial_product()
         
-        # second step
-        second_dataset: QuerySet = self.filter_by_hard_attributes(first_dataset)
+        if self.use_bitmaps:
+            # first and second steps as bitwise ANDs
+            with maybe_stage(self.profiler, profiling.HARD) as stage:
+                second_dataset: List[int] = get_bitmaps(self.category_pk, self.version).filter_by_hard_attributes(
+                    self.manufacturer_to.pk, self.initial_product_info[HARD], self.null_attributes[HARD]
+                )
+                stage.candidates = len(second_dataset)
+        else:
+            # first step
+            with maybe_stage(self.profiler, profiling.CATEGORY):
+                first_dataset: QuerySet = self.filter_by_category_and_manufacturer(category)
 
-        if second_dataset.count() == 0:
+            # second step
+            with maybe_stage(self.profiler, profiling.HARD) as stage:
+                second_dataset: List[int] = self.filter_by_hard_attributes(first_dataset)
+                stage.candidates = len(second_dataset)
+
+        if not second_dataset:
             raise AnalogNotFound('Not founded')  # after hard check
         
-        self.second_dataset = list(second_dataset)
+        self.second_dataset = second_dataset
         # third step
-        third_dataset: QuerySet = self.filter_by_any_attributes(second_dataset, attribute_type=SOFT)
+        with maybe_stage(self.profiler, profiling.SOFT) as stage:
+            third_dataset: QuerySet = self.filter_by_any_attributes(second_dataset, attribute_type=SOFT)
+            if self.profiler is not None:  # may be a lazy queryset
+                stage.candidates = len(third_dataset)
         
         # fourth step
-        fourth_dataset: QuerySet = self.filter_by_any_attributes(third_dataset, attribute_type=RECALCULATION)
+        with maybe_stage(self.profiler, profiling.RCL) as stage:
+            fourth_dataset: QuerySet = self.filter_by_any_attributes(third_dataset, attribute_type=RECALCULATION)
+            if self.profiler is not None:  # may be a lazy queryset
+                stage.candidates = len(fourth_dataset)
         
         products = Product.objects.filter(pk__in=fourth_dataset)
 
@@ -539,6 +763,283 @@ class AnalogSearch(object):
         self.left_time = time.time() - start_time
         return self
 
+    def build_in_memory(self, category=None) -> "AnalogSearch":
+        """ Same HARD, SOFT and RCL pipeline over <CategoryMatrix> instead of chained queries """
+        from catalog.search import profiling
+        from catalog.search.matrix import get_matrix
+        from catalog.search.profiling import maybe_stage
+        from catalog.search.schema import get_schema
+
+        start_time = time.time()
+        with maybe_stage(self.profiler, profiling.SCHEMA):
+            if not self.initial_product_info:
+                self.initial_product_info, self.null_attributes = self.get_full_info_from_initial_product()
+            search_types = get_schema(self.initial_product.category_id).search_types(self.search_modes)
+            matrix = get_matrix(self.initial_product.category_id if category is None else category.pk)
+
+        analog_pk, self.second_dataset = matrix.search(
+            self.manufacturer_to.pk, self.initial_product_info, self.null_attributes, search_types, self.profiler
+        )
+
+        if not self.second_dataset:
+            raise AnalogNotFound('Not founded')  # after hard check
+
+        self.product = Product.objects.filter(pk=analog_pk).first()
+        self.first_step_products = self.second_dataset
+        self.left_time = time.time() - start_time
+        return self
+
+    def build_ranked(self, category=None, limit: int = None) -> "AnalogSearch":
+        """ Score every candidate after the HARD step by weighted SOFT and RCL distance, keep top K in <ranked> """
+        from catalog.search import profiling
+        from catalog.search.matrix import get_matrix
+        from catalog.search.profiling import maybe_stage
+        from catalog.search.schema import get_schema
+
+        start_time = time.time()
+        with maybe_stage(self.profiler, profiling.SCHEMA):
+            if not self.initial_product_info:
+                self.initial_product_info, self.null_attributes = self.get_full_info_from_initial_product()
+            schema_attributes = get_schema(self.initial_product.category_id).attributes
+            matrix = get_matrix(self.initial_product.category_id if category is None else category.pk)
+
+        with maybe_stage(self.profiler, profiling.HARD) as stage:
+            mask = matrix.hard_mask(self.manufacturer_to.pk, self.initial_product_info, self.null_attributes)
+            stage.candidates = int(mask.sum())
+
+        if not mask.any():
+            raise AnalogNotFound('Not founded')  # after hard check
+
+        self.second_dataset = matrix.pks(mask)
+        with maybe_stage(self.profiler, profiling.RANK) as stage:
+            self.ranked = matrix.rank(
+                mask,
+                self.initial_product_info[SOFT] + self.initial_product_info[RECALCULATION],
+                schema_attributes,
+                limit or getattr(settings, 'ANALOG_RANKING_TOP_K', 5)
+            )
+            stage.candidates = len(self.ranked)
+
+        self.product = Product.objects.filter(pk=self.ranked[0][0]).first()
+        self.first_step_products = self.second_dataset
+        self.left_time = time.time() - start_time
+        return self
+
+    @staticmethod
+    def group_by_type(attributes, null_attributes) -> List[Mapping[str, list]]:
+        info = {HARD: [], SOFT: [], RELATION: [], RECALCULATION: [], PRICE: []}
+        for attribute in attributes:
+            info[attribute["attribute__type"]].append(attribute)
+
+        null_info = {HARD: [], SOFT: [], RELATION: [], RECALCULATION: [], PRICE: []}
+        for null_attribute in null_attributes:
+            null_info[null_attribute.type].append(null_attribute)
+
+        return [info, null_info]
+
+    def _build_alternative(self, alternative: "AlternativeCategory", pooled: bool,
+                           parent_stage=None) -> Optional["AnalogSearch"]:
+        search = AnalogSearch(
+            product_from=self.initial_product, manufacturer_to=self.manufacturer_to, engine=self.engine,
+            explain=self.explain, search_modes=self.search_modes, use_bitmaps=self.use_bitmaps,
+            profiler=self.profiler
+        )
+        # attributes of the initial product do not depend on the category, they are loaded once
+        search.initial_product_info, search.null_attributes = self.initial_product_info, self.null_attributes
+        try:
+            if pooled and self.profiler is not None:
+                # stages of the worker thread are nested into the stage of the caller
+                with self.profiler.attach(parent_stage):
+                    return search.build(category=alternative.alternative)
+            return search.build(category=alternative.alternative)
+        except AnalogNotFound:
+            return None
+        finally:
+            if pooled:
+                connection.close()  # worker threads hold their own connections
+
+    def build_alternatives(self) -> Optional["AnalogSearch"]:
+        """
+        Search in alternative categories of the initial product on a bounded thread pool.
+        The hit of the highest priority alternative wins; pending alternatives are cancelled
+        as soon as every alternative ranked above the hit is known to miss. A failed alternative
+        counts as a miss, running searches are waited for so that no worker outlives the call
+        """
+        alternatives = list(
+            AlternativeCategory.objects.filter(
+                original=self.initial_product.category_id
+            ).select_related('alternative').order_by('-priority', 'pk')
+        )
+        workers = min(getattr(settings, 'ANALOG_ALTERNATIVE_WORKERS', 4), len(alternatives))
+        if workers <= 1:
+            for alternative in alternatives:
+                result = self._build_alternative(alternative, pooled=False)
+                if result is not None:
+                    return result
+            return None
+
+        pending = object()
+        results = [pending] * len(alternatives)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        parent_stage = self.profiler.current if self.profiler is not None else None
+        futures = {
+            executor.submit(self._build_alternative, alternative, True, parent_stage): idx
+            for idx, alternative in enumerate(alternatives)
+        }
+        try:
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    logger.debug(f'<{e}>\n{traceback.format_exc()}')
+                    results[futures[future]] = None
+                for result in results:
+                    if result is pending:
+                        break
+                    if result is not None:
+                        return result
+            return None
+        finally:
+            for future in futures:
+                future.cancel()
+            # searches already running finish and close their connections
+            executor.shutdown(wait=True)
+
+    @classmethod
+    def _build_pair(cls, product: Product, manufacturer: Manufacturer, engine: str, info: Mapping,
+                    null_info: Mapping, profiler=None) -> Tuple[Optional[int], List[int], List[Tuple[int, float]]]:
+        """ Single search with preloaded source attributes, as <Product.search_analog> runs it """
+        from catalog.search import profiling
+        from catalog.search.profiling import maybe_stage
+
+        search = cls(product_from=product, manufacturer_to=manufacturer, engine=engine, profiler=profiler)
+        search.initial_product_info, search.null_attributes = info, null_info
+        try:
+            result = search.build()
+        except AnalogNotFound:
+            with maybe_stage(profiler, profiling.ALTERNATIVE):
+                result = search.build_alternatives()
+
+        if result is None:
+            return None, [], []
+        return result.product.pk if result.product is not None else None, list(result.second_dataset), result.ranked
+
+    @classmethod
+    def build_many(cls, products, manufacturers, engine: str = None, errors: Dict = None, profiler=None,
+                   use_stored: bool = True) -> Dict[Tuple[int, int], Tuple[Optional[int], List[int]]]:
+        """
+        Batch analog resolution: products x manufacturers -> {(product_pk, manufacturer_pk): (analog_pk, second_dataset)}
+        Current stored results are served, computed ones are stored with <ProductAnalog.store_many>.
+        Category schema and source attributes are loaded once, candidate matrices once per category: a batch runs
+        on <MATRIX_ENGINE> instead of the default <SQL_ENGINE>, they find the same analogs; other engines run
+        the single search per pair. A failed pair is left out, its exception goes to ``errors``
+        """
+        from catalog.search import profiling
+        from catalog.search.matrix import get_matrix
+        from catalog.search.profiling import maybe_stage
+        from catalog.search.schema import get_schema
+
+        start_time = time.time()
+        if engine is None:
+            engine = getattr(settings, 'ANALOG_SEARCH_ENGINE', SQL_ENGINE)
+            if engine == SQL_ENGINE:
+                engine = MATRIX_ENGINE
+        products = list(products)
+        manufacturers = list(manufacturers)
+        category_pks = {product.category_id for product in products}
+
+        result = {}
+        if use_stored:
+            with maybe_stage(profiler, profiling.STORED):
+                for product_pk, manufacturer_pk, analog_pk, second_dataset in ProductAnalog.objects.current().filter(
+                    product__in=[product.pk for product in products],
+                    manufacturer_to__in=[manufacturer.pk for manufacturer in manufacturers]
+                ).values_list('product', 'manufacturer_to', 'analog', 'second_dataset'):
+                    result[(product_pk, manufacturer_pk)] = (analog_pk, second_dataset)
+
+        with maybe_stage(profiler, profiling.SCHEMA):
+            # read before the search: a result computed from data changed meanwhile is stored as stale
+            versions = dict(Category.objects.filter(pk__in=category_pks).values_list('pk', 'version'))
+
+            alternatives = defaultdict(list)
+            for original_pk, alternative_pk in AlternativeCategory.objects.filter(
+                original_id__in=category_pks
+            ).order_by('-priority', 'pk').values_list('original_id', 'alternative_id'):
+                alternatives[original_pk].append(alternative_pk)
+
+            product_attributes = defaultdict(list)
+            for attribute in AttributeValue.objects.filter(
+                product__in=[product.pk for product in products]
+            ).values(
+                'product',
+                'value',
+                'un_value',
+                'attribute',
+                'attribute__type',
+                'attribute__title',
+                'attribute__is_fixed'
+            ).order_by('-attribute__is_fixed', 'attribute', 'pk'):
+                product_attributes[attribute['product']].append(attribute)
+
+        computed = []
+        for category_pk, group in groupby(sorted(products, key=lambda p: p.category_id), lambda p: p.category_id):
+            with maybe_stage(profiler, profiling.SCHEMA):
+                schema = get_schema(category_pk)
+                matrix = get_matrix(category_pk) if engine == MATRIX_ENGINE else None
+                search_types = schema.search_types()
+            for product in group:
+                attributes = product_attributes[product.pk]
+                info, null_info = cls.group_by_type(
+                    attributes, schema.missing(attribute['attribute'] for attribute in attributes)
+                )
+
+                for manufacturer in manufacturers:
+                    key = (product.pk, manufacturer.pk)
+                    if product.manufacturer_id == manufacturer.pk:
+                        result[key] = (product.pk, [])
+                        continue
+                    if key in result:
+                        continue
+
+                    try:
+                        ranked = []
+                        if matrix is None:
+                            analog_pk, second_dataset, ranked = cls._build_pair(
+                                product, manufacturer, engine, info, null_info, profiler
+                            )
+                        else:
+                            analog_pk, second_dataset = matrix.search(
+                                manufacturer.pk, info, null_info, search_types, profiler
+                            )
+                            if not second_dataset:
+                                with maybe_stage(profiler, profiling.ALTERNATIVE):
+                                    for alternative_pk in alternatives.get(category_pk, []):
+                                        analog_pk, second_dataset = get_matrix(alternative_pk).search(
+                                            manufacturer.pk, info, null_info, search_types, profiler
+                                        )
+                                        if second_dataset:
+                                            break
+                    except Exception as e:
+                        logger.debug(f'<{e}>\n{traceback.format_exc()}')
+                        if errors is not None:
+                            errors[key] = e
+                        continue
+
+                    result[key] = (analog_pk, second_dataset)
+                    computed.append(ProductAnalog(
+                        product_id=product.pk, manufacturer_to_id=manufacturer.pk, analog_id=analog_pk,
+                        second_dataset=second_dataset, catalog_version=versions.get(category_pk, 0),
+                        ranked=[[pk, score] for pk, score in ranked]
+                    ))
+
+        if computed:
+            with maybe_stage(profiler, profiling.STORED):
+                ProductAnalog.store_many(computed)
+
+        logger.debug(f'build_many: {len(products)} products x {len(manufacturers)} manufacturers, '
+                     f'{len(computed)} searched, time left: {time.time() - start_time}s')
+        return result
+
 
 class AlternativeCategory(Base):
     """
@@ -548,7 +1049,113 @@ class AlternativeCategory(Base):
                                  related_name="original_category")
     alternative = models.ForeignKey(Category, on_delete=models.PROTECT, verbose_name="Альтернативный класс",
                                     related_name="alternative_category")
+    priority = models.PositiveSmallIntegerField(verbose_name='Приоритет', default=0)
 
     class Meta:
         verbose_name = "Альтернативная модель классов"
         verbose_name_plural = "Альтернативная модель классов"
+
+
+class ProductAnalog(models.Model):
+    """
+    Модель предрассчитанного аналога товара у производителя
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name="Исходный товар",
+                                related_name="precomputed_analogs")
+    manufacturer_to = models.ForeignKey(Manufacturer, on_delete=models.CASCADE, verbose_name="Производитель",
+                                        related_name="+")
+    analog = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name="Аналог", related_name="+",
+                               null=True, blank=True)
+    second_dataset = pgfields.ArrayField(models.IntegerField(), default=list, blank=True,
+                                         verbose_name="Товары после жесткой проверки")
+    catalog_version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0)
+    ranked = pgfields.JSONField(default=list, blank=True, verbose_name="Ранжированные аналоги")  # [[pk, score], ...]
+    comparison = pgfields.JSONField(null=True, blank=True, verbose_name="Таблица сравнения")
+    comparison_key = models.CharField(max_length=255, default='', blank=True, verbose_name="Версии товаров сравнения")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Когда обновлено")
+
+    objects = ProductAnalogQuerySet.as_manager()
+
+    def __str__(self):
+        return '{} -> {}: {}'.format(self.product_id, self.manufacturer_to_id, self.analog_id)
+
+    @classmethod
+    def store(cls, product_pk: int, manufacturer_pk: int, analog_pk: Optional[int], second_dataset: List[int],
+              catalog_version: int, ranked: List[Tuple[int, float]] = ()):
+        """ Save a search result unless a result of a newer catalog version is already stored """
+        ranked = [[pk, score] for pk, score in ranked]
+        updated = cls.objects.filter(
+            product_id=product_pk, manufacturer_to_id=manufacturer_pk, catalog_version__lte=catalog_version
+        ).update(analog_id=analog_pk, second_dataset=second_dataset, catalog_version=catalog_version,
+                 ranked=ranked, comparison=None, comparison_key='', updated_at=timezone.now())
+        if not updated:
+            cls.objects.bulk_create([cls(
+                product_id=product_pk, manufacturer_to_id=manufacturer_pk, analog_id=analog_pk,
+                second_dataset=second_dataset, catalog_version=catalog_version, ranked=ranked
+            )], ignore_conflicts=True)
+
+    @classmethod
+    def store_many(cls, rows: List["ProductAnalog"]) -> int:
+        """
+        <store> for a batch of results: rows of an older catalog version are replaced, a row stored meanwhile
+        by a single search is kept. Returns the number of rows given
+        """
+        by_version = defaultdict(list)
+        for row in rows:
+            by_version[row.catalog_version].append(row)
+        for catalog_version, group in by_version.items():
+            cls.objects.filter(
+                product_id__in={row.product_id for row in group},
+                manufacturer_to_id__in={row.manufacturer_to_id for row in group},
+                catalog_version__lt=catalog_version
+            ).delete()
+        cls.objects.bulk_create(rows, ignore_conflicts=True)
+        return len(rows)
+
+    class Meta:
+        unique_together = ('product', 'manufacturer_to')
+        verbose_name = "Предрассчитанный аналог"
+        verbose_name_plural = "Предрассчитанные аналоги"
+
+
+class AnalogCluster(models.Model):
+    """
+    Модель класса эквивалентности аналогов разных производителей
+    """
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Когда создано")
+
+    def __str__(self):
+        return 'cluster {}'.format(self.pk)
+
+    class Meta:
+        verbose_name = "Группа аналогов"
+        verbose_name_plural = "Группы аналогов"
+
+
+class AnalogClusterMember(models.Model):
+    """
+    Модель товара в группе аналогов
+    """
+    cluster = models.ForeignKey(AnalogCluster, on_delete=models.CASCADE, verbose_name="Группа",
+                                related_name="members")
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, verbose_name="Товар",
+                                   related_name="analog_cluster")
+    manufacturer = models.ForeignKey(Manufacturer, on_delete=models.CASCADE, verbose_name="Производитель",
+                                     related_name="+")
+    confidence = models.FloatField(verbose_name="Достоверность", default=1.)  # of the path from the cluster root
+    linked_from = models.ForeignKey(Product, on_delete=models.SET_NULL, verbose_name="Связан через",
+                                    related_name="+", null=True, blank=True)
+    # products from the cluster root to this one and confidences of their paths from the root
+    path = pgfields.ArrayField(models.IntegerField(), default=list, blank=True, verbose_name="Путь от корня группы")
+    path_confidence = pgfields.ArrayField(models.FloatField(), default=list, blank=True,
+                                          verbose_name="Достоверность пути")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Когда обновлено")
+
+    def __str__(self):
+        return '{} in {}: {}'.format(self.product_id, self.cluster_id, self.confidence)
+
+    class Meta:
+        index_together = ('cluster', 'manufacturer')
+        indexes = [GinIndex(fields=['path'], name='catalog_cluster_path_gin')]
+        verbose_name = "Товар группы аналогов"
+        verbose_name_plural = "Товары групп аналогов"
@@ -169,25 +169,32 @@ class HealthCheckGenerator(object):
         yield data
         
     def get_data(self, manufacturer):
-        manufactures_to = Manufacturer.objects.exclude(pk=manufacturer.pk).filter(is_tried=True)
+        manufactures_to = list(Manufacturer.objects.exclude(pk=manufacturer.pk).filter(is_tried=True))
         
         pr_counts = Product.objects.filter(manufacturer=manufacturer).count()
         limit = int(pr_counts/4)
-        for initial_product in Product.objects.filter(manufacturer=manufacturer)[limit*2:3*limit]:
-            for manufacturer_to in manufactures_to:
-                
-                analog = initial_product.get_analog(manufacturer_to)
-                
-                # if analog is None:
-                #     continue
+        initial_products = list(
+            Product.objects.filter(manufacturer=manufacturer).select_related('category', 'manufacturer')[limit*2:3*limit]
+        )
+        analogs = AnalogSearch.build_many(initial_products, manufactures_to)
+
+        found_pks = set()
+        for analog_pk, second_dataset in analogs.values():
+            found_pks.add(analog_pk)
+            found_pks.update(second_dataset)
+        found = Product.objects.select_related('category', 'manufacturer').in_bulk(
+            [pk for pk in found_pks if pk is not None]
+        )
 
-                queryset__pk = initial_product.raw.get("analogs", {}).get(manufacturer_to.pk, {}) if initial_product.raw is not None else {}
+        for initial_product in initial_products:
+            for manufacturer_to in manufactures_to:
+                analog_pk, second_dataset = analogs.get((initial_product.pk, manufacturer_to.pk), (None, []))
                 yield {
                     'initial_product': initial_product,
                     'analogs': {
-                        'analog': analog,
+                        'analog': found.get(analog_pk),
                         'manufacturer_to': manufacturer_to,
-                        'queryset': Product.objects.filter(pk__in=queryset__pk.get("analog_seconds")) if queryset__pk.get("analog_seconds") is not None else []
+                        'queryset': [found[pk] for pk in second_dataset if pk in found]
                     }
                 }
     
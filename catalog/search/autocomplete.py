@@ -0,0 +1,134 @@
+"""
+Индекс артикулов для автодополнения в поиске
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from itertools import chain, islice
+from typing import Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from catalog.articles import canonical_article as normalize
+
+logger = logging.getLogger("analog")
+
+
+class ArticleIndex(object):
+    """
+    Normalized articles for bisect prefix search with an LRU cache of results per prefix.
+    Articles are split into tiers by rank (higher priority, then checked products), each tier is sorted
+    by article, so the best matches of a prefix are the heads of its ranges in consecutive tiers
+    """
+
+    def __init__(self, generation: int = 0):
+        from catalog.models import Product
+
+        self.generation = generation  # of <invalidate> calls seen by the build
+        self.built_at = time.time()
+        tiers = defaultdict(list)
+        for row in Product.objects.values_list('article', 'pk', 'title', 'manufacturer__title', 'priority', 'is_tried'):
+            article, pk, title, manufacturer_title, priority, is_tried = row
+            tiers[(-(priority or 0), not is_tried)].append((normalize(article), pk, article, title, manufacturer_title))
+
+        self.tiers: List[Tuple[List[str], list]] = []
+        for rank in sorted(tiers):
+            rows = sorted(tiers[rank])
+            self.tiers.append(([row[0] for row in rows], rows))
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def is_expired(self) -> bool:
+        return self.generation != _generation or \
+            time.time() - self.built_at > getattr(settings, 'ANALOG_AUTOCOMPLETE_TTL', 300)
+
+    def _ranges(self, key: str) -> Iterator[Tuple[list, int, int, int]]:
+        for keys, rows in self.tiers:
+            lower = bisect_left(keys, key)
+            yield rows, lower, bisect_right(keys, key, lower), bisect_left(keys, key + '\uffff', lower)
+
+    def search(self, prefix: str, limit: int) -> List[dict]:
+        key = normalize(prefix)
+        if not key:
+            return []  # e.g. only separators, would match every article
+
+        with self._cache_lock:
+            results = self._cache.get((key, limit))
+            if results is not None:
+                self._cache.move_to_end((key, limit))
+                return results
+
+        ranges = list(self._ranges(key))
+        # exact matches first, then prefix matches, both by tier
+        matches = chain(
+            chain.from_iterable(islice(rows, lower, exact) for rows, lower, exact, _ in ranges),
+            chain.from_iterable(islice(rows, exact, upper) for rows, _, exact, upper in ranges)
+        )
+        results = [
+            {'value': article, 'title': title, 'manufacturer__title': manufacturer_title, 'pk': pk}
+            for _, pk, article, title, manufacturer_title in islice(matches, limit)
+        ]
+
+        with self._cache_lock:
+            self._cache[(key, limit)] = results
+            if len(self._cache) > getattr(settings, 'ANALOG_AUTOCOMPLETE_CACHE_SIZE', 10000):
+                self._cache.popitem(last=False)
+        return results
+
+
+_index: Optional[ArticleIndex] = None
+_generation = 0
+_rebuilding = False
+_lock = threading.Lock()
+
+
+def _rebuild():
+    global _index, _rebuilding
+
+    from django.db import connection
+
+    try:
+        index = ArticleIndex(_generation)
+        with _lock:
+            _index = index
+    except Exception as e:
+        logger.error(f'Autocomplete index rebuild failed: {e}')
+    finally:
+        with _lock:
+            _rebuilding = False
+        connection.close()  # the thread holds its own connection
+
+
+def get_index() -> ArticleIndex:
+    """
+    Index for a request. Only the first build runs on the request thread: an expired or invalidated index
+    keeps serving while a background thread builds the next one
+    """
+    global _index, _rebuilding
+
+    index = _index
+    if index is not None and not index.is_expired():
+        return index
+
+    with _lock:
+        if _index is None:
+            _index = ArticleIndex(_generation)
+            return _index
+        if _index.is_expired() and not _rebuilding:
+            _rebuilding = True
+            threading.Thread(target=_rebuild, name='autocomplete-rebuild', daemon=True).start()
+        return _index
+
+
+def search(prefix: str, limit: int) -> List[dict]:
+    return get_index().search(prefix, limit)
+
+
+def invalidate():
+    """ Mark the index stale, it is rebuilt in the background on the next request """
+    global _generation
+
+    with _lock:
+        _generation += 1
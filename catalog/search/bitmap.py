@@ -0,0 +1,147 @@
+"""
+Битовые индексы (атрибут, значение) -> товары для жесткой проверки
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Hashable, List, Mapping, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger("analog")
+
+
+class CategoryBitmaps(object):
+    """
+    Packed bitsets over products of one category: one per manufacturer, per (HARD attribute, value)
+    and per HARD attribute with any value filled. Bit order follows <np.packbits>.
+    Stamped with the catalog version, changes made by any worker or by bulk queries bump it
+    """
+
+    def __init__(self, category_pk: int, version: int = 0):
+        from catalog.models import Product
+
+        start_time = time.time()
+        self.category_pk = category_pk
+        self.version = version
+        self.built_at = start_time
+
+        products = list(
+            Product.objects.filter(category_id=category_pk).values_list('pk', 'manufacturer_id', 'irrelevant')
+        )
+        self.size = len(products)
+        self.product_pks = np.array([row[0] for row in products], dtype=np.int64)
+        self.rows: Dict[int, int] = {pk: idx for idx, pk in enumerate(self.product_pks.tolist())}
+
+        self.relevant = self._empty()
+        self.manufacturers: Dict[int, np.ndarray] = {}
+        for idx, (_, manufacturer_pk, irrelevant) in enumerate(products):
+            if manufacturer_pk not in self.manufacturers:
+                self.manufacturers[manufacturer_pk] = self._empty()
+            self._set(self.manufacturers[manufacturer_pk], idx)
+            if not irrelevant:
+                self._set(self.relevant, idx)
+
+        self.values: Dict[Tuple[int, Hashable], np.ndarray] = {}
+        self.filled: Dict[int, np.ndarray] = {}
+        for product_pk, attribute_pk, value_pk, un_value in self._attribute_values(product__category_id=category_pk):
+            self._add(self.rows[product_pk], attribute_pk, value_pk, un_value)
+
+        logger.debug(f'Built {len(self.values)} bitmaps for category <{category_pk}>, '
+                     f'time left: {time.time() - start_time}s')
+
+    def is_expired(self, version: int) -> bool:
+        return self.version != version or \
+            time.time() - self.built_at > getattr(settings, 'ANALOG_BITMAP_TTL', 300)
+
+    @staticmethod
+    def _attribute_values(**filters):
+        from catalog.choices import HARD
+        from catalog.models import AttributeValue
+
+        return AttributeValue.objects.filter(
+            attribute__type=HARD, **filters
+        ).values_list('product_id', 'attribute_id', 'value_id', 'un_value')
+
+    @staticmethod
+    def key(attribute_pk: int, value_pk: Optional[int], un_value: Optional[float]) -> Tuple[int, Hashable]:
+        return attribute_pk, value_pk if value_pk is not None else un_value
+
+    def _empty(self) -> np.ndarray:
+        return np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    @staticmethod
+    def _set(bits: np.ndarray, idx: int):
+        bits[idx >> 3] |= np.uint8(0x80 >> (idx & 7))
+
+    def _add(self, idx: int, attribute_pk: int, value_pk: Optional[int], un_value: Optional[float]):
+        key = self.key(attribute_pk, value_pk, un_value)
+        if key not in self.values:
+            self.values[key] = self._empty()
+        self._set(self.values[key], idx)
+
+        if value_pk is not None or un_value is not None:
+            if attribute_pk not in self.filled:
+                self.filled[attribute_pk] = self._empty()
+            self._set(self.filled[attribute_pk], idx)
+
+    def filter_by_hard_attributes(self, manufacturer_pk: int, attributes: List[Mapping],
+                                  null_attributes) -> List[int]:
+        """
+        Category, manufacturer and HARD steps as bitwise ANDs. Values of one attribute repeated
+        at the initial product are ORed: a candidate matching any of them passes, as in the SQL filter
+        """
+        bits = self.manufacturers.get(manufacturer_pk)
+        if bits is None:
+            return []
+        bits = bits & self.relevant
+
+        by_attribute = defaultdict(list)
+        for attribute in attributes:
+            value = attribute['value'] if attribute['attribute__is_fixed'] else attribute['un_value']
+            by_attribute[attribute['attribute']].append(self.values.get((attribute['attribute'], value)))
+        for value_bits in by_attribute.values():
+            value_bits = [item for item in value_bits if item is not None]
+            if not value_bits:
+                return []
+            bits &= np.bitwise_or.reduce(value_bits)
+
+        for null_attribute in null_attributes:
+            filled_bits = self.filled.get(null_attribute.pk)
+            if filled_bits is not None:
+                bits &= ~filled_bits
+
+        return self.product_pks[np.flatnonzero(np.unpackbits(bits)[:self.size])].tolist()
+
+
+_bitmaps: Dict[int, CategoryBitmaps] = {}
+_lock = threading.Lock()
+
+
+def get_bitmaps(category_pk: int, version: int = None) -> CategoryBitmaps:
+    """ Bitmaps of the current catalog version, changes of other workers are seen through <Category.version> """
+    from catalog.search.invalidation import category_version
+
+    if version is None:
+        version = category_version(category_pk)
+
+    bitmaps = _bitmaps.get(category_pk)
+    if bitmaps is not None and not bitmaps.is_expired(version):
+        return bitmaps
+
+    with _lock:
+        bitmaps = _bitmaps.get(category_pk)
+        if bitmaps is None or bitmaps.is_expired(version):
+            bitmaps = CategoryBitmaps(category_pk, version)
+            _bitmaps[category_pk] = bitmaps
+    return bitmaps
+
+
+def invalidate(category_pk: Optional[int] = None):
+    with _lock:
+        if category_pk is None:
+            _bitmaps.clear()
+        else:
+            _bitmaps.pop(category_pk, None)
@@ -0,0 +1,228 @@
+"""
+Группы эквивалентных аналогов разных производителей
+
+Группа хранится деревом: у каждого товара путь от корня группы <path> и накопленная достоверность
+каждого узла пути <path_confidence>. Достоверность пары товаров группы - произведение достоверностей
+найденных поиском связей на пути между ними, убывающее с каждым лишним шагом
+"""
+import logging
+from collections import defaultdict
+from typing import Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Count, Q
+
+logger = logging.getLogger("analog")
+
+
+def min_confidence() -> float:
+    return getattr(settings, 'ANALOG_CLUSTER_MIN_CONFIDENCE', 0.5)
+
+
+def pair_confidence(first, second) -> Tuple[float, int]:
+    """
+    (confidence, hops) of two members of one cluster over the tree path between them: product of the link
+    confidences, every hop after the first one decays it by <ANALOG_CLUSTER_HOP_DECAY>
+    """
+    common = 0
+    for first_pk, second_pk in zip(first.path, second.path):
+        if first_pk != second_pk:
+            break
+        common += 1
+    if not common:
+        return 0., 0  # members of different trees
+
+    ancestor = first.path_confidence[common - 1]
+    hops = len(first.path) + len(second.path) - 2 * common
+    confidence = (first.confidence / ancestor) * (second.confidence / ancestor)
+    return confidence * getattr(settings, 'ANALOG_CLUSTER_HOP_DECAY', 0.9) ** max(hops - 1, 0), hops
+
+
+def find_analog(product, manufacturer_pk: int):
+    """ Most confident product of the product cluster in the manufacturer """
+    return find_analogs(product, [manufacturer_pk]).get(manufacturer_pk)
+
+
+def find_analogs(product, manufacturer_pks: Iterable[int]) -> dict:
+    """
+    {manufacturer_pk: most confident member product} for several manufacturers at once, from one join
+    of the product member with the members of its cluster. Members below <min_confidence> are not served
+    """
+    from catalog.models import AnalogClusterMember
+
+    members = list(
+        AnalogClusterMember.objects.filter(cluster__members__product_id=product.pk).filter(
+            Q(product_id=product.pk) | Q(
+                manufacturer_id__in=list(manufacturer_pks), product__irrelevant=False, product__deleted=False
+            )
+        ).select_related('product')
+    )
+    own = next((member for member in members if member.product_id == product.pk), None)
+    if own is None:
+        return {}
+
+    best = {}
+    for member in members:
+        if member.product_id == product.pk:
+            continue
+        confidence, hops = pair_confidence(own, member)
+        if confidence < min_confidence():
+            continue
+        rank = (-confidence, hops, member.product_id)
+        if member.manufacturer_id not in best or rank < best[member.manufacturer_id][0]:
+            best[member.manufacturer_id] = (rank, member.product)
+    return {manufacturer_pk: analog for manufacturer_pk, (_, analog) in best.items()}
+
+
+def search_confidence(product, analog) -> float:
+    """
+    Confidence of a search result: HARD attributes match by the search, the share of the weight of SOFT
+    and RECALCULATION values of the product the analog has exactly raises it from
+    <ANALOG_CLUSTER_SEARCH_CONFIDENCE> up to 1.0
+    """
+    from catalog.choices import RECALCULATION, SOFT
+    from catalog.models import AttributeValue
+
+    values, weights = defaultdict(dict), {}
+    for product_pk, attribute_pk, value, un_value, weight in AttributeValue.objects.filter(
+        product__in=(product.pk, analog.pk), attribute__type__in=(SOFT, RECALCULATION)
+    ).values_list('product', 'attribute', 'value', 'un_value', 'attribute__weight'):
+        values[product_pk][attribute_pk] = (value, un_value)
+        weights[attribute_pk] = weight or 1
+
+    base = getattr(settings, 'ANALOG_CLUSTER_SEARCH_CONFIDENCE', 0.9)
+    own = values[product.pk]
+    total = sum(weights[attribute_pk] for attribute_pk in own)
+    if not total:
+        return 1.
+    matched = sum(weights[pk] for pk, value in own.items() if values[analog.pk].get(pk) == value)
+    return base + (1. - base) * matched / total
+
+
+def _route(start, end) -> List[Tuple[int, float]]:
+    """ [(product pk, link confidence to the previous one), ...] of the tree path from start to end, start excluded """
+    common = 0
+    for start_pk, end_pk in zip(start.path, end.path):
+        if start_pk != end_pk:
+            break
+        common += 1
+
+    route = []
+    # up to the common ancestor: the link of a node to its parent is the ratio of their confidences
+    for idx in range(len(start.path) - 1, common - 1, -1):
+        route.append((start.path[idx - 1], start.path_confidence[idx] / start.path_confidence[idx - 1]))
+    for idx in range(common, len(end.path)):
+        route.append((end.path[idx], end.path_confidence[idx] / end.path_confidence[idx - 1]))
+    return route
+
+
+def link(product, analog, confidence: float = None):
+    """
+    Record the search result as a link of the tree. A product out of clusters joins the cluster of the other one
+    under it; two clusters are merged only by a link of at least <ANALOG_CLUSTER_MERGE_CONFIDENCE>,
+    the smaller one is re-rooted at its linked product and placed under the other one
+    """
+    from catalog.models import AnalogCluster, AnalogClusterMember
+
+    if analog is None or product.pk == analog.pk:
+        return
+    if confidence is None:
+        confidence = search_confidence(product, analog)
+
+    try:
+        with transaction.atomic():
+            members = {
+                member.product_id: member for member in AnalogClusterMember.objects.select_for_update().filter(
+                    product_id__in=(product.pk, analog.pk)
+                )
+            }
+            source, target = members.get(product.pk), members.get(analog.pk)
+
+            if source is None and target is None:
+                cluster = AnalogCluster.objects.create()
+                root = AnalogClusterMember(
+                    cluster=cluster, product_id=product.pk, manufacturer_id=product.manufacturer_id,
+                    path=[product.pk], path_confidence=[1.], confidence=1.
+                )
+                AnalogClusterMember.objects.bulk_create([root, _member(analog, root, confidence)])
+            elif target is None:
+                _member(analog, source, confidence).save()
+            elif source is None:
+                # links are symmetric: the product joins the cluster of its analog
+                _member(product, target, confidence).save()
+            elif source.cluster_id != target.cluster_id:
+                _merge(source, target, confidence)
+            # both are in one cluster already: the result is kept by <ProductAnalog>
+    except DatabaseError:
+        # e.g. a concurrent search has just linked one of the products, the cluster is a cache - skip
+        logger.debug('Concurrent cluster link of <%s> and <%s> skipped', product.pk, analog.pk)
+
+
+def _member(product, parent, confidence: float):
+    from catalog.models import AnalogClusterMember
+
+    member = AnalogClusterMember(product_id=product.pk, manufacturer_id=product.manufacturer_id)
+    _place(member, parent, [(product.pk, confidence)])
+    return member
+
+
+def _place(member, parent, route: List[Tuple[int, float]]):
+    """ Member at the end of the route from the parent: [(product pk, link confidence to the previous one), ...] """
+    path, path_confidence = list(parent.path), list(parent.path_confidence)
+    for pk, link_confidence in route:
+        path.append(pk)
+        path_confidence.append(path_confidence[-1] * link_confidence)
+    member.cluster_id = parent.cluster_id
+    member.path, member.path_confidence = path, path_confidence
+    member.confidence = path_confidence[-1]
+    member.linked_from_id = path[-2]
+
+
+def _merge(source, target, confidence: float) -> Optional[int]:
+    """ Merge clusters of the linked members, returns the pk of the merged away cluster """
+    from catalog.models import AnalogCluster, AnalogClusterMember
+
+    if confidence < getattr(settings, 'ANALOG_CLUSTER_MERGE_CONFIDENCE', 0.95):
+        return None
+
+    sizes = dict(
+        AnalogClusterMember.objects.filter(cluster_id__in=(source.cluster_id, target.cluster_id)).values(
+            'cluster_id'
+        ).annotate(size=Count('pk')).values_list('cluster_id', 'size')
+    )
+    # the smaller tree is moved under the other one, the tree of the analog for equal sizes
+    moved, kept = (target, source) if sizes.get(target.cluster_id, 0) <= sizes.get(source.cluster_id, 0) else \
+        (source, target)
+    merged_pk = moved.cluster_id
+
+    members = list(AnalogClusterMember.objects.select_for_update().filter(cluster_id=merged_pk))
+    for member in members:
+        route = [(moved.product_id, confidence)] + _route(moved, member)
+        _place(member, kept, route)
+    AnalogClusterMember.objects.bulk_update(
+        members, ('cluster', 'path', 'path_confidence', 'confidence', 'linked_from')
+    )
+    AnalogCluster.objects.filter(pk=merged_pk).delete()
+    return merged_pk
+
+
+def unlink(product_pks: Iterable[int]) -> int:
+    """ Remove products from their clusters with the members linked through them, e.g. when attributes changed """
+    from catalog.models import AnalogClusterMember
+
+    product_pks = list(product_pks)
+    deleted, _ = AnalogClusterMember.objects.filter(
+        Q(product_id__in=product_pks) | Q(path__overlap=product_pks)
+    ).delete()
+    return deleted
+
+
+def unlink_categories(category_pks: Iterable[int]) -> int:
+    from catalog.models import AnalogClusterMember
+
+    return unlink(
+        AnalogClusterMember.objects.filter(product__category_id__in=list(category_pks)).values_list(
+            'product_id', flat=True
+        )
+    )
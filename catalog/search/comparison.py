@@ -0,0 +1,138 @@
+"""
+Таблица сравнения аналога с исходным товаром
+"""
+from itertools import groupby
+from typing import Optional
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from catalog.search.invalidation import coalesce_on_commit
+
+SKIPPED_TITLES = ('ед. изм.', 'цена', 'нет в прайсе')
+FIELDS = ('value__title', 'un_value', 'attribute__title', 'attribute__pk', 'product__pk',
+          'product__title', 'product__manufacturer__title')
+
+
+def version_key(analog, original, catalog_version: int) -> str:
+    """
+    Payload is valid while both products and their attributes are unchanged, stamps of the loaded instances
+    and of the stored result are compared: labels of attributes change <Category.version>, titles of fixed values
+    and manufacturers drop the payloads showing them, see <drop_payloads>
+    """
+    return '{}:{}:{}/{}:{}:{}/{}'.format(
+        original.pk, original.attributes_version, original.updated_at.timestamp(),
+        analog.pk, analog.attributes_version, analog.updated_at.timestamp(),
+        catalog_version
+    )
+
+
+def touch(*product_pks: int):
+    """ Bump <Product.attributes_version> once per transaction for all products whose attributes changed in it """
+    coalesce_on_commit(_bump, *product_pks)
+
+
+def drop_payloads(condition: Q):
+    """ Drop payloads of the stored results matching the condition after commit, e.g. showing a changed title """
+    from catalog.models import ProductAnalog
+
+    transaction.on_commit(
+        lambda: ProductAnalog.objects.filter(condition).exclude(comparison__isnull=True).update(
+            comparison=None, comparison_key=''
+        )
+    )
+
+
+def _bump(product_pks):
+    from catalog.models import Product
+
+    Product.objects.filter(pk__in=list(product_pks)).update(attributes_version=F('attributes_version') + 1)
+
+
+def _value(element: dict):
+    return element["value__title"] if element["value__title"] is not None else element["un_value"]
+
+
+def build_payload(analog, original) -> dict:
+    """ Comparison rows of both products from one query """
+    from catalog.models import AttributeValue
+
+    matching = {analog.pk: "analog", original.pk: "original"}
+    titles = {analog.pk: (analog.title, None), original.pk: (original.title, None)}
+
+    attributes = list(
+        AttributeValue.objects.filter(product__in=(original.pk, analog.pk)).values(*FIELDS)
+    )
+    # the original first within an attribute, as in <Product.comparison>
+    attributes.sort(key=lambda element: (element['attribute__pk'], element['product__pk'] != original.pk))
+
+    info = [{
+        "analog": {"name": "наименование", "value": analog.title},
+        "original": {"name": "наименование", "value": original.title}
+    }]
+    for _, group in groupby(attributes, lambda element: element['attribute__pk']):
+        elements = list(group)
+        element1 = elements[0]
+        for element in elements:
+            titles[element['product__pk']] = (element['product__title'], element['product__manufacturer__title'])
+
+        if element1["attribute__title"].lower() in SKIPPED_TITLES:
+            continue
+
+        if len(elements) == 2:
+            element2 = elements[1]
+            info.append({
+                matching[element1["product__pk"]]: {
+                    "name": element1["attribute__title"].lower(), "value": _value(element1)
+                },
+                matching[element2["product__pk"]]: {
+                    "name": element2["attribute__title"].lower(), "value": _value(element2)
+                },
+            })
+        elif len(elements) == 1:
+            other = analog.pk if element1["product__pk"] == original.pk else original.pk
+            info.append({
+                matching[element1["product__pk"]]: {
+                    "name": element1["attribute__title"].lower(), "value": _value(element1)
+                },
+                matching[other]: {
+                    "name": element1["attribute__title"].lower(), "value": "------"
+                },
+            })
+
+    info.append({
+        "analog": {"name": "производитель", "value": titles[analog.pk][1] or analog.manufacturer.title},
+        "original": {"name": "производитель", "value": titles[original.pk][1] or original.manufacturer.title}
+    })
+    return {"result": info}
+
+
+def get_payload(analog, original, stored=None) -> dict:
+    """ Payload cached at the stored analog result of the original, rebuilt when either product has changed """
+    from catalog.models import ProductAnalog
+
+    if analog.pk == original.pk:
+        return build_payload(analog, original)
+
+    if stored is None:
+        # loaded by <Product.get_analog> or <Product.get_analogs> just before
+        stored = getattr(original, '_loaded_analogs', {}).get(analog.manufacturer_id)
+        if stored is not None and stored.analog_id != analog.pk:
+            stored = None
+    if stored is None:
+        stored: Optional[ProductAnalog] = ProductAnalog.objects.filter(
+            product=original.pk, manufacturer_to=analog.manufacturer_id, analog=analog.pk
+        ).only('pk', 'catalog_version', 'comparison', 'comparison_key').first()
+
+    key = version_key(analog, original, stored.catalog_version if stored is not None else 0)
+    if stored is not None and stored.comparison_key == key:
+        return stored.comparison
+
+    payload = build_payload(analog, original)
+    if stored is not None:
+        # by the result instead of the pk: the row kept by <Product.search_analog> is not loaded from the DB
+        ProductAnalog.objects.filter(
+            product=original.pk, manufacturer_to=analog.manufacturer_id, analog=analog.pk
+        ).update(comparison=payload, comparison_key=key)
+        stored.comparison, stored.comparison_key = payload, key
+    return payload
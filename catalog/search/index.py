@@ -0,0 +1,129 @@
+"""
+Индекс нефиксированных значений атрибута для поиска ближайшего значения
+"""
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from django.conf import settings
+
+NEAREST = 'nearest'
+MIN = 'min'
+MAX = 'max'
+CLOSEST_MIN = 'closest_min'
+CLOSEST_MAX = 'closest_max'
+
+
+def choose(values: List[float], target: Optional[float], mode: str = NEAREST) -> Optional[float]:
+    """
+    Value chosen from sorted values by one of <choices.TYPES_SEARCH> modes, None if there is no such.
+    The nearest value below the target wins a tie. Shared by the SQL and the matrix engines
+    """
+    if not values:
+        return None
+    if mode == MIN:
+        return values[0]
+    if mode == MAX:
+        return values[-1]
+    if target is None:
+        return None
+    if mode == CLOSEST_MIN:
+        position = bisect_right(values, target)
+        return values[position - 1] if position else None
+    if mode == CLOSEST_MAX:
+        position = bisect_left(values, target)
+        return values[position] if position < len(values) else None
+
+    position = bisect_left(values, target)
+    lower = values[position - 1] if position else None
+    upper = values[position] if position < len(values) else None
+    if lower is None or upper is None:
+        return upper if lower is None else lower
+    return lower if target - lower <= upper - target else upper
+
+
+class NearestValueIndex(object):
+    """
+    Values of one attribute in one category by product. A query sorts and bisects the values of its
+    candidates only, so the cost depends on the candidates after the HARD step, not on the category size
+    """
+
+    def __init__(self, category_pk: int, attribute_pk: int, version: int = 0):
+        from catalog.models import AttributeValue
+
+        self.version = version
+        self.built_at = time.time()
+        self.values: Dict[int, List[float]] = defaultdict(list)
+        self.null_products: Set[int] = set()  # products with a row of the attribute, but without a value
+        for un_value, product_pk in AttributeValue.objects.filter(
+            product__category_id=category_pk,
+            attribute_id=attribute_pk
+        ).values_list('un_value', 'product_id'):
+            if un_value is None:
+                self.null_products.add(product_pk)
+            else:
+                self.values[product_pk].append(un_value)
+
+    def is_expired(self, version: int) -> bool:
+        return self.version != version or \
+            time.time() - self.built_at > getattr(settings, 'ANALOG_INDEX_TTL', 300)
+
+    def select(self, target: Optional[float], candidates: Iterable[int], mode: str = NEAREST) -> Optional[float]:
+        """ Value chosen among values of the candidates, see <choose> """
+        return choose(
+            sorted(value for pk in candidates for value in self.values.get(pk, ())), target, mode
+        )
+
+    def products(self, value: float, candidates: Iterable[int]) -> List[int]:
+        """ Candidates having exactly this value """
+        return [pk for pk in candidates if value in self.values.get(pk, ())]
+
+    def null(self, candidates: Iterable[int]) -> List[int]:
+        """ Candidates having the attribute without a value """
+        return [pk for pk in candidates if pk in self.null_products]
+
+    def narrow(self, target: Optional[float], candidates: Iterable[int], mode: str = NEAREST) -> Optional[List[int]]:
+        """
+        Candidates with the chosen value; when there is no value to choose (e.g. the initial product has none),
+        candidates having the attribute without a value. None if the step must keep the candidates as they are
+        """
+        candidates = list(candidates)
+        value = self.select(target, candidates, mode)
+        products = self.null(candidates) if value is None else self.products(value, candidates)
+        return products or None
+
+
+_indexes: Dict[Tuple[int, int], NearestValueIndex] = {}
+_lock = threading.Lock()
+
+
+def get_index(category_pk: int, attribute_pk: int, version: int = None) -> NearestValueIndex:
+    """ Index of the current catalog version, changes of other workers are seen through <Category.version> """
+    from catalog.search.invalidation import category_version
+
+    if version is None:
+        version = category_version(category_pk)
+
+    key = (category_pk, attribute_pk)
+    index = _indexes.get(key)
+    if index is not None and not index.is_expired(version):
+        return index
+
+    with _lock:
+        index = _indexes.get(key)
+        if index is None or index.is_expired(version):
+            index = NearestValueIndex(category_pk, attribute_pk, version)
+            _indexes[key] = index
+    return index
+
+
+def invalidate(category_pk: Optional[int] = None):
+    with _lock:
+        for key in list(_keys(category_pk)):
+            _indexes.pop(key, None)
+
+
+def _keys(category_pk: Optional[int]) -> Iterator[Tuple[int, int]]:
+    return (key for key in _indexes if category_pk is None or key[0] == category_pk)
@@ -0,0 +1,81 @@
+"""
+Инвалидация предрассчитанных аналогов и кэшей поиска при изменении каталога
+"""
+import functools
+import logging
+import threading
+from typing import Callable, Iterable
+
+from django.db import transaction
+from django.db.models import F
+
+logger = logging.getLogger("analog")
+
+_local = threading.local()
+
+
+def category_version(category_pk: int) -> int:
+    """
+    Version of the category catalog, in-memory caches are stamped with it: a change committed by any worker
+    bumps the version and every process rebuilds its caches on the next read
+    """
+    from catalog.models import Category
+
+    return Category.objects.filter(pk=category_pk).values_list('version', flat=True).first() or 0
+
+
+def invalidate_categories(category_pks: Iterable[int]):
+    """ Bump catalog version, drop stored analogs and in-memory caches of the categories """
+    from catalog.models import AlternativeCategory, Category, ProductAnalog
+    from catalog.search import bitmap, clusters, index, matrix
+
+    category_pks = {pk for pk in category_pks if pk is not None}
+    if not category_pks:
+        return
+
+    # categories searching through an affected alternative are affected as well
+    affected = category_pks | set(
+        AlternativeCategory.objects.filter(alternative_id__in=category_pks).values_list('original_id', flat=True)
+    )
+
+    Category.objects.filter(pk__in=affected).update(version=F('version') + 1)
+    deleted, _ = ProductAnalog.objects.filter(product__category_id__in=affected).delete()
+    deleted += clusters.unlink_categories(affected)
+    for category_pk in affected:
+        matrix.invalidate(category_pk)
+        index.invalidate(category_pk)
+        bitmap.invalidate(category_pk)
+
+    logger.debug(f'Invalidated categories {sorted(affected)}, {deleted} stored analogs and cluster links removed')
+
+
+def schedule(*category_pks: int):
+    """ Coalesce invalidations of one transaction into a single call after commit """
+    coalesce_on_commit(invalidate_categories, *category_pks)
+
+
+def coalesce_on_commit(callback: Callable[[set], None], *items):
+    """
+    Collect items over the transaction and call ``callback(items)`` once after commit,
+    at once outside of a transaction
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        callback(set(items))
+        return
+
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        pending = _local.pending = {}
+    # callbacks of a rolled back transaction are dropped, keep their items - an extra call is harmless
+    pending.setdefault(callback, set()).update(items)
+    if not any(_flushes(entry[1], callback) for entry in connection.run_on_commit):
+        transaction.on_commit(functools.partial(_flush, callback))
+
+
+def _flushes(func, callback) -> bool:
+    return isinstance(func, functools.partial) and func.func is _flush and func.args == (callback,)
+
+
+def _flush(callback):
+    callback(_local.pending.pop(callback, set()))
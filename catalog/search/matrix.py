@@ -0,0 +1,301 @@
+"""
+Матрица атрибутов класса товаров для поиска аналогов в памяти
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger("analog")
+
+ABSENT = -1  # product has no AttributeValue row for the attribute
+NULL_VALUE = 0  # row exists, but FixedValue is not set
+
+
+class CategoryMatrix(object):
+    """
+    AttributeValue rows of one category packed into NumPy arrays:
+    ``fixed`` - FixedValue ids, ``values`` - un_value floats, ``present`` - row exists.
+    The row of the lowest pk goes to the arrays, further rows of the same attribute go to ``duplicates``;
+    a product matches when any of its rows matches, as in the SQL engine
+    """
+
+    def __init__(self, category_pk: int, version: int = 0):
+        from catalog.models import AttributeValue, Product
+
+        self.category_pk = category_pk
+        self.version = version
+        self.built_at = time.time()
+
+        products = list(
+            Product.objects.filter(category_id=category_pk).values_list('pk', 'manufacturer_id', 'irrelevant',
+                                                                        'priority')
+        )
+        self.product_pks = np.array([row[0] for row in products], dtype=np.int64)
+        self.manufacturers = np.array([row[1] for row in products], dtype=np.int64)
+        self.irrelevant = np.array([row[2] for row in products], dtype=bool)
+        self.priorities = np.array([row[3] or 0 for row in products], dtype=np.int64)
+        self.rows: Dict[int, int] = {pk: idx for idx, pk in enumerate(self.product_pks.tolist())}
+
+        values = list(
+            AttributeValue.objects.filter(
+                product__category_id=category_pk
+            ).order_by('pk').values_list('product_id', 'attribute_id', 'value_id', 'un_value')
+        )
+        self.columns: Dict[int, int] = {}
+        for _, attribute_pk, _, _ in values:
+            self.columns.setdefault(attribute_pk, len(self.columns))
+
+        shape = (len(self.rows), len(self.columns))
+        self.fixed = np.full(shape, ABSENT, dtype=np.int64)
+        self.values = np.full(shape, np.nan, dtype=np.float64)
+        self.present = np.zeros(shape, dtype=bool)
+
+        duplicates = defaultdict(list)
+        for product_pk, attribute_pk, value_pk, un_value in values:
+            row, col = self.rows.get(product_pk), self.columns[attribute_pk]
+            if row is None:
+                continue
+            if self.present[row, col]:
+                duplicates[col].append((row, NULL_VALUE if value_pk is None else value_pk,
+                                        np.nan if un_value is None else un_value))
+                continue
+            self.present[row, col] = True
+            self.fixed[row, col] = NULL_VALUE if value_pk is None else value_pk
+            if un_value is not None:
+                self.values[row, col] = un_value
+
+        # col -> (rows, fixed, values) of the extra rows
+        self.duplicates: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {
+            col: (
+                np.array([item[0] for item in items], dtype=np.int64),
+                np.array([item[1] for item in items], dtype=np.int64),
+                np.array([item[2] for item in items], dtype=np.float64)
+            ) for col, items in duplicates.items()
+        }
+
+        logger.debug(f'Built attribute matrix for category <{category_pk}>: {shape}, '
+                     f'time left: {time.time() - self.built_at}s')
+
+    def is_expired(self, version: int) -> bool:
+        return self.version != version or \
+            time.time() - self.built_at > getattr(settings, 'ANALOG_MATRIX_TTL', 300)
+
+    def matches(self, col: int, test: Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray]) -> np.ndarray:
+        """ Mask of products having any row of the column that passes test(fixed, values, present) """
+        mask = test(self.fixed[:, col], self.values[:, col], self.present[:, col])
+        if col in self.duplicates:
+            rows, fixed, values = self.duplicates[col]
+            mask[rows[test(fixed, values, np.ones(rows.size, dtype=bool))]] = True
+        return mask
+
+    def known_values(self, mask: np.ndarray, col: int) -> np.ndarray:
+        """ Sorted distinct values of the column over all rows of the masked products """
+        column = self.values[:, col]
+        known = column[mask & ~np.isnan(column)]
+        if col in self.duplicates:
+            rows, _, values = self.duplicates[col]
+            known = np.concatenate((known, values[mask[rows] & ~np.isnan(values)]))
+        return np.unique(known)
+
+    def closest(self, col: int, target: float) -> np.ndarray:
+        """ Value of the column closest to the target for each product, NaN if there is none """
+        column = self.values[:, col].copy()
+        if col in self.duplicates:
+            rows, _, values = self.duplicates[col]
+            for row, value in zip(rows.tolist(), values.tolist()):
+                if not np.isnan(value) and not abs(column[row] - target) <= abs(value - target):
+                    column[row] = value
+        return column
+
+    def candidates(self, manufacturer_pk: int) -> np.ndarray:
+        """ Mask of relevant products of the manufacturer """
+        return (self.manufacturers == manufacturer_pk) & ~self.irrelevant
+
+    def filter_by_hard_attributes(self, mask: np.ndarray, attributes: List[Mapping], null_attributes) -> np.ndarray:
+        """ Repeated rows of the initial product are alternatives: values of one attribute are ORed """
+        by_attribute = defaultdict(list)
+        for attribute in attributes:
+            by_attribute[attribute['attribute']].append(attribute)
+
+        for attribute_pk, alternatives in by_attribute.items():
+            col = self.columns.get(attribute_pk)
+            if col is None:
+                return np.zeros_like(mask)
+
+            matched = np.zeros_like(mask)
+            for attribute in alternatives:
+                if attribute['attribute__is_fixed']:
+                    expected = NULL_VALUE if attribute['value'] is None else attribute['value']
+                    matched |= self.matches(col, lambda fixed, values, present: fixed == expected)
+                elif attribute['un_value'] is None:
+                    matched |= self.matches(col, lambda fixed, values, present: present & np.isnan(values))
+                else:
+                    target = attribute['un_value']
+                    matched |= self.matches(col, lambda fixed, values, present: values == target)
+            mask = mask & matched
+
+        for null_attribute in null_attributes:
+            col = self.columns.get(null_attribute.pk)
+            if col is None:
+                continue
+
+            if null_attribute.is_fixed:
+                mask = mask & ~self.matches(col, lambda fixed, values, present: fixed > NULL_VALUE)
+            else:
+                mask = mask & ~self.matches(col, lambda fixed, values, present: present & ~np.isnan(values))
+
+        return mask
+
+    def filter_by_any_attributes(self, mask: np.ndarray, attributes: List[Mapping],
+                                 search_types: Optional[Mapping[int, str]] = None) -> np.ndarray:
+        """
+        Sequential narrowing, skips an attribute when it would leave nothing.
+        Non-fixed values are chosen by <index.choose> as in the SQL engine
+        """
+        from catalog.search.index import NEAREST, choose
+
+        search_types = search_types or {}
+        for attribute in attributes:
+            col = self.columns.get(attribute['attribute'])
+            if col is None:
+                continue
+
+            if attribute['attribute__is_fixed']:
+                expected = NULL_VALUE if attribute['value'] is None else attribute['value']
+                narrowed = mask & self.matches(col, lambda fixed, values, present: fixed == expected)
+                if narrowed.any():
+                    mask = narrowed
+                continue
+
+            value = choose(
+                self.known_values(mask, col).tolist(), attribute['un_value'],
+                search_types.get(attribute['attribute'], NEAREST)
+            )
+            if value is None:
+                narrowed = mask & self.matches(col, lambda fixed, values, present: present & np.isnan(values))
+            else:
+                narrowed = mask & self.matches(col, lambda fixed, values, present: values == value)
+            if narrowed.any():
+                mask = narrowed
+
+        return mask
+
+    def rank(self, mask: np.ndarray, attributes: List[Mapping], schema_attributes: Mapping,
+             limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Top candidates by weighted distance over the attributes, all of them scored in one pass.
+        Distance is 0..1 per attribute: mismatch of fixed value or |x - target| scaled to the spread of the candidate
+        values together with the target, so a target outside of the candidate values stays within 0..1.
+        Ties are broken by distances of attributes in <Attribute.priority> order, then by <Product.priority>
+        """
+        rows = np.flatnonzero(mask)
+        if not rows.size:
+            return []
+
+        score = np.zeros(rows.size)
+        by_priority = []
+        for attribute in attributes:
+            col = self.columns.get(attribute['attribute'])
+            meta = schema_attributes.get(attribute['attribute'])
+
+            if col is None:
+                distance = np.ones(rows.size)
+            elif attribute['attribute__is_fixed']:
+                expected = NULL_VALUE if attribute['value'] is None else attribute['value']
+                distance = (~self.matches(col, lambda fixed, values, present: fixed == expected)[rows]).astype(
+                    np.float64
+                )
+            elif attribute['un_value'] is None:
+                distance = (~self.matches(col, lambda fixed, values, present: np.isnan(values))[rows]).astype(
+                    np.float64
+                )
+            else:
+                target = attribute['un_value']
+                column = self.closest(col, target)[rows]
+                known = column[~np.isnan(column)]
+                # the target is a bound of the spread as well
+                spread = known.max(initial=target) - known.min(initial=target)
+                distance = np.abs(column - target) / (spread or 1.0)
+                distance[np.isnan(distance)] = 1.0
+
+            score += (meta.weight if meta is not None and meta.weight else 1) * distance
+            by_priority.append((meta.priority if meta is not None else np.iinfo(np.int32).max, distance))
+
+        # np.lexsort sorts by the last key first
+        keys = [self.product_pks[rows], -self.priorities[rows]]
+        keys += [distance for _, distance in sorted(by_priority, key=lambda item: item[0], reverse=True)]
+        keys.append(score)
+        order = np.lexsort(keys)[:limit]
+
+        return [(int(self.product_pks[rows[idx]]), float(score[idx])) for idx in order]
+
+    def hard_mask(self, manufacturer_pk: int, info: Mapping, null_info: Mapping) -> np.ndarray:
+        from catalog.choices import HARD
+
+        return self.filter_by_hard_attributes(self.candidates(manufacturer_pk), info[HARD], null_info[HARD])
+
+    def search(self, manufacturer_pk: int, info: Mapping, null_info: Mapping,
+               search_types: Optional[Mapping[int, str]] = None, profiler=None) -> Tuple[Optional[int], List[int]]:
+        """ Full HARD -> SOFT -> RCL pipeline, returns (analog pk, second dataset); empty dataset after hard check """
+        from catalog.choices import RECALCULATION, SOFT
+        from catalog.search import profiling
+
+        with profiling.maybe_stage(profiler, profiling.HARD) as stage:
+            mask = self.hard_mask(manufacturer_pk, info, null_info)
+            stage.candidates = int(mask.sum())
+        if not mask.any():
+            return None, []
+
+        second_dataset = self.pks(mask)
+        with profiling.maybe_stage(profiler, profiling.SOFT) as stage:
+            mask = self.filter_by_any_attributes(mask, info[SOFT], search_types)
+            stage.candidates = int(mask.sum())
+        with profiling.maybe_stage(profiler, profiling.RCL) as stage:
+            mask = self.filter_by_any_attributes(mask, info[RECALCULATION], search_types)
+            stage.candidates = int(mask.sum())
+
+        return self.first_pk(mask), second_dataset
+
+    def pks(self, mask: np.ndarray) -> List[int]:
+        return self.product_pks[mask].tolist()
+
+    def first_pk(self, mask: np.ndarray) -> Optional[int]:
+        if not mask.any():
+            return None
+        return int(self.product_pks[mask].min())
+
+
+_matrices: Dict[int, CategoryMatrix] = {}
+_lock = threading.Lock()
+
+
+def get_matrix(category_pk: int, version: int = None) -> CategoryMatrix:
+    """ Matrix of the current catalog version, changes of other workers are seen through <Category.version> """
+    from catalog.search.invalidation import category_version
+
+    if version is None:
+        version = category_version(category_pk)
+
+    matrix = _matrices.get(category_pk)
+    if matrix is not None and not matrix.is_expired(version):
+        return matrix
+
+    with _lock:
+        matrix = _matrices.get(category_pk)
+        if matrix is None or matrix.is_expired(version):
+            matrix = CategoryMatrix(category_pk, version)
+            _matrices[category_pk] = matrix
+    return matrix
+
+
+def invalidate(category_pk: Optional[int] = None):
+    with _lock:
+        if category_pk is None:
+            _matrices.clear()
+        else:
+            _matrices.pop(category_pk, None)
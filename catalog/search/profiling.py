@@ -0,0 +1,192 @@
+"""
+Профилирование этапов поиска аналогов
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+SCHEMA = 'schema'
+CATEGORY = 'category'
+STORED = 'stored'
+HARD = 'hard'
+SOFT = 'soft'
+RCL = 'rcl'
+ALTERNATIVE = 'alternative'
+RANK = 'rank'
+BATCH = 'batch'
+
+PERCENTILES = (50, 90, 99)
+
+
+class StageProfile(object):
+    """ Metrics of one stage; ``self_time``, ``queries`` and ``sql_time`` exclude nested stages """
+
+    def __init__(self, name: str, top_level: bool = True):
+        self.name = name
+        self.top_level = top_level
+        self.wall_time = 0.
+        self.self_time = 0.
+        self.children_time = 0.
+        self.queries = 0
+        self.sql_time = 0.
+        self.candidates = None
+
+    def as_dict(self) -> dict:
+        return OrderedDict([
+            ('stage', self.name),
+            ('wall_time', self.wall_time),
+            ('self_time', self.self_time),
+            ('queries', self.queries),
+            ('sql_time', self.sql_time),
+            ('candidates', self.candidates)
+        ])
+
+
+class SearchProfiler(object):
+    """
+    Opt-in collector of per-stage timings, SQL query count/time and candidate-set sizes of one search.
+    Stages nest per thread; worker threads join a stage of their caller through <attach>
+    """
+
+    def __init__(self, category_pk: int = None):
+        self.category_pk = category_pk
+        self.stages: List[StageProfile] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def current(self) -> Optional[StageProfile]:
+        return getattr(self._local, 'current', None)
+
+    def _execute_wrapper(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            current = self.current
+            if current is not None:
+                with self._lock:
+                    current.queries += 1
+                    current.sql_time += time.perf_counter() - start_time
+
+    @contextmanager
+    def _wrapped(self):
+        """ Count queries of the connection of this thread, once per thread """
+        if getattr(self._local, 'wrapped', False):
+            yield
+            return
+        self._local.wrapped = True
+        try:
+            with connection.execute_wrapper(self._execute_wrapper):
+                yield
+        finally:
+            self._local.wrapped = False
+
+    @contextmanager
+    def attach(self, stage: Optional[StageProfile]):
+        """ Nest stages of a worker thread into the stage of the thread that started it """
+        previous, self._local.current = self.current, stage
+        try:
+            with self._wrapped():
+                yield
+        finally:
+            self._local.current = previous
+
+    @contextmanager
+    def stage(self, name: str):
+        """ with profiler.stage(HARD) as stage: ...; stage.candidates = len(dataset) """
+        parent = self.current
+        stage = StageProfile(name, top_level=parent is None)
+        self._local.current = stage
+        start_time = time.perf_counter()
+        try:
+            with self._wrapped():
+                yield stage
+        finally:
+            stage.wall_time = time.perf_counter() - start_time
+            self._local.current = parent
+            with self._lock:
+                # stages nested from worker threads run in parallel, their sum may exceed the wall time
+                stage.self_time = max(stage.wall_time - stage.children_time, 0.)
+                self.stages.append(stage)
+                if parent is not None:
+                    parent.children_time += stage.wall_time
+
+    def as_list(self) -> List[dict]:
+        return [stage.as_dict() for stage in self.stages]
+
+
+@contextmanager
+def maybe_stage(profiler: Optional[SearchProfiler], name: str):
+    if profiler is None:
+        yield StageProfile(name)
+    else:
+        with profiler.stage(name) as stage:
+            yield stage
+
+
+class ProfileSummary(object):
+    """
+    Percentiles of stage metrics over the last profiled searches, overall and per category.
+    Only the last ANALOG_PROFILE_WINDOW samples per stage and per category are kept
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Deque[StageProfile]] = defaultdict(self._window)
+        self._categories: Dict[int, Deque[float]] = defaultdict(self._window)
+
+    @staticmethod
+    def _window() -> deque:
+        return deque(maxlen=getattr(settings, 'ANALOG_PROFILE_WINDOW', 1000))
+
+    def add(self, profiler: SearchProfiler):
+        with self._lock:
+            for stage in profiler.stages:
+                self._stages[stage.name].append(stage)
+            # nested stages are inside the top level ones
+            self._categories[profiler.category_pk].append(
+                sum(stage.wall_time for stage in profiler.stages if stage.top_level)
+            )
+
+    @staticmethod
+    def _percentiles(values) -> dict:
+        values = [value for value in values if value is not None]
+        if not values:
+            return {}
+        return {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "stages": {
+                    name: {
+                        "count": len(stages),
+                        "wall_time": self._percentiles(stage.wall_time for stage in stages),
+                        "self_time": self._percentiles(stage.self_time for stage in stages),
+                        "queries": self._percentiles(stage.queries for stage in stages),
+                        "sql_time": self._percentiles(stage.sql_time for stage in stages),
+                        "candidates": self._percentiles(stage.candidates for stage in stages),
+                    } for name, stages in self._stages.items()
+                },
+                # slowest categories first, they are the ones to tune
+                "categories": OrderedDict(sorted(
+                    ((category_pk, dict(count=len(times), **self._percentiles(times)))
+                     for category_pk, times in self._categories.items()),
+                    key=lambda item: item[1].get('p90', 0), reverse=True
+                )),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._categories.clear()
+
+
+summary = ProfileSummary()
@@ -0,0 +1,79 @@
+"""
+Кэш схемы атрибутов классов товаров
+"""
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from django.conf import settings
+
+from catalog.choices import HARD, PRICE, RECALCULATION, RELATION, SOFT
+
+SchemaAttribute = namedtuple('SchemaAttribute',
+                             ('pk', 'title', 'type', 'is_fixed', 'priority', 'weight', 'search_type'))
+
+
+class CategorySchema(object):
+    """ Attributes of one category grouped by type, stamped with the catalog version """
+
+    def __init__(self, category_pk: int, version: int = 0):
+        from catalog.models import Attribute
+
+        self.category_pk = category_pk
+        self.version = version
+        self.built_at = time.time()
+        self.attributes: Dict[int, SchemaAttribute] = {
+            row[0]: SchemaAttribute(*row) for row in Attribute.objects.filter(
+                category=category_pk
+            ).values_list('pk', 'title', 'type', 'is_fixed', 'priority', 'weight', 'search_type')
+        }
+        self.by_type: Dict[str, List[int]] = {HARD: [], SOFT: [], RELATION: [], RECALCULATION: [], PRICE: []}
+        for attribute in self.attributes.values():
+            self.by_type[attribute.type].append(attribute.pk)
+
+    def is_expired(self, version: int) -> bool:
+        return self.version != version or \
+            time.time() - self.built_at > getattr(settings, 'ANALOG_SCHEMA_TTL', 300)
+
+    def missing(self, filled_pks: Iterable[int]) -> List[SchemaAttribute]:
+        """ Attributes of the category not filled at the product """
+        filled_pks = set(filled_pks)
+        return [attribute for pk, attribute in self.attributes.items() if pk not in filled_pks]
+
+    def search_types(self, overrides: Optional[Mapping[int, str]] = None) -> Dict[int, str]:
+        """ <Attribute.search_type> by attribute pk, overridden per search """
+        search_types = {pk: attribute.search_type for pk, attribute in self.attributes.items()}
+        search_types.update(overrides or {})
+        return search_types
+
+
+_schemas: Dict[int, CategorySchema] = {}
+_lock = threading.Lock()
+
+
+def get_schema(category_pk: int, version: int = None) -> CategorySchema:
+    """ Schema of the current catalog version, changes of other workers are seen through <Category.version> """
+    from catalog.search.invalidation import category_version
+
+    if version is None:
+        version = category_version(category_pk)
+
+    schema = _schemas.get(category_pk)
+    if schema is not None and not schema.is_expired(version):
+        return schema
+
+    with _lock:
+        schema = _schemas.get(category_pk)
+        if schema is None or schema.is_expired(version):
+            schema = CategorySchema(category_pk, version)
+            _schemas[category_pk] = schema
+    return schema
+
+
+def invalidate(category_pk: Optional[int] = None):
+    with _lock:
+        if category_pk is None:
+            _schemas.clear()
+        else:
+            _schemas.pop(category_pk, None)
@@ -0,0 +1,90 @@
+"""
+Объединение одновременных одинаковых поисков аналогов
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger("analog")
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_calls: Dict[Hashable, _Call] = {}
+_lock = threading.Lock()
+
+
+def do(key: Hashable, func: Callable):
+    """
+    Run func once per key at a time within the process: followers wait for the leader and share its result.
+    A follower that waits longer than ANALOG_SEARCH_WAIT_TIMEOUT runs func itself
+    """
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+
+    if not leader:
+        if call.event.wait(getattr(settings, 'ANALOG_SEARCH_WAIT_TIMEOUT', 30)):
+            if call.error is not None:
+                raise call.error
+            logger.debug('Search <%s> is coalesced', key)
+            return call.result
+        return func()
+
+    try:
+        call.result = func()
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _calls.pop(key, None)
+        call.event.set()
+
+
+def _try_lock(function: str, key1: int, key2: int) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {function}(%s, %s)', [key1, key2])
+        return cursor.fetchone()[0]
+
+
+@contextmanager
+def advisory_lock(key1: int, key2: int):
+    """
+    Postgres advisory lock, serializes workers computing the same key. A worker waits at most
+    ANALOG_SEARCH_WAIT_TIMEOUT and then goes on without the lock, so a stuck search does not block the others.
+    Inside a transaction the lock is transaction level: it is held until the result stored by the holder
+    is committed, otherwise the waiting workers would not see it and would search again
+    """
+    in_transaction = connection.in_atomic_block
+    function = 'pg_try_advisory_xact_lock' if in_transaction else 'pg_try_advisory_lock'
+    deadline = time.monotonic() + getattr(settings, 'ANALOG_SEARCH_WAIT_TIMEOUT', 30)
+    delay = 0.01
+
+    locked = _try_lock(function, key1, key2)
+    while not locked and time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+        locked = _try_lock(function, key1, key2)
+    if not locked:
+        logger.warning('Advisory lock <%s, %s> is not acquired in time, search goes on without it', key1, key2)
+
+    try:
+        yield locked
+    finally:
+        if locked and not in_transaction:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [key1, key2])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from django.db import transaction
+from django.db.models import Q, signals  # NOQA
+from django.dispatch import receiver
+
+from catalog.models import AlternativeCategory, Attribute, AttributeValue, Category, FixedValue, Manufacturer, Product, \
+    ProductAnalog
+from catalog.search import autocomplete, bitmap, clusters, comparison, invalidation, schema
+
+# fields of Product that have an influence on analog search
+SEARCH_FIELDS = set(Product.SEARCH_FIELDS)
+# fields of Product shown or ranked by article autocomplete
+AUTOCOMPLETE_FIELDS = {'article', 'title', 'manufacturer', 'priority', 'is_tried'}
+
+
+@receiver(signals.post_save, sender=AttributeValue)
+@receiver(signals.post_delete, sender=AttributeValue)
+def attribute_value_changed(sender, instance, *args, **kwargs):
+    if AttributeValue.product.is_cached(instance):
+        category_pk = instance.product.category_id
+    else:
+        category_pk = Product.objects.filter(pk=instance.product_id).values_list('category_id', flat=True).first()
+    invalidation.schedule(category_pk)
+    # comparison payloads are keyed on it
+    comparison.touch(instance.product_id)
+
+
+@receiver(signals.post_save, sender=Product)
+@receiver(signals.post_delete, sender=Product)
+def product_changed(sender, instance, update_fields=None, *args, **kwargs):
+    if update_fields is not None and not SEARCH_FIELDS.intersection(update_fields):
+        return
+    # e.g. a title edit in the admin saves every field, but does not change search results
+    if kwargs.get('signal') is signals.post_save and not kwargs.get('created') and not instance.search_changed():
+        return
+
+    # product could leave the category, where it was found as analog
+    ProductAnalog.objects.filter(analog=instance).delete()
+    clusters.unlink([instance.pk])
+    invalidation.schedule(instance.category_id, instance.loaded_category_id)
+
+
+@receiver(signals.post_save, sender=Product)
+@receiver(signals.post_delete, sender=Product)
+def product_article_changed(sender, instance, update_fields=None, *args, **kwargs):
+    if update_fields is None or AUTOCOMPLETE_FIELDS.intersection(update_fields):
+        transaction.on_commit(autocomplete.invalidate)
+
+
+@receiver(signals.post_save, sender=FixedValue)
+def fixed_value_changed(sender, instance, created=False, *args, **kwargs):
+    if created:
+        return
+    # the title is shown in comparison payloads
+    comparison.drop_payloads(Q(product__attributevalue__value=instance) | Q(analog__attributevalue__value=instance))
+
+
+@receiver(signals.post_save, sender=Manufacturer)
+def manufacturer_changed(sender, instance, created=False, *args, **kwargs):
+    if created:
+        return
+    # the title is shown in comparison payloads
+    comparison.drop_payloads(Q(product__manufacturer=instance) | Q(analog__manufacturer=instance))
+
+
+@receiver(signals.post_save, sender=AlternativeCategory)
+@receiver(signals.post_delete, sender=AlternativeCategory)
+def alternative_category_changed(sender, instance, *args, **kwargs):
+    invalidation.schedule(instance.original_id)
+
+
+@receiver(signals.m2m_changed, sender=Category.attributes.through)
+def category_attributes_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    if reverse and action == 'pre_clear':
+        # attribute.category_set.clear(): categories are unknown after the clear
+        instance._cleared_categories = list(Category.objects.filter(attributes=instance).values_list('pk', flat=True))
+        return
+    if not action.startswith('post_'):
+        return
+
+    if not reverse:
+        category_pks = [instance.pk]
+    elif action == 'post_clear':
+        category_pks = getattr(instance, '_cleared_categories', [])
+    else:
+        category_pks = pk_set or []
+
+    for category_pk in category_pks:
+        schema.invalidate(category_pk)
+    invalidation.schedule(*category_pks)
+
+
+@receiver(signals.post_save, sender=Attribute)
+@receiver(signals.post_delete, sender=Attribute)
+def attribute_changed(sender, instance, *args, **kwargs):
+    schema.invalidate()
+    transaction.on_commit(bitmap.invalidate)  # attribute could change its type
+    invalidation.schedule(*Category.objects.filter(attributes=instance).values_list('pk', flat=True))
@@ -0,0 +1,73 @@
+"""
+Каталог для тестов поиска аналогов и загрузки файлов
+"""
+from django.contrib.auth import models as auth_md
+
+from catalog.choices import HARD, RECALCULATION, SOFT
+from catalog.models import Attribute, AttributeValue, Category, FixedValue, Manufacturer, Product
+
+
+def reset_caches():
+    """ In-memory caches outlive the rolled back data of a test, <on_commit> invalidation does not run in TestCase """
+    from catalog.search import bitmap, index, matrix, schema
+
+    for cache in (bitmap, index, matrix, schema):
+        cache.invalidate()
+
+
+class Catalog(object):
+    """
+    One category of bolts: <kind> and <length> are HARD, <diameter> is SOFT, <weight> is RECALCULATION.
+    Products of <source> are searched among products of <target>, <other> has no analogs
+    """
+
+    def __init__(self, username: str = 'tester'):
+        self.user = auth_md.User.objects.create_user(username=username, password='password')
+
+        self.parent = self.create(Category, title='Крепёж')
+        self.category = self.create(Category, title='Болты', parent=self.parent)
+
+        self.source = self.create(Manufacturer, title='Alpha', is_tried=True)
+        self.target = self.create(Manufacturer, title='Beta', is_tried=True)
+        self.other = self.create(Manufacturer, title='Gamma')
+
+        self.kind = self.create(Attribute, title='Вид', type=HARD, priority=1, is_fixed=True)
+        self.length = self.create(Attribute, title='Длина', type=HARD, priority=2)
+        self.diameter = self.create(Attribute, title='Диаметр', type=SOFT, priority=3, weight=2)
+        self.weight = self.create(Attribute, title='Вес', type=RECALCULATION, priority=4, weight=1)
+        self.category.attributes.add(self.kind, self.length, self.diameter, self.weight)
+
+        self.hex = self.create(FixedValue, title='hex', attribute=self.kind)
+        self.round = self.create(FixedValue, title='round', attribute=self.kind)
+
+    def create(self, model, **fields):
+        return model.objects.create(created_by=self.user, updated_by=self.user, **fields)
+
+    def product(self, article: str, manufacturer: Manufacturer, category: Category = None, **values) -> Product:
+        """ Product with attribute values by attribute name, e.g. kind=catalog.hex, length=10. """
+        product = self.create(
+            Product, title=f'Болт {article}', article=article, manufacturer=manufacturer,
+            category=category or self.category
+        )
+        for name, value in values.items():
+            self.value(product, getattr(self, name), value)
+        return product
+
+    def value(self, product: Product, attribute: Attribute, value) -> AttributeValue:
+        if attribute.is_fixed:
+            return self.create(AttributeValue, product=product, attribute=attribute, value=value)
+        return self.create(AttributeValue, product=product, attribute=attribute, un_value=value)
+
+    def bolts(self):
+        """
+        Source bolt A-1 and its candidates in <target>. Diameters 4 and 6 are equally close to 5, so the search
+        type of <diameter> decides between B-1 and B-2/B-3, weight decides between B-2 and B-3
+        """
+        self.initial = self.product('A-1', self.source, kind=self.hex, length=10, diameter=5, weight=2)
+        self.b1 = self.product('B-1', self.target, kind=self.hex, length=10, diameter=4, weight=2)
+        self.b2 = self.product('B-2', self.target, kind=self.hex, length=10, diameter=6, weight=1)
+        self.b3 = self.product('B-3', self.target, kind=self.hex, length=10, diameter=6, weight=3)
+        self.b4 = self.product('B-4', self.target, kind=self.round, length=10, diameter=5, weight=2)
+        self.b5 = self.product('B-5', self.target, kind=self.hex, length=12, diameter=5, weight=2)
+        self.g1 = self.product('G-1', self.other, kind=self.round, length=12, diameter=5, weight=2)
+        return self
@@ -0,0 +1,86 @@
+from django.test import TestCase
+
+from catalog.models import AnalogClusterMember
+from catalog.search import clusters
+from catalog.tests.fixtures import Catalog, reset_caches
+
+
+class ClusterTests(TestCase):
+    """ Links of search results are propagated both ways and through the tree with a decaying confidence """
+
+    def setUp(self):
+        reset_caches()
+        self.catalog = Catalog().bolts()
+        self.a2 = self.catalog.product('A-2', self.catalog.source)
+
+    def test_both_directions(self):
+        catalog = self.catalog
+        clusters.link(catalog.initial, catalog.b1)
+
+        self.assertEqual(clusters.find_analog(catalog.initial, catalog.target.pk), catalog.b1)
+        self.assertEqual(clusters.find_analog(catalog.b1, catalog.source.pk), catalog.initial)
+        self.assertIsNone(clusters.find_analog(catalog.initial, catalog.other.pk))
+
+    def test_search_confidence(self):
+        # <diameter> of weight 2 differs, <weight> of weight 1 is the same
+        confidence = clusters.search_confidence(self.catalog.initial, self.catalog.b1)
+        self.assertAlmostEqual(confidence, 0.9 + 0.1 / 3)
+        member = AnalogClusterMember(path=[1, 2], path_confidence=[1., confidence], confidence=confidence)
+        self.assertEqual(clusters.pair_confidence(AnalogClusterMember(path=[1], path_confidence=[1.], confidence=1.),
+                                                  member), (confidence, 1))
+
+    def test_transitive_link(self):
+        catalog = self.catalog
+        clusters.link(catalog.initial, catalog.b1, 1.)
+        clusters.link(catalog.b1, catalog.g1, 1.)
+
+        self.assertEqual(clusters.find_analog(catalog.initial, catalog.other.pk), catalog.g1)
+        self.assertEqual(clusters.find_analog(catalog.g1, catalog.source.pk), catalog.initial)
+        member = AnalogClusterMember.objects.get(product=catalog.g1)
+        self.assertEqual(member.path, [catalog.initial.pk, catalog.b1.pk, catalog.g1.pk])
+
+    def test_direct_link_wins_over_a_confident_path(self):
+        catalog = self.catalog
+        clusters.link(catalog.initial, catalog.b1, 1.)
+        clusters.link(catalog.b1, catalog.g1, 0.95)
+        clusters.link(self.a2, catalog.g1, 0.9)
+
+        # the root A-1 is two hops away from G-1: 1.0 * 0.95 decayed by 0.9 is below the direct 0.9
+        self.assertEqual(clusters.find_analog(catalog.g1, catalog.source.pk), self.a2)
+
+    def test_weak_path_is_not_served(self):
+        catalog = self.catalog
+        clusters.link(catalog.initial, catalog.b1, 0.7)
+        clusters.link(catalog.b1, catalog.g1, 0.7)
+
+        self.assertEqual(clusters.find_analog(catalog.initial, catalog.target.pk), catalog.b1)
+        self.assertIsNone(clusters.find_analog(catalog.initial, catalog.other.pk))
+
+    def test_merge(self):
+        catalog = self.catalog
+        clusters.link(catalog.initial, catalog.b1, 1.)
+        clusters.link(self.a2, catalog.g1, 1.)
+
+        clusters.link(catalog.b1, catalog.g1, 0.9)  # below <ANALOG_CLUSTER_MERGE_CONFIDENCE>
+        self.assertIsNone(clusters.find_analog(catalog.initial, catalog.other.pk))
+
+        clusters.link(catalog.b1, catalog.g1, 0.97)
+        self.assertEqual(AnalogClusterMember.objects.values('cluster').distinct().count(), 1)
+        self.assertEqual(clusters.find_analog(catalog.initial, catalog.other.pk), catalog.g1)
+        self.assertEqual(clusters.find_analog(catalog.b1, catalog.source.pk), catalog.initial)
+        # A-2 is reached through the re-rooted tree of G-1
+        member = AnalogClusterMember.objects.get(product=self.a2)
+        self.assertEqual(member.path, [catalog.initial.pk, catalog.b1.pk, catalog.g1.pk, self.a2.pk])
+        self.assertAlmostEqual(member.confidence, 0.97)
+
+    def test_unlink(self):
+        catalog = self.catalog
+        clusters.link(catalog.initial, catalog.b1, 1.)
+        clusters.link(catalog.b1, catalog.g1, 1.)
+        clusters.link(catalog.initial, catalog.b2, 1.)
+
+        clusters.unlink([catalog.b1.pk])
+
+        # G-1 was linked through B-1
+        self.assertEqual(set(AnalogClusterMember.objects.values_list('product', flat=True)),
+                         {catalog.initial.pk, catalog.b2.pk})
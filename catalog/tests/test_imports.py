@@ -0,0 +1,287 @@
+import csv
+import os
+import tempfile
+from datetime import timedelta
+
+import openpyxl
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+
+from catalog import imports
+from catalog.choices import JOB_DONE, JOB_RUNNING
+from catalog.file_utils import CSVDocumentReader, ProcessingUploadData, XLSDocumentReader, document_reader, pd, pq
+from catalog.models import AttributeValue, DataFile, ImportJob, Product, ProductAnalog
+from catalog.search.invalidation import category_version
+from catalog.tests.fixtures import Catalog, reset_caches
+
+# attribute columns of the import template, columns 0-8 describe the product
+HEADER = {9: 'Вид', 10: 'Длина', 11: 'Диаметр', 12: 'Вес'}
+
+
+def line(article: str, manufacturer: str = 'Beta', title: str = None, kind: str = 'hex', length: str = '10',
+         diameter: str = '5', weight: str = '2') -> dict:
+    """ Line of the import template as read from a file, empty cells are left out """
+    values = {
+        0: title or f'Болт {article}', 1: 'Крепёж', 2: article, 6: 'Болты', 7: manufacturer,
+        9: kind, 10: length, 11: diameter, 12: weight
+    }
+    return {column: value for column, value in values.items() if value is not None}
+
+
+class UpsertTests(TransactionTestCase):
+    """ Upsert import writes only changed products and values and invalidates their categories """
+
+    def setUp(self):
+        reset_caches()
+        self.catalog = Catalog().bolts()
+
+    def load(self, *lines, upsert=True):
+        processing = ProcessingUploadData([HEADER] + list(lines), user=self.catalog.user, upsert=upsert)
+        success, message = processing.get_structured_data(only_check=False)
+        return processing, success, message
+
+    def test_new_products(self):
+        processing, success, message = self.load(line('U-1'), line('U-2', diameter='6'))
+
+        self.assertTrue(success, message)
+        self.assertEqual(len(processing.created_products), 2)
+        self.assertEqual(processing.changed_products, [])
+        product = Product.objects.get(article='U-2')
+        self.assertEqual(product.category, self.catalog.category)
+        self.assertEqual(
+            AttributeValue.objects.get(product=product, attribute=self.catalog.diameter).un_value, 6.
+        )
+
+    def test_changed_products(self):
+        self.load(line('U-1', diameter='4.5'), line('U-2', diameter='6'))
+        first, second = Product.objects.get(article='U-1'), Product.objects.get(article='U-2')
+        self.assertEqual(self.catalog.initial.get_analog(self.catalog.target), first)
+        version = category_version(self.catalog.category.pk)
+
+        processing, success, message = self.load(line('U-1', diameter='7', weight=None), line('U-2', diameter='6'))
+
+        self.assertTrue(success, message)
+        self.assertEqual(processing.created_products, [])
+        self.assertEqual(processing.changed_products, [first.pk])
+        self.assertEqual(
+            AttributeValue.objects.get(product=first, attribute=self.catalog.diameter).un_value, 7.
+        )
+        # a value missing in the file is soft-deleted
+        self.assertFalse(AttributeValue.objects.filter(product=first, attribute=self.catalog.weight).exists())
+        self.assertEqual(Product.objects.get(pk=first.pk).attributes_version, first.attributes_version + 1)
+        self.assertEqual(Product.objects.get(pk=second.pk).attributes_version, second.attributes_version)
+
+        # the whole category is invalidated: the changed product could become the analog of any product
+        self.assertEqual(category_version(self.catalog.category.pk), version + 1)
+        self.assertFalse(ProductAnalog.objects.filter(product=self.catalog.initial).exists())
+        self.assertEqual(self.catalog.initial.get_analog(self.catalog.target), self.catalog.b1)
+
+    def test_changed_fields(self):
+        self.load(line('U-1'))
+        processing, success, message = self.load(line('U-1', title='Болт новый'))
+
+        self.assertTrue(success, message)
+        self.assertEqual(len(processing.changed_products), 1)
+        self.assertEqual(Product.objects.get(article='U-1').title, 'Болт новый')
+
+    def test_unchanged_products(self):
+        self.load(line('U-1'), line('U-2'))
+        version = category_version(self.catalog.category.pk)
+
+        processing, success, message = self.load(line('U-1'), line('U-2'))
+
+        self.assertTrue(success, message)
+        self.assertEqual((processing.created_products, processing.changed_products), ([], []))
+        self.assertEqual(category_version(self.catalog.category.pk), version)
+
+    def test_repeated_line(self):
+        processing, success, message = self.load(line('U-1'), line('U-1', diameter='6'))
+
+        self.assertFalse(success)
+        self.assertIn('повторяется в файле', message)
+        self.assertFalse(Product.objects.filter(article='U-1').exists())
+
+    def test_validation_pool(self):
+        self.load(line('U-1'))
+        lines = [line('U-1'), line('U-2'), line('U-3', manufacturer='Nobody'), line('U-4')]
+        processing = ProcessingUploadData([HEADER] + lines, user=self.catalog.user, workers=2)
+        processing.CHUNK_SIZE = 1
+
+        # the spawned workers check the lines over the snapshot of the resolver taken here
+        success, message = processing.get_structured_data(only_check=False)
+
+        self.assertFalse(success)
+        self.assertEqual([line_number for line_number, _ in processing.errors], [2, 4])
+        self.assertEqual(Product.objects.filter(article__startswith='U-').count(), 1)
+
+    def test_existing_product_without_upsert(self):
+        self.load(line('U-1'))
+        processing, success, message = self.load(line('U-1'), upsert=False)
+
+        self.assertFalse(success)
+        self.assertEqual(processing.errors[0][0], 2)  # the line after the header
+        self.assertEqual(Product.objects.filter(article='U-1').count(), 1)
+
+
+class ImportChunksTests(TransactionTestCase):
+    """ Chunks are committed with their checkpoint, an interrupted import resumes from it """
+
+    def setUp(self):
+        reset_caches()
+        self.catalog = Catalog()
+        self.checkpoints = []
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def processing(self, *lines) -> ProcessingUploadData:
+        processing = ProcessingUploadData([HEADER] + list(lines), user=self.catalog.user)
+        processing.CHUNK_SIZE = 2
+        return processing
+
+    def articles(self):
+        return sorted(Product.objects.filter(manufacturer=self.catalog.target).values_list('article', flat=True))
+
+    def test_failed_chunk(self):
+        processing = self.processing(line('C-1'), line('C-2'), line('C-3'), line('C-4', manufacturer='Nobody'),
+                                     line('C-5'))
+        success, message = processing.import_chunks(0, self.checkpoints.append)
+
+        self.assertFalse(success)
+        self.assertEqual(processing.errors[0][0], 5)  # line of the file
+        # the first chunk stays imported with its checkpoint, the failed one is rolled back
+        self.assertEqual(self.checkpoints, [2])
+        self.assertEqual(self.articles(), ['C-1', 'C-2'])
+
+    def test_resume(self):
+        self.processing(line('C-1'), line('C-2'), line('C-3'), line('C-4', manufacturer='Nobody')).import_chunks(
+            0, self.checkpoints.append
+        )
+
+        processing = self.processing(line('C-1'), line('C-2'), line('C-3'), line('C-4'), line('C-5'))
+        success, message = processing.import_chunks(self.checkpoints[-1], self.checkpoints.append)
+
+        self.assertTrue(success, message)
+        self.assertEqual(self.checkpoints, [2, 4, 5])
+        self.assertEqual(len(processing.created_products), 3)
+        self.assertEqual(self.articles(), ['C-1', 'C-2', 'C-3', 'C-4', 'C-5'])
+
+    def job(self, *lines, **fields) -> ImportJob:
+        path = os.path.join(self.directory, 'import.tsv')
+        with open(path, 'w', newline='', encoding='utf-8') as stream:
+            writer = csv.writer(stream, delimiter='\t')
+            for row in [HEADER] + list(lines):
+                writer.writerow([row.get(column, '') for column in range(max(HEADER) + 1)])
+        datafile = self.catalog.create(DataFile, file=path)
+        job = imports.enqueue(datafile, self.catalog.user)
+        if fields:
+            ImportJob.objects.filter(pk=job.pk).update(**fields)
+        return job
+
+    def test_run(self):
+        job = self.job(line('C-1'), line('C-2'), line('C-3'))
+
+        claimed = imports.claim('worker-1')
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertTrue(imports.run(claimed))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.checkpoint, job.created_count), (JOB_DONE, 'worker-1', 3, 3))
+        self.assertEqual(self.articles(), ['C-1', 'C-2', 'C-3'])
+
+    def test_stale_job_is_resumed(self):
+        self.processing(line('C-1'), line('C-2')).import_chunks()
+        job = self.job(line('C-1'), line('C-2'), line('C-3'), status=JOB_RUNNING, worker='worker-1', checkpoint=2,
+                       heartbeat_at=timezone.now() - timedelta(days=1))
+
+        claimed = imports.claim('worker-2')
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertTrue(imports.run(claimed))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.checkpoint, job.created_count), (JOB_DONE, 'worker-2', 3, 1))
+        self.assertEqual(self.articles(), ['C-1', 'C-2', 'C-3'])
+
+    def test_running_job_is_not_claimed(self):
+        self.job(line('C-1'), status=JOB_RUNNING, worker='worker-1', heartbeat_at=timezone.now())
+        self.assertIsNone(imports.claim('worker-2'))
+
+    def test_lost_job(self):
+        job = self.job(line('C-1'), line('C-2'))
+        claimed = imports.claim('worker-1')
+        # e.g. taken over after missed heartbeats
+        ImportJob.objects.filter(pk=job.pk).update(worker='worker-2')
+
+        self.assertFalse(imports.run(claimed))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.checkpoint), (JOB_RUNNING, 'worker-2', 0))
+        self.assertEqual(self.articles(), [])
+
+
+class DocumentReaderTests(SimpleTestCase):
+    """ Every reader gives the same {column: stripped value} lines """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as stream:
+            stream.write(content)
+        return path
+
+    def test_csv(self):
+        content = '\ufeffБолт;Крепёж;"A;1"\r\nВинт;"Крепёж";B-2\r\n; x ;\r\n\r\n'
+        path = self.write('catalog.csv', content.encode('utf-8'))
+        reader = document_reader(path)
+
+        self.assertIsInstance(reader, CSVDocumentReader)
+        # the delimiter is sniffed, the BOM is skipped, empty cells are left out
+        self.assertEqual(list(reader.iter_rows()), [
+            {0: 'Болт', 1: 'Крепёж', 2: 'A;1'}, {0: 'Винт', 1: 'Крепёж', 2: 'B-2'}, {1: 'x'}, {}
+        ])
+        self.assertIsNone(reader.count_rows())
+
+    def test_tsv(self):
+        path = self.write('catalog.tsv', 'Болт, М6\tКрепёж\n\t10,5\n'.encode('utf-8'))
+        self.assertEqual(list(document_reader(path).iter_rows()), [{0: 'Болт, М6', 1: 'Крепёж'}, {1: '10,5'}])
+
+    def test_file_object(self):
+        path = self.write('catalog.csv', 'a,b\nc,d\n'.encode('utf-8'))
+        with open(path, 'rb') as stream:
+            lines = list(document_reader(stream).iter_rows())
+        self.assertEqual(lines, [{0: 'a', 1: 'b'}, {0: 'c', 1: 'd'}])
+
+    def test_xlsx(self):
+        path = os.path.join(self.directory, 'catalog.xlsx')
+        workbook = openpyxl.Workbook()
+        for row in (('Болт', 'Крепёж'), (None, 10), ('A-1', 2.5)):
+            workbook.active.append(row)
+        workbook.save(path)
+
+        reader = document_reader(path)
+        self.assertIsInstance(reader, XLSDocumentReader)
+        self.assertEqual(reader.count_rows(), 3)
+        self.assertEqual(list(reader.iter_rows()), [{0: 'Болт', 1: 'Крепёж'}, {1: '10'}, {0: 'A-1', 1: '2.5'}])
+
+    def test_parquet(self):
+        if pq is None and pd is None:
+            self.skipTest('pyarrow or pandas is required')
+        path = os.path.join(self.directory, 'catalog.parquet')
+        frame = {'article': ['A-1', None], 'length': ['10', '12']}
+        if pq is not None:
+            import pyarrow
+
+            pq.write_table(pyarrow.table(frame), path)
+        else:
+            pd.DataFrame(frame).to_parquet(path)
+
+        reader = document_reader(path)
+        self.assertEqual(list(reader.iter_rows()), [
+            {0: 'article', 1: 'length'}, {0: 'A-1', 1: '10'}, {1: '12'}
+        ])
+        if pq is not None:
+            self.assertEqual(reader.count_rows(), 3)
@@ -0,0 +1,147 @@
+from django.db import transaction
+from django.db.models import F
+from django.test import TransactionTestCase
+
+from catalog.models import AlternativeCategory, AttributeValue, Category, Product, ProductAnalog
+from catalog.search import comparison, matrix
+from catalog.search.invalidation import category_version
+from catalog.tests.fixtures import Catalog, reset_caches
+
+
+class InvalidationTests(TransactionTestCase):
+    """ Stored analogs and caches follow <Category.version>, bumped after commit of a catalog change """
+
+    def setUp(self):
+        reset_caches()
+        self.catalog = Catalog().bolts()
+        self.version = category_version(self.catalog.category.pk)
+
+    def stored(self):
+        return ProductAnalog.objects.current().filter(
+            product=self.catalog.initial, manufacturer_to=self.catalog.target
+        ).first()
+
+    def test_result_is_stored(self):
+        self.assertEqual(self.catalog.initial.get_analog(self.catalog.target), self.catalog.b1)
+
+        stored = self.stored()
+        self.assertEqual(stored.analog, self.catalog.b1)
+        self.assertEqual(stored.catalog_version, self.version)
+        self.assertEqual(sorted(stored.second_dataset), [self.catalog.b1.pk, self.catalog.b2.pk, self.catalog.b3.pk])
+
+    def test_attribute_value_change(self):
+        self.catalog.initial.get_analog(self.catalog.target)
+
+        attribute_value = AttributeValue.objects.get(product=self.catalog.b2, attribute=self.catalog.diameter)
+        attribute_value.un_value = 5
+        attribute_value.save()
+
+        self.assertEqual(category_version(self.catalog.category.pk), self.version + 1)
+        self.assertFalse(ProductAnalog.objects.filter(product=self.catalog.initial).exists())
+        # caches are rebuilt for the new version, the changed product is found
+        self.assertEqual(self.catalog.initial.get_analog(self.catalog.target), self.catalog.b2)
+
+    def test_changes_of_one_transaction_bump_the_version_once(self):
+        with transaction.atomic():
+            for product in (self.catalog.b1, self.catalog.b2):
+                self.catalog.value(product, self.catalog.weight, 2)
+            self.assertEqual(category_version(self.catalog.category.pk), self.version)
+        self.assertEqual(category_version(self.catalog.category.pk), self.version + 1)
+
+    def test_rolled_back_change(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.catalog.value(self.catalog.b1, self.catalog.weight, 2)
+                raise ValueError
+        self.assertEqual(category_version(self.catalog.category.pk), self.version)
+
+    def test_product_leaving_the_category(self):
+        category = self.catalog.create(Category, title='Винты', parent=self.catalog.parent)
+        self.catalog.initial.get_analog(self.catalog.target)
+
+        self.catalog.b1.category = category
+        self.catalog.b1.save()
+
+        self.assertEqual(category_version(self.catalog.category.pk), self.version + 1)
+        self.assertEqual(category_version(category.pk), 1)
+        self.assertEqual(self.catalog.initial.get_analog(self.catalog.target), self.catalog.b2)
+
+    def test_title_change_keeps_results(self):
+        self.catalog.initial.get_analog(self.catalog.target)
+
+        self.catalog.b1.title = 'Болт шестигранный'
+        self.catalog.b1.save()
+
+        self.assertEqual(category_version(self.catalog.category.pk), self.version)
+        self.assertIsNotNone(self.stored())
+
+    def test_alternative_category(self):
+        alternative = self.catalog.create(Category, title='Винты', parent=self.catalog.parent)
+        self.catalog.create(AlternativeCategory, original=self.catalog.category, alternative=alternative)
+        version = category_version(self.catalog.category.pk)
+        self.catalog.initial.get_analog(self.catalog.target)
+
+        # results of the original category may come from the alternative
+        self.catalog.product('V-1', self.catalog.target, category=alternative)
+
+        self.assertEqual(category_version(self.catalog.category.pk), version + 1)
+        self.assertIsNone(self.stored())
+
+    def test_manufacturer_title_drops_payloads(self):
+        catalog = self.catalog
+        catalog.initial.get_analog(catalog.target)
+        comparison.get_payload(catalog.b1, catalog.initial)
+        self.assertIsNotNone(self.stored().comparison)
+
+        catalog.target.title = 'Beta GmbH'
+        catalog.target.save()
+
+        stored = self.stored()
+        self.assertEqual((stored.comparison, stored.comparison_key), (None, ''))
+        # instances of the next request
+        analog, original = Product.objects.get(pk=catalog.b1.pk), Product.objects.get(pk=catalog.initial.pk)
+        self.assertEqual(comparison.get_payload(analog, original)['result'][-1]['analog'],
+                         {'name': 'производитель', 'value': 'Beta GmbH'})
+
+    def test_newer_result_is_kept(self):
+        catalog = self.catalog
+        ProductAnalog.store(catalog.initial.pk, catalog.target.pk, catalog.b2.pk, [], self.version + 2)
+        ProductAnalog.store(catalog.initial.pk, catalog.target.pk, catalog.b3.pk, [], self.version + 1)
+        self.assertEqual(ProductAnalog.objects.get(product=catalog.initial).analog, catalog.b2)
+
+        ProductAnalog.store(catalog.initial.pk, catalog.target.pk, catalog.b1.pk, [], self.version + 2)
+        self.assertEqual(ProductAnalog.objects.get(product=catalog.initial).analog, catalog.b1)
+
+    def test_batch_store(self):
+        catalog = self.catalog
+        ProductAnalog.store(catalog.initial.pk, catalog.target.pk, catalog.b2.pk, [], self.version + 1)
+        ProductAnalog.store(catalog.initial.pk, catalog.other.pk, None, [], self.version - 1)
+
+        ProductAnalog.store_many([
+            ProductAnalog(product=catalog.initial, manufacturer_to=manufacturer, analog=catalog.b1,
+                          catalog_version=self.version) for manufacturer in (catalog.target, catalog.other)
+        ])
+
+        stored = {row.manufacturer_to_id: row for row in ProductAnalog.objects.filter(product=catalog.initial)}
+        self.assertEqual(stored[catalog.target.pk].analog, catalog.b2)
+        self.assertEqual((stored[catalog.other.pk].analog, stored[catalog.other.pk].catalog_version),
+                         (catalog.b1, self.version))
+
+    def test_stale_result(self):
+        self.catalog.initial.get_analog(self.catalog.target)
+        # e.g. a bulk change of another worker
+        Category.objects.filter(pk=self.catalog.category.pk).update(version=F('version') + 1)
+
+        self.assertIsNone(self.stored())
+        self.assertEqual(self.catalog.initial.get_analog(self.catalog.target), self.catalog.b1)
+        self.assertEqual(self.stored().catalog_version, self.version + 1)
+
+    def test_cache_follows_the_version(self):
+        cached = matrix.get_matrix(self.catalog.category.pk)
+        self.assertIs(matrix.get_matrix(self.catalog.category.pk), cached)
+
+        Category.objects.filter(pk=self.catalog.category.pk).update(version=F('version') + 1)
+
+        rebuilt = matrix.get_matrix(self.catalog.category.pk)
+        self.assertIsNot(rebuilt, cached)
+        self.assertEqual(rebuilt.version, self.version + 1)
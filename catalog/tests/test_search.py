@@ -0,0 +1,195 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from catalog.choices import MATRIX_ENGINE, RANKED_ENGINE, SQL_ENGINE
+from catalog.exceptions import AnalogNotFound
+from catalog.models import AlternativeCategory, AnalogSearch, Category, Manufacturer, Product, ProductAnalog
+from catalog.search.index import CLOSEST_MAX, CLOSEST_MIN, MAX, MIN, NEAREST, choose
+from catalog.search.invalidation import category_version
+from catalog.tests.fixtures import Catalog, reset_caches
+
+
+class ChooseTests(SimpleTestCase):
+    """ Selection of a non-fixed value shared by the SQL and the matrix engines """
+
+    values = [4., 6., 9.]
+
+    def test_nearest_lower_value_wins_a_tie(self):
+        self.assertEqual(choose(self.values, 5., NEAREST), 4.)
+        self.assertEqual(choose(self.values, 8., NEAREST), 9.)
+
+    def test_closest_min_and_max_include_the_target(self):
+        self.assertEqual(choose(self.values, 6., CLOSEST_MIN), 6.)
+        self.assertEqual(choose(self.values, 5., CLOSEST_MIN), 4.)
+        self.assertEqual(choose(self.values, 6., CLOSEST_MAX), 6.)
+        self.assertEqual(choose(self.values, 7., CLOSEST_MAX), 9.)
+
+    def test_closest_out_of_range(self):
+        self.assertIsNone(choose(self.values, 3., CLOSEST_MIN))
+        self.assertIsNone(choose(self.values, 10., CLOSEST_MAX))
+
+    def test_min_and_max_ignore_the_target(self):
+        self.assertEqual(choose(self.values, None, MIN), 4.)
+        self.assertEqual(choose(self.values, None, MAX), 9.)
+
+    def test_no_value(self):
+        self.assertIsNone(choose([], 5., NEAREST))
+        self.assertIsNone(choose(self.values, None, NEAREST))
+
+
+class EngineParityTests(TestCase):
+    """ SQL and matrix engines find the same analog and the same candidates after the HARD step """
+
+    def setUp(self):
+        reset_caches()
+        self.catalog = Catalog().bolts()
+
+    def search(self, engine, product=None, manufacturer=None, search_modes=None, use_bitmaps=False) -> AnalogSearch:
+        return AnalogSearch(
+            product_from=product or self.catalog.initial, manufacturer_to=manufacturer or self.catalog.target,
+            engine=engine, search_modes=search_modes, use_bitmaps=use_bitmaps
+        ).build()
+
+    def assertParity(self, expected, **kwargs):
+        results = {
+            'sql': self.search(SQL_ENGINE, **kwargs),
+            'bitmaps': self.search(SQL_ENGINE, use_bitmaps=True, **kwargs),
+            'matrix': self.search(MATRIX_ENGINE, **kwargs),
+        }
+        second_dataset = sorted(results['sql'].second_dataset)
+        for name, result in results.items():
+            with self.subTest(engine=name):
+                self.assertEqual(result.product, expected)
+                self.assertEqual(sorted(result.second_dataset), second_dataset)
+
+    def test_hard_step(self):
+        result = self.search(SQL_ENGINE)
+        self.assertEqual(sorted(result.second_dataset), [self.catalog.b1.pk, self.catalog.b2.pk, self.catalog.b3.pk])
+
+    def test_nearest(self):
+        self.assertParity(self.catalog.b1)
+
+    def test_search_types(self):
+        diameter, catalog = self.catalog.diameter.pk, self.catalog
+        for mode, expected in ((MIN, catalog.b1), (MAX, catalog.b2), (CLOSEST_MIN, catalog.b1),
+                               (CLOSEST_MAX, catalog.b2)):
+            with self.subTest(mode=mode):
+                self.assertParity(expected, search_modes={diameter: mode})
+
+    def test_attribute_search_type(self):
+        self.catalog.diameter.search_type = CLOSEST_MAX
+        self.catalog.diameter.save()
+        self.assertParity(self.catalog.b2)
+
+    def test_duplicated_values(self):
+        # the second row of an attribute matches as well as the first one
+        self.catalog.value(self.catalog.b3, self.catalog.diameter, 5)
+        self.assertParity(self.catalog.b3)
+
+    def test_missing_value(self):
+        # HARD attribute missing at the initial product: candidates without a value of it pass
+        catalog = self.catalog
+        product = catalog.product('A-2', catalog.source, kind=catalog.hex, diameter=5)
+        b6 = catalog.product('B-6', catalog.target, kind=catalog.hex, diameter=5)
+        b7 = catalog.product('B-7', catalog.target, kind=catalog.hex, diameter=7)
+        catalog.value(b7, catalog.length, None)
+        self.assertParity(b6, product=product)
+        self.assertEqual(sorted(self.search(MATRIX_ENGINE, product=product).second_dataset), [b6.pk, b7.pk])
+
+    def test_not_found(self):
+        for engine in (SQL_ENGINE, MATRIX_ENGINE, RANKED_ENGINE):
+            with self.subTest(engine=engine):
+                with self.assertRaises(AnalogNotFound):
+                    self.search(engine, manufacturer=self.catalog.other)
+
+    def test_irrelevant_products_are_skipped(self):
+        self.catalog.b1.irrelevant = True
+        self.catalog.b1.save()
+        self.assertParity(self.catalog.b2)
+
+    def test_build_many(self):
+        catalog = self.catalog
+        products, manufacturers = [catalog.initial, catalog.b4], [catalog.source, catalog.target, catalog.other]
+        sql = AnalogSearch.build_many(products, manufacturers, engine=SQL_ENGINE, use_stored=False)
+        matrix = AnalogSearch.build_many(products, manufacturers, engine=MATRIX_ENGINE, use_stored=False)
+
+        self.assertEqual(sql.keys(), matrix.keys())
+        for key in sql:
+            with self.subTest(key=key):
+                self.assertEqual(sql[key][0], matrix[key][0])
+                self.assertEqual(sorted(sql[key][1]), sorted(matrix[key][1]))
+        self.assertEqual(sql[(catalog.initial.pk, catalog.target.pk)][0], catalog.b1.pk)
+        self.assertEqual(sql[(catalog.initial.pk, catalog.source.pk)], (catalog.initial.pk, []))
+        self.assertEqual(sql[(catalog.initial.pk, catalog.other.pk)], (None, []))
+
+    def test_build_many_serves_and_stores_results(self):
+        catalog = self.catalog
+        version = category_version(catalog.category.pk)
+        ProductAnalog.store(catalog.initial.pk, catalog.target.pk, catalog.b3.pk, [], version)
+
+        analogs = AnalogSearch.build_many([catalog.initial], [catalog.target, catalog.other])
+
+        self.assertEqual(analogs[(catalog.initial.pk, catalog.target.pk)], (catalog.b3.pk, []))
+        self.assertEqual(analogs[(catalog.initial.pk, catalog.other.pk)], (None, []))
+        stored = ProductAnalog.objects.current().get(product=catalog.initial, manufacturer_to=catalog.other)
+        self.assertIsNone(stored.analog)
+
+    def test_ranked(self):
+        result = self.search(RANKED_ENGINE)
+        self.assertEqual(result.product, self.catalog.b1)
+        self.assertEqual([pk for pk, _ in result.ranked], [self.catalog.b1.pk, self.catalog.b2.pk, self.catalog.b3.pk])
+        self.assertEqual([score for _, score in result.ranked], [1., 1.5, 1.5])
+
+    @override_settings(ANALOG_SEARCH_ENGINE=RANKED_ENGINE)
+    def test_ranked_result_is_reused(self):
+        catalog = self.catalog
+        for product in (catalog.initial, Product.objects.get(pk=catalog.initial.pk)):  # searched, then stored
+            with self.subTest(product=product):
+                self.assertEqual(product.get_analog(catalog.target), catalog.b1)
+                with self.assertNumQueries(1):  # candidates only, the result row is already loaded
+                    ranked = product.get_ranked(catalog.target)
+                self.assertEqual([(analog, score) for analog, score in ranked],
+                                 [(catalog.b1, 1.), (catalog.b2, 1.5), (catalog.b3, 1.5)])
+
+
+@override_settings(ANALOG_ALTERNATIVE_WORKERS=2)
+class AlternativeCategoryTests(TransactionTestCase):
+    """ Alternatives are searched on the thread pool with their own connections, so the data is committed """
+
+    def setUp(self):
+        reset_caches()
+        catalog = self.catalog = Catalog().bolts()
+        self.manufacturer = catalog.create(Manufacturer, title='Delta')
+        self.low = catalog.create(Category, title='Винты', parent=catalog.parent)
+        self.high = catalog.create(Category, title='Шпильки', parent=catalog.parent)
+        for category, priority in ((self.low, 1), (self.high, 2)):
+            category.attributes.add(catalog.kind, catalog.length, catalog.diameter, catalog.weight)
+            catalog.create(AlternativeCategory, original=catalog.category, alternative=category, priority=priority)
+
+    def product(self, article, category, length=10):
+        return self.catalog.product(article, self.manufacturer, category=category, kind=self.catalog.hex,
+                                    length=length, diameter=5, weight=2)
+
+    def test_higher_priority_wins(self):
+        self.product('D-1', self.low)
+        high = self.product('D-2', self.high)
+        self.assertEqual(self.catalog.initial.search_analog(self.manufacturer), high)
+
+    def test_lower_priority_after_a_miss(self):
+        low = self.product('D-1', self.low)
+        self.product('D-2', self.high, length=12)
+        self.assertEqual(self.catalog.initial.search_analog(self.manufacturer), low)
+
+    def test_failed_alternative_is_a_miss(self):
+        low = self.product('D-1', self.low)
+        self.product('D-2', self.high)
+        build, high_pk = AnalogSearch.build, self.high.pk
+
+        def broken_build(search, category=None):
+            if category is not None and category.pk == high_pk:
+                raise RuntimeError('broken alternative')
+            return build(search, category)
+
+        with mock.patch.object(AnalogSearch, 'build', broken_build):
+            self.assertEqual(self.catalog.initial.search_analog(self.manufacturer), low)
@@ -165,10 +165,10 @@ class SearchProducts(object):
             self.manufacturer_from = self.form.cleaned_data.get('manufacturer_from')
             if self.manufacturer_from:
                 self.product = Product.objects\
-                    .filter(article=self.article, manufacturer=self.manufacturer_from)\
+                    .by_article(self.article, manufacturer=self.manufacturer_from)\
                     .select_related('manufacturer', 'category').first()
         else:
-            self.product = Product.objects.filter(article=self.article) \
+            self.product = Product.objects.by_article(self.article) \
                 .select_related('manufacturer', 'category').first()
         
         if not self.product:
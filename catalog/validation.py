@@ -0,0 +1,29 @@
+"""
+Процессы проверки строк загружаемого файла, см. <ProcessingUploadData.iter_validated>
+
+Модуль не импортирует модели: при запуске процесса методом spawn он загружается до настройки Django.
+Процессы не обращаются к БД, снимок справочников со всеми ключами товаров готовит родительский процесс
+"""
+import pickle
+from typing import Tuple
+
+_validator = None
+
+
+def init(snapshot: bytes, options, upsert: bool):
+    """ Pool initializer: the resolver is unpickled only after the apps are loaded """
+    global _validator
+
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+    from catalog.file_utils import ProcessingUploadData
+
+    _validator = ProcessingUploadData.validator(pickle.loads(snapshot), options, upsert)
+
+
+def validate_chunk(start: int, lines: list) -> Tuple[int, list, list]:
+    return _validator.validate_chunk(start, lines)
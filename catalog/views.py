@@ -77,7 +77,7 @@ def search_view(request):
             manufacturer_to = form.cleaned_data['manufacturer_to']
             
             try:
-                product = Product.objects.get(article=article, manufacturer=manufacturer_from)
+                product = Product.objects.get_by_article(article, manufacturer=manufacturer_from)
             except Product.DoesNotExist:
                 return render(request, 'admin/catalog/search.html',
                               {'Error': {'val': True, 'msg': 'Не найден продукт с артикулом {}'.format(article)}})
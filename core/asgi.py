@@ -0,0 +1,53 @@
+"""
+ASGI config for analog project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+e.g. ``uvicorn core.asgi:application``. Async views of the API wait for the database
+on the default executor of the loop: <sync_to_async(thread_sensitive=False)> runs the ORM work there,
+so the pool is bounded by ASGI_THREADS, the number of DB connections of a worker as well.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+
+from app.log_writer import writer as log_writer
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+django_application = get_asgi_application()
+_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ASGI_THREADS', 16), thread_name_prefix='asgi')
+_loop = None
+
+
+def _bound_pool():
+    global _loop
+
+    loop = asyncio.get_event_loop()
+    if loop is not _loop:
+        loop.set_default_executor(_executor)
+        _loop = loop
+
+
+async def application(scope, receive, send):
+    _bound_pool()
+
+    if scope['type'] == 'lifespan':
+        # Django 3.1 serves only http
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                log_writer.stop()
+                _executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    await django_application(scope, receive, send)